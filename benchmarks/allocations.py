@@ -0,0 +1,68 @@
+"""
+Memory allocated to serve one request of each route, measured with tracemalloc.
+
+    python -m benchmarks.allocations [--requests 50] [--output FILE]
+
+Requests run one at a time against the load scenarios. For each one, the peak
+of the traced memory above what was held before it started is recorded: the
+transient allocations of the request path, such as decoded bodies, validated
+models, intermediate dicts and the encoded response.
+"""
+import argparse
+import asyncio
+import statistics
+import tracemalloc
+
+from benchmarks import stand_ins
+from benchmarks.load import build_scenarios
+from benchmarks.results import write_results
+
+WARMUP_REQUESTS = 5
+
+
+async def measure(client, make_request, requests: int) -> dict:
+    for index in range(WARMUP_REQUESTS):
+        await make_request(client, index)
+
+    peaks = []
+    for index in range(WARMUP_REQUESTS, WARMUP_REQUESTS + requests):
+        tracemalloc.reset_peak()
+        held, _ = tracemalloc.get_traced_memory()
+        await make_request(client, index)
+        _, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak - held)
+
+    return {
+        "requests": requests,
+        "median_peak_bytes": int(statistics.median(peaks)),
+        "max_peak_bytes": max(peaks),
+    }
+
+
+async def main(requests: int, output: str = None):
+    import httpx
+    # main reads the settings and builds its clients on import, so it waits for the stand-ins
+    from main import app
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            scenarios = await build_scenarios(app, client, WARMUP_REQUESTS + requests)
+            tracemalloc.start()
+            try:
+                results = {name: await measure(client, make_request, requests)
+                           for name, make_request in scenarios.items()}
+            finally:
+                tracemalloc.stop()
+
+    write_results({"suite": "allocations", "results": results}, output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Memory allocated per request of each route")
+    parser.add_argument("--requests", type=int, default=50, help="measured requests per scenario")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    stand_ins.install()
+    asyncio.run(main(args.requests, args.output))
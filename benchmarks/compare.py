@@ -0,0 +1,53 @@
+"""
+Compare two result files written by the benchmark suites.
+
+    python -m benchmarks.compare BASELINE CANDIDATE [--threshold 10]
+
+Prints the change of every shared scenario and exits with 1 when one got slower
+by more than `threshold` percent, so it can gate a change in CI.
+"""
+import argparse
+import json
+import sys
+
+# the figure each suite is compared on, lower is better
+METRICS = {"micro": "best_ns", "load": "p95_ms", "allocations": "median_peak_bytes"}
+
+
+def compare(baseline: dict, candidate: dict, threshold: float) -> list:
+    """
+    @return: the names of the scenarios that regressed by more than `threshold` percent
+    """
+    metric = METRICS[candidate["suite"]]
+    regressions = []
+    print(f"{baseline.get('commit')} -> {candidate.get('commit')} ({metric})")
+    for name, result in candidate["results"].items():
+        before = baseline["results"].get(name, {}).get(metric)
+        if not before:
+            print(f"  {name}: {result[metric]} (new)")
+            continue
+        change = (result[metric] - before) / before * 100
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        print(f"  {name}: {before} -> {result[metric]} ({change:+.1f}%){'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=10.0, help="allowed slowdown in percent")
+    args = parser.parse_args()
+
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    with open(args.candidate) as file:
+        candidate = json.load(file)
+    if candidate.get("suite") not in METRICS:
+        sys.exit(f"only the {', '.join(METRICS)} suites can be compared")
+    if baseline.get("suite") != candidate.get("suite"):
+        sys.exit(f"cannot compare a {baseline.get('suite')} run with a {candidate.get('suite')} run")
+
+    sys.exit(1 if compare(baseline, candidate, args.threshold) else 0)
@@ -0,0 +1,162 @@
+"""
+Concurrent load scenarios against every route of `main.app`, served in process
+with Mongo and Redis replaced by the in-memory stand-ins.
+
+    python -m benchmarks.load [--requests 500] [--concurrency 20] [--mongo-latency-ms 0]
+                              [--redis-latency-ms 0] [--redis-nodes 1] [--output FILE]
+
+Each scenario reports its throughput and latency percentiles. The stand-ins
+answer instantly unless a latency is given, so the numbers mostly measure the
+application's own work: validation, crypto, caching and serialization.
+"""
+import argparse
+import asyncio
+import time
+from collections import Counter
+
+from benchmarks import stand_ins
+from benchmarks.results import percentiles, write_results
+
+PAYLOAD = {
+    "user_id": "benchmark-user",
+    "full_name": "Jane Doe",
+    "transaction_amount": 125.5,
+    "transaction_type": "credit",
+    "transaction_date": "2024-10-01T09:40:53Z",
+    "transaction_currency": "USD",
+}
+SEED_TRANSACTIONS = 500
+BULK_SIZE = 100
+ANALYTICS_BATCH_SIZE = 200
+
+
+def _payload(user_id: str, index: int) -> dict:
+    return {**PAYLOAD, "user_id": user_id, "transaction_amount": 1 + index % 500,
+            "transaction_date": f"2024-{1 + index % 12:02d}-{1 + index % 28:02d}T09:40:53Z"}
+
+
+async def run_scenario(client, make_request, requests: int, concurrency: int) -> dict:
+    latencies = []
+    status_codes = Counter()
+    indexes = iter(range(requests))
+
+    async def worker():
+        for index in indexes:
+            started = time.perf_counter()
+            response = await make_request(client, index)
+            if hasattr(response, "aread"):
+                await response.aread()
+            latencies.append(time.perf_counter() - started)
+            status_codes[response.status_code] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "throughput_rps": round(requests / elapsed, 1),
+        "status_codes": {str(code): count for code, count in sorted(status_codes.items())},
+        **percentiles(latencies),
+    }
+
+
+async def seed(client, user_id: str, count: int):
+    """Create `count` transactions for `user_id` and return their ids."""
+    ids = []
+    for offset in range(0, count, BULK_SIZE):
+        records = [_payload(user_id, index) for index in range(offset, min(offset + BULK_SIZE, count))]
+        response = await client.post("/api/v1/transactions:bulk", json=records)
+        ids.extend(result["id"] for result in response.json()["data"])
+    return ids
+
+
+async def build_scenarios(app, client, requests: int) -> dict:
+    """
+    Seed the data the scenarios rely on.
+    @return: request factories by scenario name, called with the client and the request index
+    """
+    history_ids = await seed(client, "history-user", SEED_TRANSACTIONS)
+    deletable_ids = await seed(client, "delete-user", requests)
+
+    analytics_user_ids = [f"analytics-user-{n}" for n in range(ANALYTICS_BATCH_SIZE)]
+    await client.post("/api/v1/transactions:bulk", json=[_payload(user_id, 0) for user_id in analytics_user_ids])
+
+    async def analytics_batch_cache_miss(c, i):
+        await app.state.redis_service.bump_generations(analytics_user_ids)
+        return await c.post("/api/v1/transactions/analytics:batch", json={"user_ids": analytics_user_ids})
+
+    async def history_cache_miss(c, i):
+        await app.state.redis_service.bump_generations(["history-user"])
+        return await c.get("/api/v1/transactions/history-user")
+
+    scenarios = {
+        "POST /api/v1/transactions": lambda c, i: c.post(
+            "/api/v1/transactions", json=_payload("create-user", i)),
+    }
+    if app.state.write_behind_queue is not None:
+        scenarios["POST /api/v1/transactions (respond-async)"] = lambda c, i: c.post(
+            "/api/v1/transactions", json=_payload("async-user", i), headers={"Prefer": "respond-async"})
+    scenarios.update({
+        f"POST /api/v1/transactions:bulk ({BULK_SIZE} records)": lambda c, i: c.post(
+            "/api/v1/transactions:bulk", json=[_payload(f"bulk-user-{i}", n) for n in range(BULK_SIZE)]),
+        "GET /api/v1/transactions/{user_id}": lambda c, i: c.get(
+            "/api/v1/transactions/history-user"),
+        "GET /api/v1/transactions/{user_id} (cache miss)": history_cache_miss,
+        "GET /api/v1/transactions/{user_id} (cursor)": lambda c, i: c.get(
+            "/api/v1/transactions/history-user", params={"pagination": "cursor", "page_size": 50}),
+        "GET /api/v1/transactions/{user_id}/analytics": lambda c, i: c.get(
+            "/api/v1/transactions/history-user/analytics"),
+        f"POST /api/v1/transactions/analytics:batch ({ANALYTICS_BATCH_SIZE} users)": lambda c, i: c.post(
+            "/api/v1/transactions/analytics:batch", json={"user_ids": analytics_user_ids}),
+        f"POST /api/v1/transactions/analytics:batch ({ANALYTICS_BATCH_SIZE} users, cache miss)":
+            analytics_batch_cache_miss,
+        "GET /api/v1/transactions/{user_id}/export": lambda c, i: c.get(
+            "/api/v1/transactions/history-user/export"),
+        "PUT /api/v1/transactions/{transaction_id}": lambda c, i: c.put(
+            f"/api/v1/transactions/{history_ids[i % len(history_ids)]}", json=_payload("history-user", i)),
+        "DELETE /api/v1/transactions/{transaction_id}": lambda c, i: c.delete(
+            f"/api/v1/transactions/{deletable_ids[i]}"),
+    })
+    return scenarios
+
+
+async def main(requests: int, concurrency: int, mongo_latency_ms: float, redis_latency_ms: float,
+               redis_nodes: int = 1, output: str = None):
+    import httpx
+    # main reads the settings and builds its clients on import, so it waits for the stand-ins
+    from main import app
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            results = {}
+            for name, make_request in (await build_scenarios(app, client, requests)).items():
+                # the heavier routes get fewer requests so a run stays short
+                count = requests if "bulk" not in name and "export" not in name else max(1, requests // 10)
+                results[name] = await run_scenario(client, make_request, count, concurrency)
+
+    write_results({
+        "suite": "load",
+        "mongo_latency_ms": mongo_latency_ms,
+        "redis_latency_ms": redis_latency_ms,
+        "redis_nodes": redis_nodes,
+        "seed_transactions": SEED_TRANSACTIONS,
+        "results": results,
+    }, output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load scenarios against every route")
+    parser.add_argument("--requests", type=int, default=500, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--mongo-latency-ms", type=float, default=0.0, help="delay added to every Mongo call")
+    parser.add_argument("--redis-latency-ms", type=float, default=0.0, help="delay added to every Redis call")
+    parser.add_argument("--redis-nodes", type=int, default=1, help="redis servers the cache is sharded over")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    stand_ins.install(args.mongo_latency_ms / 1000, args.redis_latency_ms / 1000, args.redis_nodes)
+    asyncio.run(main(args.requests, args.concurrency, args.mongo_latency_ms, args.redis_latency_ms, args.redis_nodes,
+                     args.output))
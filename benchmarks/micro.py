@@ -0,0 +1,133 @@
+"""
+Microbenchmarks of the CPU bound steps of the request paths.
+
+    python -m benchmarks.micro [--min-time 0.5] [--output FILE]
+"""
+import argparse
+import statistics
+import time
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+from benchmarks import stand_ins
+
+stand_ins.install()
+
+from bson import ObjectId  # noqa: E402
+
+from benchmarks.results import write_results  # noqa: E402
+from src.transaction.dto.requests.transaction_create_req import TransactionCreateRequest  # noqa: E402
+from src.transaction.dto.responses.http_response import TRANSACTION_RESPONSE_FIELDS, dump_response, \
+    transaction_list_adapter, transaction_page_model  # noqa: E402
+from src.transaction.services.redis_service import CachedResponse  # noqa: E402
+from src.transaction.utils.analytics import summarize_daily_rollups  # noqa: E402
+from src.transaction.utils.security import decrypt_field, encrypt_field  # noqa: E402
+
+PAYLOAD = {
+    "user_id": "benchmark-user",
+    "full_name": "Jane Doe",
+    "transaction_amount": 125.5,
+    "transaction_type": "credit",
+    "transaction_date": "2024-10-01T09:40:53Z",
+    "transaction_currency": "USD",
+}
+HISTORY_SIZE = 100
+
+
+def bench(func, min_time: float, repeat: int = 5) -> dict:
+    """
+    Time `func` in loops long enough to last about `min_time` seconds, `repeat` times.
+    @return: per call timings in nanoseconds
+    """
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time / 10:
+            break
+        loops *= 2
+    loops = max(1, int(loops * min_time / elapsed))
+
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        timings.append((time.perf_counter() - started) / loops * 1e9)
+
+    return {
+        "loops": loops,
+        "best_ns": round(min(timings), 1),
+        "median_ns": round(statistics.median(timings), 1),
+        "ops_per_second": round(1e9 / min(timings), 1),
+    }
+
+
+def history_documents():
+    encrypted_name = encrypt_field(PAYLOAD["full_name"])
+    started = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    return [{
+        "_id": ObjectId(),
+        "user_id": PAYLOAD["user_id"],
+        "full_name": encrypted_name,
+        "transaction_amount": Decimal("125.50"),
+        "transaction_type": "credit",
+        "transaction_date": started + timedelta(hours=index),
+        "transaction_currency": "USD",
+    } for index in range(HISTORY_SIZE)]
+
+
+def scenarios():
+    encrypted_name = encrypt_field(PAYLOAD["full_name"])
+    documents = history_documents()
+    for document in documents:
+        document["full_name"] = PAYLOAD["full_name"]
+
+    fields = tuple(TRANSACTION_RESPONSE_FIELDS)
+    adapter = transaction_list_adapter(fields)
+    responses = adapter.validate_python(documents, context={"decrypted": True})
+    history = {"is_successful": True, "message": "operation completed successfully", "page": 1,
+               "page_size": len(responses), "data": adapter.dump_python(responses, by_alias=True)}
+    cached = CachedResponse.encode(history)
+    page = transaction_page_model(fields).model_construct(is_successful=True,
+                                                         message="operation completed successfully", page=1,
+                                                         page_size=len(responses), next_cursor=None, data=responses)
+
+    rollups = [{"day": f"2024-{month:02d}-{day:02d}", "transaction_count": day,
+                "transaction_amount": Decimal(day * 10)}
+               for month in range(1, 13) for day in range(1, 29)]
+
+    return {
+        # the encrypting validator replaces full_name in the dict it is given, so it gets a fresh one each time
+        "dto_validation": lambda: TransactionCreateRequest.model_validate(dict(PAYLOAD)),
+        "dto_validation_deferred_encryption": lambda: TransactionCreateRequest.model_validate(
+            PAYLOAD, context={"defer_encryption": True}),
+        "dto_validation_json_deferred_encryption": lambda: TransactionCreateRequest.model_validate_json(
+            b'{"user_id":"benchmark-user","full_name":"Jane Doe","transaction_amount":125.5,'
+            b'"transaction_type":"credit","transaction_date":"2024-10-01T09:40:53Z","transaction_currency":"USD"}',
+            context={"defer_encryption": True}),
+        "encrypt_field": lambda: encrypt_field(PAYLOAD["full_name"]),
+        "decrypt_field": lambda: decrypt_field(encrypted_name),
+        f"history_response_validation_{HISTORY_SIZE}": lambda: adapter.validate_python(
+            documents, context={"decrypted": True}),
+        f"history_response_dump_{HISTORY_SIZE}": lambda: adapter.dump_python(responses, by_alias=True),
+        f"history_page_dump_json_{HISTORY_SIZE}": lambda: dump_response(page, by_alias=True),
+        f"cache_encode_{HISTORY_SIZE}": lambda: CachedResponse.encode(history),
+        f"cache_decode_{HISTORY_SIZE}": cached.decode,
+        f"analytics_summary_{len(rollups)}_days": lambda: summarize_daily_rollups(rollups),
+    }
+
+
+def main(min_time: float, output: str = None):
+    results = {name: bench(func, min_time) for name, func in scenarios().items()}
+    write_results({"suite": "micro", "min_time": min_time, "results": results}, output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the request path steps")
+    parser.add_argument("--min-time", type=float, default=0.5, help="seconds spent on each repetition")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+    main(args.min_time, args.output)
@@ -0,0 +1,95 @@
+"""
+Compare query latency of Motor against PyMongo's native AsyncMongoClient.
+
+    python -m benchmarks.mongo_client_latency [--requests 2000] [--concurrency 50] [--output FILE]
+
+Runs the same find_one and insert_one workload, sequentially and concurrently,
+through both drivers against MONGODB_URL, in a scratch collection that is
+dropped afterwards, and prints the latency percentiles of each as JSON.
+"""
+import argparse
+import asyncio
+import time
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import AsyncMongoClient
+
+from benchmarks.results import percentiles, write_results
+from src.config import Config
+
+COLLECTION = "benchmark_client_latency"
+
+
+async def timed(operation, samples):
+    started = time.perf_counter()
+    await operation()
+    samples.append(time.perf_counter() - started)
+
+
+async def run_workload(collection, requests: int, concurrency: int):
+    document_id = ObjectId()
+    await collection.insert_one({"_id": document_id, "user_id": "benchmark", "transaction_amount": "1"})
+
+    def find_one():
+        return collection.find_one({"_id": document_id})
+
+    def insert_one():
+        return collection.insert_one({"user_id": "benchmark", "transaction_amount": "1"})
+
+    results = {}
+    for name, operation in (("find_one", find_one), ("insert_one", insert_one)):
+        sequential = []
+        for _ in range(requests):
+            await timed(operation, sequential)
+
+        concurrent = []
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def bounded():
+            async with semaphore:
+                await timed(operation, concurrent)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(bounded() for _ in range(requests)))
+        elapsed = time.perf_counter() - started
+
+        results[name] = {
+            "sequential": percentiles(sequential),
+            "concurrent": {**percentiles(concurrent), "ops_per_second": round(requests / elapsed, 1)},
+        }
+    return results
+
+
+async def main(requests: int, concurrency: int, output: str = None):
+    options = {"maxPoolSize": Config.MONGO_MAX_POOL_SIZE}
+    report = {"requests": requests, "concurrency": concurrency}
+
+    motor_client = AsyncIOMotorClient(Config.MONGODB_URL, **options)
+    try:
+        collection = motor_client[Config.MONGO_DATABASE][COLLECTION]
+        await collection.drop()
+        report["motor"] = await run_workload(collection, requests, concurrency)
+        await collection.drop()
+    finally:
+        motor_client.close()
+
+    pymongo_client = AsyncMongoClient(Config.MONGODB_URL, **options)
+    try:
+        collection = pymongo_client[Config.MONGO_DATABASE][COLLECTION]
+        await collection.drop()
+        report["pymongo_async"] = await run_workload(collection, requests, concurrency)
+        await collection.drop()
+    finally:
+        await pymongo_client.close()
+
+    write_results(report, output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.concurrency, args.output))
@@ -0,0 +1,47 @@
+import json
+import os
+import platform
+import statistics
+import subprocess
+from datetime import datetime, timezone
+from typing import List, Optional
+
+
+def percentiles(samples: List[float]) -> dict:
+    """Latency summary of `samples`, given in seconds, reported in milliseconds."""
+    samples = sorted(samples)
+    quantiles = statistics.quantiles(samples, n=100, method="inclusive") if len(samples) > 1 else samples * 99
+    return {
+        "count": len(samples),
+        "mean_ms": round(statistics.fmean(samples) * 1000, 3),
+        "p50_ms": round(quantiles[49] * 1000, 3),
+        "p95_ms": round(quantiles[94] * 1000, 3),
+        "p99_ms": round(quantiles[98] * 1000, 3),
+        "max_ms": round(samples[-1] * 1000, 3),
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(report: dict, output: Optional[str] = None):
+    """
+    Print `report` as JSON, and write it to `output` if given, along with what
+    is needed to compare it with another run: the commit, the interpreter and the time.
+    """
+    report = {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        **report,
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if output:
+        with open(output, "w") as file:
+            file.write(text + "\n")
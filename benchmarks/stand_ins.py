@@ -0,0 +1,526 @@
+"""
+In-process stand-ins for MongoDB and Redis, so `main.app` can be benchmarked
+without either server.
+
+They implement the subset of the PyMongo and redis-py APIs the application
+uses, keep everything in memory, and can add a fixed latency to every call
+to approximate a network round trip. `install()` must be called before
+`main` is imported.
+"""
+import asyncio
+import base64
+import copy
+import os
+import secrets
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional
+
+from bson import ObjectId
+from cryptography.fernet import Fernet
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+_MISSING = object()
+
+
+def _value(document: dict, path: str):
+    for part in path.split("."):
+        if not isinstance(document, dict) or part not in document:
+            return _MISSING
+        document = document[part]
+    return document
+
+
+def _compare(op: str, value, argument) -> bool:
+    if value is _MISSING or value is None:
+        return False
+    if op == "$lt":
+        return value < argument
+    if op == "$lte":
+        return value <= argument
+    if op == "$gt":
+        return value > argument
+    return value >= argument
+
+
+def matches(document: dict, query: dict) -> bool:
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(matches(document, branch) for branch in condition):
+                return False
+            continue
+
+        value = _value(document, key)
+        if isinstance(condition, dict) and condition and all(op.startswith("$") for op in condition):
+            for op, argument in condition.items():
+                if op == "$in":
+                    if value is _MISSING or value not in argument:
+                        return False
+                elif op == "$exists":
+                    if (value is not _MISSING) != bool(argument):
+                        return False
+                elif op in ("$lt", "$lte", "$gt", "$gte"):
+                    if not _compare(op, value, argument):
+                        return False
+                else:
+                    raise NotImplementedError(f"query operator {op}")
+        elif (None if value is _MISSING else value) != condition:
+            return False
+    return True
+
+
+def project(document: dict, projection: Optional[dict]) -> dict:
+    if not projection:
+        return copy.deepcopy(document)
+    included = [key for key, flag in projection.items() if flag and key != "_id"]
+    if not included:
+        return {key: copy.deepcopy(value) for key, value in document.items() if projection.get(key, 1)}
+    result = {key: copy.deepcopy(document[key]) for key in included if key in document}
+    if projection.get("_id", 1) and "_id" in document:
+        result["_id"] = document["_id"]
+    return result
+
+
+def apply_update(document: dict, update: dict):
+    for op, fields in update.items():
+        if op == "$set":
+            document.update(copy.deepcopy(fields))
+        elif op == "$inc":
+            for key, amount in fields.items():
+                document[key] = document.get(key, 0) + amount
+        elif op == "$unset":
+            for key in fields:
+                document.pop(key, None)
+        else:
+            raise NotImplementedError(f"update operator {op}")
+
+
+def _evaluate(document: dict, expression):
+    if isinstance(expression, str) and expression.startswith("$"):
+        value = _value(document, expression[1:])
+        return None if value is _MISSING else value
+    if isinstance(expression, dict):
+        return {key: _evaluate(document, value) for key, value in expression.items()}
+    return expression
+
+
+def group(documents: List[dict], specification: dict) -> List[dict]:
+    groups = {}
+    for document in documents:
+        key = _evaluate(document, specification["_id"])
+        result = groups.setdefault(repr(key), {"_id": key})
+        for field, accumulator in specification.items():
+            if field == "_id":
+                continue
+            (op, expression), = accumulator.items()
+            value = _evaluate(document, expression)
+            if op == "$sum":
+                result[field] = result.get(field, 0) + value
+            elif op == "$push":
+                result.setdefault(field, []).append(value)
+            else:
+                raise NotImplementedError(f"accumulator {op}")
+    return list(groups.values())
+
+
+class Latency:
+    """Fixed delay added to every call of a stand-in, in seconds."""
+
+    def __init__(self, seconds: float = 0.0):
+        self.seconds = seconds
+
+    async def wait(self):
+        await asyncio.sleep(self.seconds)
+
+
+class InMemoryCursor:
+    def __init__(self, documents: List[dict], projection: Optional[dict], latency: Latency):
+        self._documents = documents
+        self._projection = projection
+        self._latency = latency
+        self._sort = []
+        self._limit = 0
+        self._iterator = None
+
+    def sort(self, key_or_list, direction=None):
+        if isinstance(key_or_list, str):
+            self._sort = [(key_or_list, direction or 1)]
+        else:
+            self._sort = list(key_or_list.items() if isinstance(key_or_list, dict) else key_or_list)
+        return self
+
+    def limit(self, limit: int):
+        self._limit = limit
+        return self
+
+    def batch_size(self, batch_size: int):
+        return self
+
+    def _results(self) -> List[dict]:
+        documents = list(self._documents)
+        for key, direction in reversed(self._sort):
+            documents.sort(key=lambda document: _value(document, key), reverse=direction == -1)
+        if self._limit:
+            documents = documents[:self._limit]
+        return [project(document, self._projection) for document in documents]
+
+    async def to_list(self, length: Optional[int] = None) -> List[dict]:
+        await self._latency.wait()
+        results = self._results()
+        return results[:length] if length else results
+
+    def __aiter__(self):
+        self._iterator = iter(self._results())
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._iterator)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def close(self):
+        pass
+
+
+class InsertOneResult:
+    def __init__(self, inserted_id):
+        self.inserted_id = inserted_id
+
+
+class DeleteResult:
+    def __init__(self, deleted_count: int):
+        self.deleted_count = deleted_count
+
+
+class InMemoryCollection:
+    def __init__(self, name: str, latency: Latency):
+        self.name = name
+        self.latency = latency
+        self.documents: Dict[Any, dict] = {}
+
+    def with_options(self, **options):
+        return self
+
+    async def create_indexes(self, indexes, session=None):
+        return [index.document["name"] for index in indexes]
+
+    async def insert_one(self, document: dict, session=None):
+        await self.latency.wait()
+        document.setdefault("_id", ObjectId())
+        if document["_id"] in self.documents:
+            raise DuplicateKeyError("E11000 duplicate key")
+        self.documents[document["_id"]] = copy.deepcopy(document)
+        return InsertOneResult(document["_id"])
+
+    async def insert_many(self, documents: List[dict], ordered: bool = True, session=None):
+        await self.latency.wait()
+        write_errors = []
+        for index, document in enumerate(documents):
+            document.setdefault("_id", ObjectId())
+            if document["_id"] in self.documents:
+                write_errors.append({"index": index, "code": 11000, "errmsg": "E11000 duplicate key"})
+                if ordered:
+                    break
+                continue
+            self.documents[document["_id"]] = copy.deepcopy(document)
+        if write_errors:
+            raise BulkWriteError({"writeErrors": write_errors})
+
+    def find(self, query: Optional[dict] = None, projection: Optional[dict] = None, session=None, **kwargs):
+        return InMemoryCursor([document for document in self.documents.values() if matches(document, query or {})],
+                              projection, self.latency)
+
+    async def aggregate(self, pipeline: List[dict], session=None, **kwargs):
+        """Runs `$match` and `$group` stages, the latter with `$sum` and `$push` accumulators."""
+        await self.latency.wait()
+        documents = list(self.documents.values())
+        for pipeline_stage in pipeline:
+            (op, argument), = pipeline_stage.items()
+            if op == "$match":
+                documents = [document for document in documents if matches(document, argument)]
+            elif op == "$group":
+                documents = group(documents, argument)
+            else:
+                raise NotImplementedError(f"pipeline stage {op}")
+        return InMemoryCursor(documents, None, Latency())
+
+    async def find_one(self, query: Optional[dict] = None, projection: Optional[dict] = None, session=None):
+        await self.latency.wait()
+        document = self._first(query or {})
+        return project(document, projection) if document is not None else None
+
+    async def find_one_and_update(self, query: dict, update: dict, return_document=False, session=None, **kwargs):
+        await self.latency.wait()
+        document = self._first(query)
+        if document is None:
+            return None
+        before = copy.deepcopy(document)
+        apply_update(document, update)
+        return copy.deepcopy(document) if return_document else before
+
+    async def find_one_and_delete(self, query: dict, session=None, **kwargs):
+        await self.latency.wait()
+        document = self._first(query)
+        if document is not None:
+            del self.documents[document["_id"]]
+        return document
+
+    async def delete_many(self, query: dict, session=None):
+        await self.latency.wait()
+        deleted = [key for key, document in self.documents.items() if matches(document, query)]
+        for key in deleted:
+            del self.documents[key]
+        return DeleteResult(len(deleted))
+
+    async def bulk_write(self, operations, ordered: bool = True, session=None):
+        await self.latency.wait()
+        for operation in operations:
+            query, update, upsert = operation._filter, operation._doc, operation._upsert
+            document = self._first(query)
+            if document is None:
+                if not upsert:
+                    continue
+                document = {key: value for key, value in query.items() if not key.startswith("$")}
+                document["_id"] = ObjectId()
+                self.documents[document["_id"]] = document
+            apply_update(document, update)
+
+    def _first(self, query: dict) -> Optional[dict]:
+        if set(query) == {"_id"} and not isinstance(query["_id"], dict):
+            return self.documents.get(query["_id"])
+        return next((document for document in self.documents.values() if matches(document, query)), None)
+
+
+class InMemorySession:
+    operation_time = None
+    cluster_time = None
+
+    def advance_cluster_time(self, cluster_time):
+        pass
+
+    def advance_operation_time(self, operation_time):
+        pass
+
+
+class InMemoryDatabase:
+    async def command(self, command: dict, **kwargs):
+        if "explain" in command:
+            return {"queryPlanner": {"winningPlan": {"stage": "FETCH", "inputStage": {"stage": "IXSCAN"}}}}
+        return {"ok": 1}
+
+
+class InMemoryPubSub:
+    def __init__(self, redis: "InMemoryRedis"):
+        self._redis = redis
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._channels = set()
+
+    async def subscribe(self, *channels):
+        for channel in channels:
+            self._channels.add(channel)
+            self._redis.subscribers.setdefault(channel, set()).add(self._queue)
+
+    async def listen(self):
+        while True:
+            yield await self._queue.get()
+
+    async def get_message(self, ignore_subscribe_messages: bool = False, timeout: Optional[float] = 0.0):
+        getter = asyncio.ensure_future(self._queue.get())
+        try:
+            await asyncio.wait({getter}, timeout=timeout)
+        finally:
+            getter.cancel()
+        return getter.result() if getter.done() and not getter.cancelled() else None
+
+    async def close(self):
+        for channel in self._channels:
+            self._redis.subscribers.get(channel, set()).discard(self._queue)
+        self._channels.clear()
+
+    aclose = close
+
+
+class InMemoryPipeline:
+    def __init__(self, redis: "InMemoryRedis"):
+        self._redis = redis
+        self._commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self._commands.append((name, args, kwargs))
+            return self
+        return queue
+
+    async def execute(self):
+        await self._redis.latency.wait()
+        results = [getattr(self._redis, f"_{name}")(*args, **kwargs) for name, args, kwargs in self._commands]
+        self._commands = []
+        return results
+
+
+class InMemoryRedis:
+    """Key/value store with expiry, MGET, INCR, pub/sub and pipelines, behaving like redis-py's asyncio client."""
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.data: Dict[str, tuple] = {}
+        self.subscribers: Dict[str, set] = {}
+        self.scripts = {}
+
+    @staticmethod
+    def _encode(value) -> bytes:
+        return value if isinstance(value, bytes) else str(value).encode()
+
+    def _get(self, key: str) -> Optional[bytes]:
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self.data[key]
+            return None
+        return value
+
+    def _set(self, key: str, value, ex: Optional[int] = None, px: Optional[int] = None, nx: bool = False):
+        if nx and self._get(key) is not None:
+            return None
+        expires_at = None
+        if ex is not None:
+            expires_at = time.monotonic() + ex
+        elif px is not None:
+            expires_at = time.monotonic() + px / 1000
+        self.data[key] = (self._encode(value), expires_at)
+        return True
+
+    def _mget(self, keys: List[str]) -> List[Optional[bytes]]:
+        return [self._get(key) for key in keys]
+
+    def _incr(self, key: str) -> int:
+        value = int(self._get(key) or 0) + 1
+        expires_at = self.data[key][1] if key in self.data else None
+        self.data[key] = (self._encode(value), expires_at)
+        return value
+
+    def _delete(self, *keys) -> int:
+        return sum(1 for key in keys if self.data.pop(key, None) is not None)
+
+    def _publish(self, channel: str, message) -> int:
+        subscribers = self.subscribers.get(channel, set())
+        for queue in subscribers:
+            queue.put_nowait({"type": "message", "channel": channel.encode(), "data": self._encode(message)})
+        return len(subscribers)
+
+    async def get(self, key: str):
+        await self.latency.wait()
+        return self._get(key)
+
+    async def mget(self, keys: List[str]):
+        await self.latency.wait()
+        return self._mget(keys)
+
+    async def set(self, key: str, value, ex: Optional[int] = None, px: Optional[int] = None, nx: bool = False):
+        await self.latency.wait()
+        return self._set(key, value, ex=ex, px=px, nx=nx)
+
+    async def incr(self, key: str):
+        await self.latency.wait()
+        return self._incr(key)
+
+    async def delete(self, *keys):
+        await self.latency.wait()
+        return self._delete(*keys)
+
+    async def publish(self, channel: str, message):
+        await self.latency.wait()
+        return self._publish(channel, message)
+
+    async def eval(self, script: str, numkeys: int, *keys_and_args):
+        """Scripts cannot run here; the ones the application sends are registered as Python functions."""
+        await self.latency.wait()
+        return self.scripts[script](self, list(keys_and_args[:numkeys]), list(keys_and_args[numkeys:]))
+
+    def pipeline(self, transaction: bool = True):
+        return InMemoryPipeline(self)
+
+    def pubsub(self):
+        return InMemoryPubSub(self)
+
+    async def close(self):
+        pass
+
+    aclose = close
+
+
+def _release_lock(redis: InMemoryRedis, keys: List[str], args: List[str]) -> int:
+    if redis._get(keys[0]) == redis._encode(args[0]):
+        return redis._delete(keys[0])
+    return 0
+
+
+class StandIns:
+    def __init__(self, mongo_latency: float = 0.0, redis_latency: float = 0.0):
+        self.mongo_latency = Latency(mongo_latency)
+        self.redis_latency = Latency(redis_latency)
+        self.redis = InMemoryRedis(self.redis_latency)
+        # one server per url, REDIS_URL's being `redis`
+        self.redis_servers: Dict[str, InMemoryRedis] = {os.environ["REDIS_URL"]: self.redis}
+        self.transactions = InMemoryCollection("transactions", self.mongo_latency)
+        self.rollups = InMemoryCollection("transaction_daily_rollups", self.mongo_latency)
+        self.analytics = InMemoryCollection("transaction_analytics", self.mongo_latency)
+
+
+def install(mongo_latency: float = 0.0, redis_latency: float = 0.0, redis_nodes: int = 1) -> StandIns:
+    """
+    Point the application at in-memory stand-ins. Call it before importing `main`.
+    @param mongo_latency: seconds added to every Mongo call
+    @param redis_latency: seconds added to every Redis call
+    @param redis_nodes: Redis servers the cache is sharded over, see REDIS_NODES
+    """
+    os.environ.setdefault("MONGODB_URL", "mongodb://stand-in")
+    os.environ.setdefault("REDIS_URL", "redis://stand-in")
+    os.environ.setdefault("FERNET_KEY", Fernet.generate_key().decode())
+    os.environ.setdefault("SESSION_TOKEN_KEY", secrets.token_urlsafe(32))
+    os.environ.setdefault("BLIND_INDEX_KEY", base64.urlsafe_b64encode(secrets.token_bytes(32)).decode())
+    os.environ.setdefault("INDEX_PLAN_GUARD", "off")
+    os.environ.setdefault("MONGO_SLOW_QUERY_MS", "-1")
+    if redis_nodes > 1:
+        os.environ.setdefault("REDIS_NODES", ",".join(f"redis://stand-in-{index}" for index in range(redis_nodes)))
+
+    from src.persistence.base import database
+    from src.transaction.services import redis_service
+    from src.transaction.services.redis_service import RedisService
+
+    stand_ins = StandIns(mongo_latency, redis_latency)
+
+    async def connect():
+        database.db = InMemoryDatabase()
+        database.transactions = database.transaction_reads = stand_ins.transactions
+        database.rollups = database.rollup_reads = stand_ins.rollups
+        database.analytics = database.analytics_reads = stand_ins.analytics
+
+    async def close():
+        pass
+
+    @asynccontextmanager
+    async def causal_session(after=None):
+        yield InMemorySession()
+
+    async def connect_redis_server(url, **options):
+        redis = stand_ins.redis_servers.get(url)
+        if redis is None:
+            redis = stand_ins.redis_servers[url] = InMemoryRedis(stand_ins.redis_latency)
+        redis.scripts[RedisService.RELEASE_LOCK_SCRIPT] = _release_lock
+        return redis
+
+    database.connect = connect
+    database.close = close
+    database.causal_session = causal_session
+    redis_service.connect_redis_server = connect_redis_server
+    return stand_ins
@@ -0,0 +1,46 @@
+"""
+Production server: gunicorn supervising uvicorn workers.
+
+    gunicorn --config gunicorn.conf.py main:app
+
+The app is imported once in the master and forked into the workers, which share
+its memory. Connections are opened by the lifespan, so every worker creates its
+own Mongo and Redis pools after the fork.
+"""
+import os
+import tempfile
+import time
+
+from src.config import Config
+
+# every worker writes its metrics here and /metrics aggregates them, so it must be set before the app is imported.
+# A fresh directory per server start, as files left by a previous run would be aggregated with this one's
+if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="prometheus-")
+
+bind = f"{Config.SERVER_HOST}:{Config.SERVER_PORT}"
+workers = Config.WEB_CONCURRENCY
+worker_class = "src.bootstrap.server.Worker"
+preload_app = True
+
+max_requests = Config.SERVER_MAX_REQUESTS
+max_requests_jitter = Config.SERVER_MAX_REQUESTS_JITTER
+graceful_timeout = Config.SERVER_GRACEFUL_TIMEOUT
+timeout = Config.SERVER_TIMEOUT
+keepalive = Config.SERVER_KEEPALIVE
+
+loglevel = Config.LOG_LEVEL
+accesslog = None
+
+_started = time.perf_counter()
+
+
+def when_ready(server):
+    server.log.info("master ready in %.0fms, app preloaded, starting %d workers",
+                    (time.perf_counter() - _started) * 1000, workers)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -1,26 +1,66 @@
 import os
 from contextlib import asynccontextmanager
 
-import aioredis
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
+from prometheus_client import CONTENT_TYPE_LATEST
 
 from src.bootstrap.containers import Container
+from src.bootstrap.metrics import create_metrics_registry, render_metrics
+from src.bootstrap.server import StartupTimer
+from src.config import Config
+from src.persistence.base import database
 from src.transaction.api import transaction_route
-from src.transaction.services.redis_service import RedisService
+from src.transaction.services.redis_service import RedisService, connect_redis
+from src.transaction.services.write_behind_service import WriteBehindQueue
+from src.transaction.utils.timing import TimingMiddleware
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """
-    connect to redis on startup
+    open and warm up the mongo pool, ensure the indexes and check the query plans,
+    connect to redis and listen for cache invalidations on startup, and run the
+    write-behind flusher, if enabled.
+    Runs once in each worker, after the fork, so every worker gets its own pools.
     :param app:
     :return:
     """
-    REDIS_URL = os.getenv("REDIS_URL")
-    redis = await aioredis.from_url(REDIS_URL)
-    app.state.redis_service = RedisService(redis)  # Store RedisService in app state
+    startup = StartupTimer()
+    with startup.phase("mongo"):
+        await database.connect()
+    transaction_repository = app.container.transaction_repository()
+    with startup.phase("indexes"):
+        await transaction_repository.ensure_indexes()
+        await transaction_repository.check_query_plans(Config.INDEX_PLAN_GUARD)
+
+    with startup.phase("redis"):
+        REDIS_URL = os.getenv("REDIS_URL")
+        redis = await connect_redis(REDIS_URL, Config.REDIS_NODES, Config.REDIS_CLUSTER)
+        app.state.redis_service = RedisService(redis)  # Store RedisService in app state
+        app.state.redis_service.start()
+
+    app.state.write_behind_queue = None
+    if Config.WRITE_BEHIND_ENABLED:
+        app.state.write_behind_queue = WriteBehindQueue(
+            transaction_repository,
+            app.state.redis_service,
+            max_size=Config.WRITE_BEHIND_QUEUE_SIZE,
+            batch_size=Config.WRITE_BEHIND_BATCH_SIZE,
+            flush_interval=Config.WRITE_BEHIND_FLUSH_INTERVAL_MS / 1000,
+        )
+        app.state.write_behind_queue.start()
+    startup.report()
+
     yield
-    await redis.close()
+
+    if app.state.write_behind_queue is not None:
+        await app.state.write_behind_queue.stop()
+    await app.state.redis_service.stop()
+    await redis.aclose()
+    app.container.crypto_service().close()
+    # the next startup of this app, e.g. the next TestClient, gets fresh services
+    app.container.reset_singletons()
+    await database.close()
 
 
 def create_app() -> FastAPI:
@@ -31,6 +71,8 @@ def create_app() -> FastAPI:
 
     app = FastAPI(title="Assessment API", lifespan=lifespan)
     app.container = container
+    app.state.metrics_registry = create_metrics_registry(app)
+    app.add_middleware(TimingMiddleware, server_timing=Config.SERVER_TIMING)
 
     app.include_router(transaction_route.router)
 
@@ -44,8 +86,27 @@ app = create_app()
 async def _():
     return {"detail": "API is up and running"}
 
+
+@app.get("/metrics")
+async def _(request: Request):
+    return Response(content=render_metrics(request.app.state.metrics_registry), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/metrics/write-behind")
+async def _(request: Request):
+    write_behind_queue = request.app.state.write_behind_queue
+    if write_behind_queue is None:
+        return {"enabled": False}
+    return {"enabled": True, **write_behind_queue.stats()}
+
+
+@app.get("/metrics/cache")
+async def _(request: Request):
+    return request.app.state.redis_service.stats()
+
 if __name__ == "__main__":
     if os.getenv('APP_ENV') == 'development':
         uvicorn.run("main:app", host="127.0.0.1", port=8000, log_level="debug", reload=True)
     else:
-        uvicorn.run("main:app", host="127.0.0.1", port=8000, log_level="debug")
+        # production mode: gunicorn managed uvicorn workers, see gunicorn.conf.py
+        os.execvp("gunicorn", ["gunicorn", "--config", "gunicorn.conf.py", "main:app"])
@@ -1,5 +1,7 @@
 from dependency_injector import containers, providers
 
+from src.config import Config
+from src.transaction.services.crypto_service import CryptoService
 from src.transaction.services.transaction_service import TransactionService
 from src.transaction.db.repository import TransactionRepository
 
@@ -7,11 +9,20 @@ from src.transaction.db.repository import TransactionRepository
 class Container(containers.DeclarativeContainer):
     config = providers.Configuration()
 
-    transaction_repository = providers.Factory(
+    # services and the repository hold no per-request state, so one instance serves every request
+    transaction_repository = providers.Singleton(
         TransactionRepository
     )
 
-    transaction_service = providers.Factory(
+    crypto_service = providers.Singleton(
+        CryptoService,
+        max_workers=Config.CRYPTO_MAX_WORKERS,
+        batch_size=Config.CRYPTO_BATCH_SIZE,
+        cache_size=Config.CRYPTO_CACHE_SIZE,
+    )
+
+    transaction_service = providers.Singleton(
         TransactionService,
-        transaction_repository=transaction_repository
+        transaction_repository=transaction_repository,
+        crypto_service=crypto_service,
     )
@@ -0,0 +1,92 @@
+import os
+
+from prometheus_client import REGISTRY, CollectorRegistry, generate_latest, multiprocess
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from src.transaction.services.circuit_breaker import CircuitBreaker
+
+
+class ServiceStatsCollector:
+    """
+    Exposes the counters the cache and the write-behind queue already keep,
+    read from `app.state` at scrape time, so the request paths pay nothing for them.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def collect(self):
+        redis_service = getattr(self.app.state, "redis_service", None)
+        if redis_service is not None:
+            yield from self._cache_metrics(redis_service.stats())
+
+        write_behind_queue = getattr(self.app.state, "write_behind_queue", None)
+        if write_behind_queue is not None:
+            yield from self._write_behind_metrics(write_behind_queue.stats())
+
+    @staticmethod
+    def _cache_metrics(stats: dict):
+        lookups = CounterMetricFamily("cache_lookups", "Cache lookups by tier and result", labels=["tier", "result"])
+        hit_ratio = GaugeMetricFamily("cache_hit_ratio", "Share of the lookups answered by each tier",
+                                      labels=["tier"])
+        for tier in ("l1", "l2"):
+            hits, misses = stats[tier]["hits"], stats[tier]["misses"]
+            lookups.add_metric([tier, "hit"], hits)
+            lookups.add_metric([tier, "miss"], misses)
+            hit_ratio.add_metric([tier], hits / (hits + misses) if hits + misses else 0.0)
+        yield lookups
+        yield hit_ratio
+
+        yield GaugeMetricFamily("cache_l1_entries", "Entries held in the in-process cache",
+                                value=stats["l1"]["entries"])
+        yield CounterMetricFamily("cache_l1_evictions", "Entries evicted from the in-process cache",
+                                  value=stats["l1"]["evictions"])
+        yield CounterMetricFamily("cache_stale_hits", "Lookups answered with a stale entry",
+                                  value=stats["stale_hits"])
+        yield CounterMetricFamily("cache_loads", "Entries computed by a loader", value=stats["loads"])
+        yield CounterMetricFamily("cache_load_failures", "Loader calls that failed", value=stats["load_failures"])
+        yield CounterMetricFamily("cache_bypassed", "Loads that skipped the cache as redis was unavailable",
+                                  value=stats["bypassed"])
+        yield CounterMetricFamily("cache_pool_exhausted", "Redis calls skipped as every pooled connection was busy",
+                                  value=stats["pool_exhausted"])
+        yield GaugeMetricFamily("cache_pending_invalidations", "Users whose invalidation has yet to reach redis",
+                                value=stats["pending_invalidations"])
+
+        breaker = stats["breaker"]
+        state = GaugeMetricFamily("cache_breaker_state", "State of the redis circuit breaker, 1 for the current one",
+                                  labels=["state"])
+        for name in CircuitBreaker.STATES:
+            state.add_metric([name], 1.0 if breaker["state"] == name else 0.0)
+        yield state
+        yield CounterMetricFamily("cache_breaker_opened", "Times the redis circuit breaker opened",
+                                  value=breaker["opened"])
+        yield CounterMetricFamily("cache_breaker_rejected", "Redis calls skipped while the circuit breaker was open",
+                                  value=breaker["rejected"])
+
+    @staticmethod
+    def _write_behind_metrics(stats: dict):
+        yield GaugeMetricFamily("write_behind_queue_depth", "Transactions waiting to be committed",
+                                value=stats["queue_depth"])
+        for name in ("enqueued", "rejected", "flushed", "failed", "retries", "flushes"):
+            yield CounterMetricFamily(f"write_behind_{name}", f"Write-behind {name} count", value=stats[name])
+        yield GaugeMetricFamily("write_behind_max_flush_seconds", "Slowest group commit so far",
+                                value=stats["max_flush_seconds"])
+
+
+def create_metrics_registry(app) -> CollectorRegistry:
+    registry = CollectorRegistry(auto_describe=False)
+    registry.register(ServiceStatsCollector(app))
+    return registry
+
+
+def render_metrics(app_registry: CollectorRegistry) -> bytes:
+    """
+    Prometheus text exposition of the process wide histograms followed by the app's service counters.
+    Under gunicorn the histograms are aggregated over all the workers, while the service counters
+    are those of the worker answering the scrape.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry) + generate_latest(app_registry)
+    return generate_latest(REGISTRY) + generate_latest(app_registry)
@@ -0,0 +1,44 @@
+import os
+import time
+from contextlib import contextmanager
+
+from loguru import logger
+from prometheus_client import Gauge
+from uvicorn.workers import UvicornWorker
+
+STARTUP_SECONDS = Gauge(
+    "app_startup_seconds", "Time spent in each startup phase of a worker",
+    ["phase"], multiprocess_mode="liveall",
+)
+
+
+class Worker(UvicornWorker):
+    """Gunicorn worker serving the app with the uvloop event loop and the httptools parser."""
+    CONFIG_KWARGS = {"loop": "uvloop", "http": "httptools"}
+
+
+class StartupTimer:
+    """
+    Times the phases of the lifespan startup of a worker, reported as a log line
+    and the `app_startup_seconds` gauge once the worker is ready to serve.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - started
+
+    def report(self):
+        self.phases["total"] = time.perf_counter() - self.started
+        for name, seconds in self.phases.items():
+            STARTUP_SECONDS.labels(name).set(seconds)
+        logger.info("worker {} ready in {:.0f}ms ({})", os.getpid(), self.phases["total"] * 1000,
+                    ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in self.phases.items()
+                              if name != "total"))
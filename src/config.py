@@ -1,6 +1,132 @@
 import os
 
+from dotenv import load_dotenv
+
+load_dotenv()
+
 
 class Config:
     # MONGO ENVIRONMENT VARIABLES
     MONGODB_URL = os.environ["MONGODB_URL"]
+
+    # BULK INGEST
+    BULK_INSERT_CHUNK_SIZE = int(os.getenv("BULK_INSERT_CHUNK_SIZE", "1000"))
+
+    # WRITE-BEHIND INGESTION
+    WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "false").lower() == "true"
+    WRITE_BEHIND_QUEUE_SIZE = int(os.getenv("WRITE_BEHIND_QUEUE_SIZE", "10000"))
+    WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "500"))
+    WRITE_BEHIND_FLUSH_INTERVAL_MS = int(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL_MS", "50"))
+    # what to do when the queue is full: "reject" answers 503, "sync" falls back to a direct write
+    WRITE_BEHIND_OVERFLOW = os.getenv("WRITE_BEHIND_OVERFLOW", "reject")
+    # a group commit failing on a transient error is retried after this long, doubled on every retry up to the max
+    WRITE_BEHIND_RETRY_BACKOFF_MS = int(os.getenv("WRITE_BEHIND_RETRY_BACKOFF_MS", "100"))
+    WRITE_BEHIND_RETRY_MAX_BACKOFF_MS = int(os.getenv("WRITE_BEHIND_RETRY_MAX_BACKOFF_MS", "5000"))
+    # at shutdown, documents still not committed after this long are logged and counted as failed, keep it well
+    # under SERVER_GRACEFUL_TIMEOUT so the worker is not killed mid-drain
+    WRITE_BEHIND_DRAIN_TIMEOUT_MS = int(os.getenv("WRITE_BEHIND_DRAIN_TIMEOUT_MS", "20000"))
+
+    # EXPORT
+    EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+
+    # BATCH ANALYTICS
+    # most users one request to the batch analytics endpoint may ask for
+    ANALYTICS_BATCH_MAX_USERS = int(os.getenv("ANALYTICS_BATCH_MAX_USERS", "500"))
+
+    # CACHE
+    # Cache keys are versioned per user and every write bumps the version, so the TTL only bounds memory use
+    CACHE_EXPIRE_IN = int(os.getenv("CACHE_EXPIRE_IN", "21600"))
+    CACHE_L1_MAX_ENTRIES = int(os.getenv("CACHE_L1_MAX_ENTRIES", "10000"))
+    CACHE_L1_TTL = float(os.getenv("CACHE_L1_TTL", "10"))
+    CACHE_INVALIDATION_CHANNEL = os.getenv("CACHE_INVALIDATION_CHANNEL", "transactions:cache_invalidation")
+    # entries are served stale for this long after CACHE_EXPIRE_IN while one loader refreshes them
+    CACHE_STALE_TTL = int(os.getenv("CACHE_STALE_TTL", "3600"))
+    CACHE_LOCK_TTL_MS = int(os.getenv("CACHE_LOCK_TTL_MS", "5000"))
+    CACHE_LOCK_WAIT_MS = int(os.getenv("CACHE_LOCK_WAIT_MS", "2000"))
+    # cached response bodies larger than this many bytes are stored gzip-compressed, -1 disables compression
+    CACHE_COMPRESSION_THRESHOLD = int(os.getenv("CACHE_COMPRESSION_THRESHOLD", "1024"))
+    CACHE_COMPRESSION_LEVEL = int(os.getenv("CACHE_COMPRESSION_LEVEL", "6"))
+
+    # REDIS CLIENT
+    REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "100"))
+    # a cache call slower than this counts as a failure, the request carries on without the cache
+    REDIS_SOCKET_TIMEOUT_MS = int(os.getenv("REDIS_SOCKET_TIMEOUT_MS", "250"))
+    REDIS_CONNECT_TIMEOUT_MS = int(os.getenv("REDIS_CONNECT_TIMEOUT_MS", "500"))
+    # a cache call finding every connection busy waits this long for one, then carries on without the cache
+    REDIS_POOL_TIMEOUT_MS = int(os.getenv("REDIS_POOL_TIMEOUT_MS", "50"))
+    REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", "30"))
+    # after this many failed calls in a row redis is skipped for REDIS_BREAKER_COOLDOWN_SECONDS, then one call
+    # tries it again
+    REDIS_BREAKER_FAILURES = int(os.getenv("REDIS_BREAKER_FAILURES", "5"))
+    REDIS_BREAKER_COOLDOWN_SECONDS = float(os.getenv("REDIS_BREAKER_COOLDOWN_SECONDS", "30"))
+
+    # REDIS SHARDING
+    # comma separated redis urls the cache is sharded over by consistent hashing on the user id, instead of REDIS_URL
+    REDIS_NODES = os.getenv("REDIS_NODES", "")
+    # points of each node on the hash ring, more of them spread the keys more evenly
+    REDIS_VNODES = int(os.getenv("REDIS_VNODES", "160"))
+    # REDIS_URL is a server of a Redis Cluster, which shards the keys itself
+    REDIS_CLUSTER = os.getenv("REDIS_CLUSTER", "false").lower() == "true"
+
+    # CRYPTO
+    CRYPTO_MAX_WORKERS = int(os.getenv("CRYPTO_MAX_WORKERS", str(min(4, os.cpu_count() or 1))))
+    CRYPTO_BATCH_SIZE = int(os.getenv("CRYPTO_BATCH_SIZE", "256"))
+    CRYPTO_CACHE_SIZE = int(os.getenv("CRYPTO_CACHE_SIZE", "10000"))
+
+    # MONGO CLIENT
+    MONGO_DATABASE = os.getenv("MONGO_DATABASE", "fido-new")
+    MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+    MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "10"))
+    MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+    MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+    MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "10000"))
+    # comma separated wire compressors in order of preference, e.g. "zstd,snappy,zlib"
+    MONGO_COMPRESSORS = os.getenv("MONGO_COMPRESSORS", "")
+    # connections opened and checked before the app starts serving
+    MONGO_WARMUP_CONNECTIONS = int(os.getenv("MONGO_WARMUP_CONNECTIONS", "10"))
+
+    # READ ROUTING
+    # history and analytics reads go to secondaries ("secondaryPreferred") unless this is "false"
+    MONGO_SECONDARY_READS = os.getenv("MONGO_SECONDARY_READS", "true").lower() == "true"
+    # secondaries lagging further behind the primary are not read from, -1 disables the bound (90 minimum)
+    MONGO_MAX_STALENESS_SECONDS = int(os.getenv("MONGO_MAX_STALENESS_SECONDS", "90"))
+
+    # ROLLUPS
+    # transaction writes and their daily rollup updates commit together in a multi-document transaction on a replica
+    # set or sharded cluster; otherwise a failed rollup update is logged and counted until rebuild_rollups repairs it
+    ROLLUP_TRANSACTIONS = os.getenv("ROLLUP_TRANSACTIONS", "true").lower() == "true"
+
+    # STORAGE SCHEMA
+    # layout of the transaction documents written from now on, both are always read, see src/transaction/db/schema.py:
+    # 1 keeps the DTO field names and Decimal128 amounts, 2 uses short field names, integer minor unit amounts and
+    # enum transaction types
+    TRANSACTION_SCHEMA_VERSION = int(os.getenv("TRANSACTION_SCHEMA_VERSION", "1"))
+
+    # INDEXES
+    # startup check of the repository query plans: "off", "warn" logs queries needing a COLLSCAN or an
+    # in-memory SORT, "fail" also stops the app from starting
+    INDEX_PLAN_GUARD = os.getenv("INDEX_PLAN_GUARD", "warn").lower()
+
+    # MONITORING
+    # mongo commands slower than this are logged with the shape of their filter, -1 disables the log
+    MONGO_SLOW_QUERY_MS = float(os.getenv("MONGO_SLOW_QUERY_MS", "100"))
+    # also log the winning plan of each slow command, once per filter shape
+    MONGO_SLOW_QUERY_EXPLAIN = os.getenv("MONGO_SLOW_QUERY_EXPLAIN", "false").lower() == "true"
+    # Server-Timing response header with the stage durations of a request: "always", "off", or "request" to
+    # only send it when the request carries an X-Server-Timing header
+    SERVER_TIMING = os.getenv("SERVER_TIMING", "request").lower()
+
+    # SERVER
+    SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+    SERVER_PORT = int(os.getenv("SERVER_PORT", "8989"))
+    # worker processes, each with its own event loop, mongo pool and redis connections
+    WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1)))
+    # a worker is replaced after serving this many requests, plus up to the jitter so they don't all restart
+    # together, 0 disables the recycling
+    SERVER_MAX_REQUESTS = int(os.getenv("SERVER_MAX_REQUESTS", "10000"))
+    SERVER_MAX_REQUESTS_JITTER = int(os.getenv("SERVER_MAX_REQUESTS_JITTER", "1000"))
+    # seconds a worker gets to finish its in-flight requests when it is recycled or the server stops
+    SERVER_GRACEFUL_TIMEOUT = int(os.getenv("SERVER_GRACEFUL_TIMEOUT", "30"))
+    SERVER_TIMEOUT = int(os.getenv("SERVER_TIMEOUT", "60"))
+    SERVER_KEEPALIVE = int(os.getenv("SERVER_KEEPALIVE", "5"))
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "info")
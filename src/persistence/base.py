@@ -1,15 +1,113 @@
-import os
-import motor.motor_asyncio
-from dotenv import load_dotenv
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Optional, Tuple
+
+from bson import Timestamp
 from bson.codec_options import CodecOptions
+from loguru import logger
+from pymongo import AsyncMongoClient
+from pymongo.read_preferences import Primary, SecondaryPreferred
+
+from src.config import Config
 from .custom_type import type_registry
-# from config import Config
-load_dotenv()
+from .monitoring import command_monitor
 
 codec_options = CodecOptions(type_registry=type_registry)
 
-MONGODB_URL = os.getenv("MONGODB_URL")
+ANALYTICS_COLLECTION = "transaction_analytics"
+
+
+def client_options() -> dict:
+    """Options of the Mongo clients, shared by the app and the commands running outside of it."""
+    options = {
+        "maxPoolSize": Config.MONGO_MAX_POOL_SIZE,
+        "minPoolSize": Config.MONGO_MIN_POOL_SIZE,
+        "connectTimeoutMS": Config.MONGO_CONNECT_TIMEOUT_MS,
+        "serverSelectionTimeoutMS": Config.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        "socketTimeoutMS": Config.MONGO_SOCKET_TIMEOUT_MS,
+    }
+    if Config.MONGO_COMPRESSORS:
+        options["compressors"] = Config.MONGO_COMPRESSORS
+    return options
+
+
+class MongoDatabase:
+    """
+    Holds the application's `AsyncMongoClient` and collections.
+
+    The client is created by `connect()` and closed by `close()`, which the FastAPI
+    lifespan calls, so every worker process opens its own pool after it starts.
+
+    `transactions`, `rollups` and `analytics` read from the primary. `transaction_reads`,
+    `rollup_reads` and `analytics_reads` are the same collections routed to secondaries
+    with bounded staleness, for reads that can be slightly behind the writes.
+    `analytics` holds the analytics materialized by `commands.materialize_analytics`.
+    `supports_transactions` tells whether the deployment runs multi-document
+    transactions, which a standalone server does not.
+    """
+
+    def __init__(self):
+        self.client = None
+        self.db = None
+        self.transactions = None
+        self.rollups = None
+        self.analytics = None
+        self.transaction_reads = None
+        self.rollup_reads = None
+        self.analytics_reads = None
+        self.supports_transactions = False
+
+    async def connect(self):
+        self.client = AsyncMongoClient(Config.MONGODB_URL, event_listeners=[command_monitor], **client_options())
+        self.db = self.client.get_database(Config.MONGO_DATABASE)
+        command_monitor.database = self.db
+        self.transactions = self.db.get_collection("transactions", codec_options=codec_options)
+        self.rollups = self.db.get_collection("transaction_daily_rollups", codec_options=codec_options)
+        self.analytics = self.db.get_collection(ANALYTICS_COLLECTION, codec_options=codec_options)
+
+        read_preference = Primary()
+        if Config.MONGO_SECONDARY_READS:
+            read_preference = SecondaryPreferred(max_staleness=Config.MONGO_MAX_STALENESS_SECONDS)
+        self.transaction_reads = self.transactions.with_options(read_preference=read_preference)
+        self.rollup_reads = self.rollups.with_options(read_preference=read_preference)
+        self.analytics_reads = self.analytics.with_options(read_preference=read_preference)
+
+        await self.warm_up()
+
+        hello = await self.client.admin.command("hello")
+        self.supports_transactions = "setName" in hello or hello.get("msg") == "isdbgrid"
+        if Config.ROLLUP_TRANSACTIONS and not self.supports_transactions:
+            logger.warning("mongo runs standalone, transaction writes and their rollup updates are not atomic")
+
+    async def warm_up(self):
+        """
+        Open and check connections up front, so the first requests do not pay
+        for server selection, TCP and TLS handshakes and authentication.
+        """
+        started = time.perf_counter()
+        await asyncio.gather(*(self.client.admin.command("ping")
+                               for _ in range(max(1, Config.MONGO_WARMUP_CONNECTIONS))))
+        logger.info(f"mongo connection pool warmed up in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    @asynccontextmanager
+    async def causal_session(self, after: Optional[Tuple[Timestamp, dict]] = None):
+        """
+        Start a causally consistent session, so reads run in it observe the writes run in it before,
+        whichever member serves them.
+        @param after: `(operation_time, cluster_time)` of an earlier session whose writes must be observed too
+        """
+        async with self.client.start_session(causal_consistency=True) as session:
+            if after is not None:
+                operation_time, cluster_time = after
+                session.advance_cluster_time(cluster_time)
+                session.advance_operation_time(operation_time)
+            yield session
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+
 
-client = motor.motor_asyncio.AsyncIOMotorClient(MONGODB_URL)
-db = client.get_database("fido-new")
-transaction_collection = db.get_collection("transactions", codec_options=codec_options)
+database = MongoDatabase()
@@ -0,0 +1,207 @@
+"""
+Latency monitoring of the commands the application sends to MongoDB.
+
+`CommandMonitor` is registered on the client as a PyMongo `CommandListener`.
+It records the duration of every command, labelled with the command name and
+the repository method that issued it, and logs the commands slower than
+`MONGO_SLOW_QUERY_MS` with the shape of their filter. Repository methods are
+wrapped with `monitored`, which times the whole method and tells the listener
+which method is running.
+"""
+import asyncio
+import functools
+import inspect
+import time
+from contextvars import ContextVar
+from typing import Any, Dict, Optional, Tuple
+
+from loguru import logger
+from prometheus_client import Histogram
+from pymongo import monitoring
+
+from src.config import Config
+from src.transaction.utils.timing import record_stage
+
+MONGO_COMMAND_SECONDS = Histogram(
+    "mongo_command_duration_seconds",
+    "Duration of the commands sent to MongoDB",
+    ["command", "collection", "operation"],
+)
+REPOSITORY_OPERATION_SECONDS = Histogram(
+    "repository_operation_duration_seconds",
+    "Duration of the repository methods, including every command they send",
+    ["operation"],
+)
+
+# repository method running in the current task, set by `monitored`
+current_operation: ContextVar[Optional[str]] = ContextVar("current_operation", default=None)
+
+# fields of a command that belong to its session or transport rather than to the query itself
+_SESSION_FIELDS = {"lsid", "txnNumber", "autocommit", "startTransaction", "readConcern", "writeConcern"}
+# where each command keeps the filter that decides which documents it touches
+_FILTER_PATHS = {
+    "find": ("filter",),
+    "count": ("query",),
+    "distinct": ("query",),
+    "findAndModify": ("query",),
+    "delete": ("deletes", 0, "q"),
+    "update": ("updates", 0, "q"),
+}
+_EXPLAINABLE_COMMANDS = {"find", "aggregate", "count", "distinct", "findAndModify", "delete", "update"}
+
+
+def query_shape(value: Any) -> Any:
+    """Replace the values of a filter with `?`, keeping its field names and operators."""
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        shapes = [query_shape(item) for item in value]
+        return shapes if any(isinstance(item, (dict, list)) for item in shapes) else "?"
+    return "?"
+
+
+def _command_filter(command_name: str, command: dict) -> Any:
+    if command_name == "aggregate":
+        pipeline = command.get("pipeline") or [{}]
+        return pipeline[0].get("$match")
+
+    value = command
+    for key in _FILTER_PATHS.get(command_name, ()):
+        try:
+            value = value[key]
+        except (KeyError, IndexError, TypeError):
+            return None
+    return value if value is not command else None
+
+
+def monitored(method):
+    """
+    Time a repository method, and label the commands it sends with its name.
+    The time of the outermost method also counts towards the request's `mongo` stage.
+    Works on coroutines and async generators.
+    """
+    name = method.__name__
+
+    if inspect.isasyncgenfunction(method):
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            elapsed = 0.0
+            generator = method(*args, **kwargs)
+            try:
+                while True:
+                    # only the steps of the generator are timed, not the consumer's work in between
+                    outermost = current_operation.get() is None
+                    token = current_operation.set(name)
+                    started = time.perf_counter()
+                    try:
+                        item = await generator.__anext__()
+                    except StopAsyncIteration:
+                        break
+                    finally:
+                        step = time.perf_counter() - started
+                        elapsed += step
+                        current_operation.reset(token)
+                        if outermost:
+                            record_stage("mongo", step)
+                    yield item
+            finally:
+                await generator.aclose()
+                REPOSITORY_OPERATION_SECONDS.labels(name).observe(elapsed)
+
+        return wrapper
+
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        outermost = current_operation.get() is None
+        token = current_operation.set(name)
+        started = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            REPOSITORY_OPERATION_SECONDS.labels(name).observe(elapsed)
+            current_operation.reset(token)
+            if outermost:
+                record_stage("mongo", elapsed)
+
+    return wrapper
+
+
+class CommandMonitor(monitoring.CommandListener):
+    """
+    Records the duration of every command and logs the slow ones.
+
+    The listener is called synchronously by the driver, in the task that sends
+    the command, so it only does bookkeeping. Explaining a slow command, when
+    `MONGO_SLOW_QUERY_EXPLAIN` is set, happens in a background task, once per
+    filter shape.
+    """
+
+    def __init__(self, slow_query_ms: float, explain_slow_queries: bool = False):
+        self.slow_query_ms = slow_query_ms
+        self.explain_slow_queries = explain_slow_queries
+        self.database = None
+        self._started: Dict[Tuple[Any, int], tuple] = {}
+        self._explained = set()
+        self._explains = set()
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        if event.command_name == "explain":
+            return
+        command = event.command
+        collection = command.get(event.command_name)
+        self._started[(event.connection_id, event.request_id)] = (
+            collection if isinstance(collection, str) else "",
+            current_operation.get() or "",
+            _command_filter(event.command_name, command),
+            command if self.explain_slow_queries and event.command_name in _EXPLAINABLE_COMMANDS else None,
+        )
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        self._finished(event)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        self._finished(event)
+
+    def _finished(self, event):
+        started = self._started.pop((event.connection_id, event.request_id), None)
+        if started is None:
+            return
+        collection, operation, command_filter, command = started
+
+        seconds = event.duration_micros / 1_000_000
+        MONGO_COMMAND_SECONDS.labels(event.command_name, collection, operation).observe(seconds)
+
+        if 0 <= self.slow_query_ms < seconds * 1000:
+            shape = query_shape(command_filter) if command_filter is not None else None
+            logger.warning(f"slow mongo command {event.command_name} on {collection} took {seconds * 1000:.1f} ms "
+                           f"(operation: {operation or '-'}, filter: {shape})")
+            if command is not None:
+                self._explain_in_background(event.command_name, collection, shape, command)
+
+    def _explain_in_background(self, command_name: str, collection: str, shape: Any, command: dict):
+        key = (command_name, collection, repr(shape))
+        if key in self._explained or self.database is None:
+            return
+        self._explained.add(key)
+
+        try:
+            task = asyncio.get_running_loop().create_task(self._explain(command_name, collection, command))
+        except RuntimeError:
+            return
+        self._explains.add(task)
+        task.add_done_callback(self._explains.discard)
+
+    async def _explain(self, command_name: str, collection: str, command: dict):
+        command = {key: value for key, value in command.items()
+                   if not key.startswith("$") and key not in _SESSION_FIELDS}
+        try:
+            explanation = await self.database.command({"explain": command, "verbosity": "queryPlanner"})
+        except Exception as e:
+            logger.warning(f"could not explain slow mongo command {command_name} on {collection}: {e}")
+            return
+        logger.warning(f"plan of slow mongo command {command_name} on {collection}: "
+                       f"{explanation.get('queryPlanner', {}).get('winningPlan')}")
+
+
+command_monitor = CommandMonitor(Config.MONGO_SLOW_QUERY_MS, Config.MONGO_SLOW_QUERY_EXPLAIN)
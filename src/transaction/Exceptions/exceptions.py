@@ -7,3 +7,18 @@ class NotFoundError(Exception):
 
 class TransactionRecordNotFoundError(NotFoundError):
     entity_name: str = "transactions"
+
+
+class InvalidCursorError(Exception):
+    def __init__(self, cursor):
+        super().__init__(f"invalid pagination cursor: {cursor}")
+
+
+class InvalidSessionTokenError(Exception):
+    def __init__(self, session_token):
+        super().__init__(f"invalid session token: {session_token}")
+
+
+class QueryPlanError(Exception):
+    def __init__(self, problems):
+        super().__init__(f"queries not served by an index: {problems}")
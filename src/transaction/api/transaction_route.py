@@ -1,52 +1,123 @@
+import gzip
 from datetime import datetime
-from typing import Optional
+from typing import List, Literal, Optional
 
 from dependency_injector.wiring import Provide, inject
-from fastapi import APIRouter, Depends, HTTPException, Request
-from loguru import logger
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
 
 from src.bootstrap.containers import Container
-from src.transaction.Exceptions.exceptions import TransactionRecordNotFoundError
-from src.transaction.dto.requests.transaction_create_req import TransactionCreateRequest, TransactionUpdateRequest
-from src.transaction.dto.responses.http_response import TransactionCreateResponse, PagedHttpResponseModel, \
-    SingleDataResponseModel
-from src.transaction.services.transaction_service import TransactionService
+from src.config import Config
+from src.transaction.Exceptions.exceptions import InvalidCursorError, InvalidSessionTokenError, \
+    TransactionRecordNotFoundError
+from src.transaction.dto.requests.transaction_create_req import TransactionAnalyticsBatchRequest, \
+    TransactionCreateRequest, TransactionLookupRequest, TransactionUpdateRequest
+from src.transaction.dto.responses.http_response import PagedHttpResponseModel, SingleDataResponseModel, \
+    TransactionListResponseModel, TransactionResponseModel, TRANSACTION_RESPONSE_FIELDS, dump_response, transaction_page_model
+from src.transaction.services.redis_service import CachedResponse
+from src.transaction.services.transaction_service import TransactionService, TRANSACTION_EXPORT_FIELDS
+from src.transaction.utils.ndjson import iter_ndjson_lines
+from src.transaction.utils.session_token import SESSION_TOKEN_HEADER
 
 router = APIRouter()
 
 
-@router.post("/api/v1/transactions", tags=["Transactions"], response_model=SingleDataResponseModel, status_code=201)
+@router.post("/api/v1/transactions", tags=["Transactions"], response_model=TransactionResponseModel, status_code=201)
 @inject
 async def create_transaction_request(
         payload: TransactionCreateRequest,
+        request: Request,
         transaction_service: TransactionService = Depends(Provide[Container.transaction_service])):
     """
     Endpoint to create a transaction record
+    Send `Prefer: respond-async` to have the record group-committed in the background (202)
+    The `X-Session-Token` response header lets later reads observe this write
     """
+    if "respond-async" in request.headers.get("prefer", "") and request.app.state.write_behind_queue is not None:
+        queued = await transaction_service.enqueue_transaction(payload, request)
+        if queued is not None:
+            return _json_response(TransactionResponseModel.model_construct(
+                is_successful=True, message="Transaction accepted for processing", data=queued), status_code=202)
+        if Config.WRITE_BEHIND_OVERFLOW != "sync":
+            raise HTTPException(status_code=503, detail="Transaction queue is full, please retry later")
+
     try:
-        response = await transaction_service.create_transaction(payload)
-        return SingleDataResponseModel(is_successful=True,
-                                       message="Transaction created successfully",
-                                       data=response.dict())
+        created = await transaction_service.create_transaction(payload, request)
+        response = _json_response(TransactionResponseModel.model_construct(
+            is_successful=True, message="Transaction created successfully", data=created), status_code=201)
+        _set_session_token(response, request)
+        return response
     except Exception as e:
         raise HTTPException(status_code=500, detail=e)
 
 
-@router.put("/api/v1/transactions/{transaction_id}", tags=["Transactions"], response_model=SingleDataResponseModel)
+@router.post("/api/v1/transactions:bulk", tags=["Transactions"], response_model=SingleDataResponseModel)
+@inject
+async def create_transactions_bulk_request(
+        request: Request,
+        transaction_service: TransactionService = Depends(Provide[Container.transaction_service])):
+    """
+    Endpoint to create transaction records in bulk
+    Accepts either a JSON array or a streamed NDJSON body (`Content-Type: application/x-ndjson`)
+    """
+    if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+        records = iter_ndjson_lines(request.stream())
+    else:
+        try:
+            body = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=422, detail="Request body must be a JSON array or NDJSON")
+        if not isinstance(body, list):
+            raise HTTPException(status_code=422, detail="Request body must be a JSON array or NDJSON")
+        records = _iterate(body)
+
+    results = await transaction_service.create_transactions(records, request)
+    failed = sum(1 for result in results if result["error"] is not None)
+
+    response = _json_response(SingleDataResponseModel.model_construct(
+        is_successful=failed == 0, message=f"{len(results) - failed} transactions created, {failed} failed",
+        data=results))
+    _set_session_token(response, request)
+    return response
+
+
+@router.post("/api/v1/transactions:lookup", tags=["Transactions"], response_model=TransactionListResponseModel)
+@inject
+async def lookup_transactions_by_name(
+        payload: TransactionLookupRequest,
+        transaction_service: TransactionService = Depends(Provide[Container.transaction_service])):
+    """
+    Endpoint to find transactions by the customer's full name, newest first
+    The name is matched regardless of case and spacing, and sent in the body to keep it out of URLs and access logs
+    """
+    transactions = await transaction_service.lookup_transactions_by_name(payload.full_name, payload.limit)
+    return _json_response(TransactionListResponseModel.model_construct(
+        is_successful=True, message="operation completed successfully", data=transactions))
+
+
+async def _iterate(items: list):
+    for item in items:
+        yield item
+
+
+@router.put("/api/v1/transactions/{transaction_id}", tags=["Transactions"], response_model=TransactionResponseModel)
 @inject
 async def update_transaction_details(
         transaction_id: str,
         payload: TransactionUpdateRequest,
+        request: Request,
         transaction_service: TransactionService = Depends(Provide[Container.transaction_service])):
     """
     Endpoint to edit a transaction
     """
 
     try:
-        response = await transaction_service.update_transaction(transaction_id, payload)
-        return SingleDataResponseModel(is_successful=True,
-                                       message="Transaction updated successfully",
-                                       data=response.dict())
+        updated = await transaction_service.update_transaction(transaction_id, payload, request)
+        response = _json_response(TransactionResponseModel.model_construct(
+            is_successful=True, message="Transaction updated successfully", data=updated))
+        _set_session_token(response, request)
+        return response
 
     except TransactionRecordNotFoundError:
         raise HTTPException(status_code=404, detail="Transaction not found")
@@ -59,12 +130,15 @@ async def update_transaction_details(
 @inject
 async def delete_finance_request(
         transaction_id: str,
+        request: Request,
         transaction_service: TransactionService = Depends(Provide[Container.transaction_service])):
     """
     Endpoint to delete transaction record
     """
     try:
-        response = await transaction_service.delete_transaction(transaction_id)
+        await transaction_service.delete_transaction(transaction_id, request)
+        response = Response(status_code=204)
+        _set_session_token(response, request)
         return response
     except TransactionRecordNotFoundError:
         raise HTTPException(status_code=404, detail="Transaction record not found")
@@ -77,26 +151,80 @@ async def get_transaction_history(
         request: Request,
         page: int = 1,
         page_size: int = 10,
+        pagination: Literal["legacy", "cursor"] = "legacy",
+        cursor: Optional[str] = None,
+        fields: Optional[str] = None,
+        session_token: Optional[str] = Header(None, alias=SESSION_TOKEN_HEADER),
         transaction_service: TransactionService = Depends(Provide[Container.transaction_service])):
     """
     Endpoint to retrieve transaction history for a user
+    @Query params = pagination: `legacy` returns the latest records, `cursor` pages through the whole history
+    @Query params = cursor: `next_cursor` of the previous page, implies `pagination=cursor`
+    @Query params = fields: comma separated list of fields to return, all by default
+    @Header X-Session-Token: token returned by a write, the response will reflect that write
     """
+    selected_fields = _parse_fields(fields, TRANSACTION_RESPONSE_FIELDS)
 
-    response = await transaction_service.fetch_transaction_history(user_id, request)
+    if pagination == "cursor" or cursor:
+        if not 1 <= page_size <= 1000:
+            raise HTTPException(status_code=422, detail="page_size must be between 1 and 1000")
+        try:
+            transactions, next_cursor = await transaction_service.fetch_transaction_history_page(
+                user_id, page_size, cursor, selected_fields)
+        except InvalidCursorError:
+            raise HTTPException(status_code=400, detail="Invalid pagination cursor")
 
-    return PagedHttpResponseModel(is_successful=True,
-                                  message="operation completed successfully",
-                                  page=page,
-                                  page_size=len(response),
-                                  data=response)
+        return _json_response(transaction_page_model(tuple(selected_fields)).model_construct(
+            is_successful=True,
+            message="operation completed successfully",
+            page=page,
+            page_size=page_size,
+            next_cursor=next_cursor,
+            data=transactions), by_alias=True)
+
+    try:
+        response = await transaction_service.fetch_transaction_history(user_id, request, page, selected_fields,
+                                                                       session_token)
+    except InvalidSessionTokenError:
+        raise HTTPException(status_code=400, detail="Invalid session token")
+    return _cached_response(response, request)
 
 
-@router.get("/api/v1/transactions/{user_id}/analytics", tags=["Transactions"])
+@router.get("/api/v1/transactions/{user_id}/export", tags=["Transactions"])
+@inject
+async def export_transaction_history(
+        user_id: str,
+        export_format: Literal["ndjson", "csv"] = Query("ndjson", alias="format"),
+        fields: Optional[str] = None,
+        start_date: Optional[datetime] = None,
+        end_date: Optional[datetime] = None,
+        transaction_service: TransactionService = Depends(Provide[Container.transaction_service])):
+    """
+    Endpoint to stream the full transaction history of a user
+    @Query params = format: `ndjson` or `csv`
+    @Query params = fields: comma separated list of fields to export, all by default
+    @Query params = start_date
+    @Query params = end_date
+    """
+    selected_fields = _parse_fields(fields, TRANSACTION_EXPORT_FIELDS)
+
+    media_type = "text/csv" if export_format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        transaction_service.export_transaction_history(user_id, export_format, selected_fields,
+                                                       start_date, end_date),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{user_id}_transactions.{export_format}"'},
+    )
+
+
+@router.get("/api/v1/transactions/{user_id}/analytics", tags=["Transactions"], response_model=SingleDataResponseModel)
 @inject
 async def get_transaction_analytics(user_id: str,
                                     request: Request,
                                     start_date:  Optional[datetime] = None,
                                     end_date: Optional[datetime] = None,
+                                    source: Literal["live", "materialized"] = "live",
+                                    session_token: Optional[str] = Header(None, alias=SESSION_TOKEN_HEADER),
                                     transaction_service: TransactionService = Depends(
                                         Provide[Container.transaction_service])
                                     ):
@@ -104,10 +232,100 @@ async def get_transaction_analytics(user_id: str,
     Endpoint to retrieve transaction analytics for a user
     @Query params = start_date
     @Query params = end_date
+    @Query params = source: `materialized` serves the analytics of the last nightly batch, see
+    `commands.materialize_analytics`, without date ranges
+    @Header X-Session-Token: token returned by a write, the response will reflect that write
+    """
+    if source == "materialized":
+        if start_date is not None or end_date is not None:
+            raise HTTPException(status_code=422, detail="Date ranges are only supported by live analytics")
+        response = await transaction_service.fetch_materialized_transaction_analytics(user_id)
+        return _cached_response(response, request)
+
+    try:
+        response = await transaction_service.fetch_transaction_analytics(user_id, request, start_date, end_date,
+                                                                         session_token)
+    except InvalidSessionTokenError:
+        raise HTTPException(status_code=400, detail="Invalid session token")
+    return _cached_response(response, request)
+
+
+@router.post("/api/v1/transactions/analytics:batch", tags=["Transactions"], response_model=SingleDataResponseModel)
+@inject
+async def get_transactions_analytics_batch(payload: TransactionAnalyticsBatchRequest,
+                                           request: Request,
+                                           transaction_service: TransactionService = Depends(
+                                               Provide[Container.transaction_service])
+                                           ):
+    """
+    Endpoint to retrieve the transaction analytics of many users at once
+    `data` maps every requested user id to its analytics, null for users with nothing to report
+    """
+    user_ids = list(dict.fromkeys(payload.user_ids))
+    response = await transaction_service.fetch_transactions_analytics(user_ids, request, payload.start_date,
+                                                                      payload.end_date)
+    return _cached_response(response, request)
+
+
+def _parse_fields(fields: Optional[str], allowed_fields: List[str]) -> List[str]:
+    """
+    Parse a comma separated `fields` query parameter, defaulting to every allowed field
+    """
+    if fields is None:
+        return allowed_fields
+
+    selected_fields = list(dict.fromkeys(field.strip() for field in fields.split(",") if field.strip()))
+    if not selected_fields or set(selected_fields) - set(allowed_fields):
+        raise HTTPException(status_code=422, detail=f"fields must be a subset of: {allowed_fields}")
+    return selected_fields
+
+
+def _set_session_token(response: Response, request: Request):
+    """
+    Hand the session token of the write made for this request back to the client, when the deployment has one
+    """
+    session_token = getattr(request.state, "session_token", None)
+    if session_token is not None:
+        response.headers[SESSION_TOKEN_HEADER] = session_token
+
+
+def _json_response(content: BaseModel, status_code: int = 200, by_alias: bool = False) -> Response:
+    """
+    Send a response envelope serialized straight to bytes, instead of having FastAPI validate and encode it again
+    """
+    return Response(content=dump_response(content, by_alias), status_code=status_code, media_type="application/json")
+
+
+def _accepts_gzip(accept_encoding: str) -> bool:
+    """
+    Whether an Accept-Encoding header allows gzip: with a q-value above 0 for gzip itself, or for `*` when gzip
+    is not listed
+    """
+    qualities = {}
+    for coding in accept_encoding.split(","):
+        name, *params = coding.split(";")
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[name.strip().lower()] = quality
+    return qualities.get("gzip", qualities.get("x-gzip", qualities.get("*", 0.0))) > 0
+
+
+def _cached_response(cached: CachedResponse, request: Request) -> Response:
+    """
+    Send a cached body as is, letting clients that accept gzip take compressed bodies without re-encoding
     """
-    response = await transaction_service.fetch_transaction_analytics(user_id, request)
-    logger.info(response)
-    return SingleDataResponseModel(is_successful=True,
-                                   message="Successfully retrieved stats",
-                                   data=response
-                                   )
+    if not cached.compressed:
+        return Response(content=cached.body, media_type="application/json")
+
+    if _accepts_gzip(request.headers.get("accept-encoding", "")):
+        return Response(content=cached.body, media_type="application/json",
+                        headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"})
+
+    return Response(content=gzip.decompress(cached.body), media_type="application/json",
+                    headers={"Vary": "Accept-Encoding"})
@@ -0,0 +1,70 @@
+"""
+Store the blind index of `full_name` on the records lacking one, in the background.
+
+    python -m src.transaction.commands.backfill_blind_index [--batch-size 500] [--after-id ID] [--all]
+
+Records written before blind indexes existed cannot be looked up by name until
+this has run over them. --all recomputes the index of every record, which is
+needed after BLIND_INDEX_KEY changes. Records are walked in `_id` order and each
+one is only updated if its ciphertext has not changed in the meantime. The last
+`_id` of every batch is logged so an interrupted run can resume with --after-id.
+"""
+import argparse
+import asyncio
+
+from bson import ObjectId
+from loguru import logger
+from pymongo import UpdateOne
+
+from src.persistence.base import database
+from src.transaction.db.schema import V2_FIELDS
+from src.transaction.utils.security import blind_index, decrypt_fields
+
+
+async def backfill_blind_index(batch_size: int, after_id: str = None, recompute: bool = False):
+    query = {} if recompute else {"full_name_bidx": {"$exists": False}}
+    if after_id:
+        query["_id"] = {"$gt": ObjectId(after_id)}
+    indexed = 0
+
+    while True:
+        batch = await database.transactions.find(query, {"full_name": 1, V2_FIELDS["full_name"]: 1}) \
+            .sort("_id", 1).limit(batch_size).to_list(length=batch_size)
+        if not batch:
+            break
+
+        # the name is stored under `full_name` or its v2 name, depending on the layout of the record
+        fields = ["full_name" if "full_name" in document else V2_FIELDS["full_name"] for document in batch]
+        names = decrypt_fields([document[field] for document, field in zip(batch, fields)])
+
+        operations = [UpdateOne({"_id": document["_id"], field: document[field]},
+                                {"$set": {"full_name_bidx": blind_index(name)}})
+                      for document, field, name in zip(batch, fields, names)]
+        result = await database.transactions.bulk_write(operations, ordered=False)
+        indexed += result.modified_count
+
+        query["_id"] = {"$gt": batch[-1]["_id"]}
+        logger.info(f"indexed {indexed} records so far, last _id {batch[-1]['_id']}")
+
+    logger.info(f"blind index backfill finished, {indexed} records indexed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Store the blind index of full_name on transaction records")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--after-id", help="resume after this transaction _id")
+    parser.add_argument("--all", action="store_true", help="recompute the index of every record, after a key change")
+    args = parser.parse_args()
+
+    async def run():
+        await database.connect()
+        try:
+            await backfill_blind_index(args.batch_size, args.after_id, args.all)
+        finally:
+            await database.close()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
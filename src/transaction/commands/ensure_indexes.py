@@ -0,0 +1,51 @@
+"""
+Create the indexes of the transaction collections, and optionally check the query plans.
+
+    python -m src.transaction.commands.ensure_indexes [--check]
+
+Run it before a deploy, so building a new index on a large collection does not
+hold up the app's startup. With `--check`, every repository query is explained
+and the command exits with status 1 if one of them needs a collection scan or
+an in-memory sort.
+"""
+import argparse
+import asyncio
+import sys
+
+from loguru import logger
+
+from src.persistence.base import database
+from src.transaction.db import indexes
+
+
+async def ensure_indexes(check: bool = False) -> bool:
+    await indexes.ensure_indexes()
+    if not check:
+        return True
+
+    problems = await indexes.explain_query_plans()
+    for name, stages in problems.items():
+        logger.error(f"query plan of {name} uses {', '.join(stages)}")
+    if not problems:
+        logger.info(f"all {len(indexes.QUERY_SHAPES)} repository queries are served by an index")
+    return not problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create the transaction indexes")
+    parser.add_argument("--check", action="store_true",
+                        help="explain the repository queries and fail if one is not served by an index")
+    args = parser.parse_args()
+
+    async def run():
+        await database.connect()
+        try:
+            return await ensure_indexes(args.check)
+        finally:
+            await database.close()
+
+    sys.exit(0 if asyncio.run(run()) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""
+Compute the analytics of every user from their transactions, into the `transaction_analytics` collection.
+
+    python -m src.transaction.commands.materialize_analytics [--partitions 16] [--processes N]
+        [--chunk-size 1000] [--run-id ID] [--restart]
+
+Meant to run nightly: `GET /api/v1/transactions/{user_id}/analytics?source=materialized`
+serves its results with a single read by `_id`. Users are split into partitions by
+ranges of a hash of their `user_id`, so heavy and light users spread evenly, and the
+partitions run in parallel in a pool of processes. Each one streams the transactions
+of a chunk of its users at a time, computes their metrics with NumPy and bulk-upserts
+them. Progress is checkpointed per partition in the `analytics_jobs` collection after
+every chunk: running again with the same --run-id (today's UTC date by default) and
+--partitions resumes every partition where it stopped, --restart starts them over.
+Once every partition is done, the analytics of users the run did not see, whose
+transactions were all deleted, are removed.
+"""
+import argparse
+import hashlib
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
+from typing import Dict, List
+
+import numpy as np
+from loguru import logger
+from pymongo import MongoClient, ReplaceOne
+
+from src.config import Config
+from src.persistence.base import ANALYTICS_COLLECTION, client_options, codec_options
+from src.transaction.db.schema import V2_AMOUNT_EXPONENT, V2_FIELDS, storage_projection
+
+CHECKPOINTS = "analytics_jobs"
+
+_PROJECTION = storage_projection({"_id": 0, "user_id": 1, "transaction_date": 1, "transaction_amount": 1})
+
+# database of the worker process, opened by `_open_database`
+_database = None
+
+
+def partition_of(user_id: str, partitions: int) -> int:
+    """Partition of a user: the 64 bit hash space of user ids is split into `partitions` equal ranges."""
+    digest = hashlib.blake2b(user_id.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") * partitions >> 64
+
+
+def summarize_transactions(user_count: int, users: np.ndarray, days: np.ndarray, amounts: np.ndarray) -> dict:
+    """
+    Compute the analytics of a chunk of users from their transactions, one array element per transaction.
+    Same metrics as `summarize_daily_rollups`, ties between days going to the earliest.
+    @param user_count: number of users in the chunk
+    @param users: index of the user of each transaction in the chunk
+    @param days: UTC day of each transaction, in days since the epoch
+    @param amounts:
+    @return: arrays holding the transaction count, total amount, busiest day and the count on that day of each
+    user, by user index. The busiest day of users without transactions is meaningless
+    """
+    transaction_counts = np.bincount(users, minlength=user_count)
+    total_amounts = np.bincount(users, weights=amounts, minlength=user_count)
+
+    # count per (user, day), packed in one integer so a single sort groups them
+    first_day = days.min() if days.size else 0
+    user_days, day_counts = np.unique((users.astype(np.int64) << 32) | (days - first_day), return_counts=True)
+    day_users = user_days >> 32
+    day_offsets = user_days & 0xFFFFFFFF
+
+    # per user, the day with the highest count, the earliest one on ties
+    order = np.lexsort((day_offsets, -day_counts, day_users))
+    _, first = np.unique(day_users[order], return_index=True)
+    busiest = order[first]
+
+    busiest_days = np.zeros(user_count, dtype=np.int64)
+    busiest_counts = np.zeros(user_count, dtype=np.int64)
+    busiest_days[day_users[busiest]] = day_offsets[busiest] + first_day
+    busiest_counts[day_users[busiest]] = day_counts[busiest]
+    return {
+        "transaction_count": transaction_counts,
+        "total_amount": total_amounts,
+        "busiest_day": busiest_days,
+        "busiest_day_count": busiest_counts,
+    }
+
+
+def _amount(document: dict) -> float:
+    # v1 documents hold a Decimal, v2 ones integer minor units, see `schema`
+    if V2_FIELDS["transaction_amount"] in document:
+        return document[V2_FIELDS["transaction_amount"]] / 10 ** document[V2_AMOUNT_EXPONENT]
+    return float(document["transaction_amount"])
+
+
+def _read_chunk(user_ids: List[str], batch_size: int):
+    index = {user_id: position for position, user_id in enumerate(user_ids)}
+    users, dates, amounts = [], [], []
+
+    cursor = _database.transactions.find({"user_id": {"$in": user_ids}}, _PROJECTION, batch_size=batch_size)
+    for document in cursor:
+        users.append(index[document["user_id"]])
+        dates.append(document["transaction_date"])
+        amounts.append(_amount(document))
+
+    days = np.array(dates, dtype="datetime64[ms]").astype("datetime64[D]").astype(np.int64)
+    return np.array(users, dtype=np.int64), days, np.array(amounts, dtype=np.float64)
+
+
+def _analytics_documents(user_ids: List[str], run_id: str, batch_size: int) -> List[ReplaceOne]:
+    metrics = summarize_transactions(len(user_ids), *_read_chunk(user_ids, batch_size))
+    busiest_days = np.datetime_as_string(metrics["busiest_day"].astype("datetime64[D]"))
+    computed_at = datetime.now(timezone.utc)
+
+    operations = []
+    for position, user_id in enumerate(user_ids):
+        transaction_count = int(metrics["transaction_count"][position])
+        if transaction_count == 0:
+            # deleted since the users were listed, left to the cleanup of the run
+            continue
+        operations.append(ReplaceOne({"_id": user_id}, {
+            "average_transaction_value": float(metrics["total_amount"][position]) / transaction_count,
+            "day_with_most_transactions": str(busiest_days[position]),
+            "transaction_count_on_that_day": int(metrics["busiest_day_count"][position]),
+            "transaction_count": transaction_count,
+            "computed_at": computed_at,
+            "run_id": run_id,
+        }, upsert=True))
+    return operations
+
+
+def _open_database():
+    global _database
+    _database = MongoClient(Config.MONGODB_URL, **client_options()) \
+        .get_database(Config.MONGO_DATABASE, codec_options=codec_options)
+
+
+def run_partition(run_id: str, partition: int, partitions: int, user_ids: List[str], chunk_size: int,
+                  restart: bool = False) -> int:
+    """
+    Materialize the analytics of the users of one partition, resuming after its checkpoint.
+    Runs in a worker process.
+    @param user_ids: users of the partition, sorted
+    @return: number of users materialized by the partition over the run
+    """
+    checkpoint_id = {"run_id": run_id, "partitions": partitions, "partition": partition}
+    checkpoints = _database.get_collection(CHECKPOINTS)
+    checkpoint = None if restart else checkpoints.find_one({"_id": checkpoint_id})
+    if checkpoint and checkpoint["done"]:
+        return checkpoint["users"]
+
+    materialized = checkpoint["users"] if checkpoint else 0
+    if checkpoint and checkpoint.get("last_user_id") is not None:
+        user_ids = [user_id for user_id in user_ids if user_id > checkpoint["last_user_id"]]
+        logger.info(f"partition {partition} resuming after user {checkpoint['last_user_id']}")
+
+    analytics = _database.get_collection(ANALYTICS_COLLECTION)
+    for start in range(0, len(user_ids), chunk_size):
+        chunk = user_ids[start:start + chunk_size]
+        operations = _analytics_documents(chunk, run_id, Config.EXPORT_BATCH_SIZE)
+        if operations:
+            analytics.bulk_write(operations, ordered=False)
+        materialized += len(operations)
+        checkpoints.update_one({"_id": checkpoint_id}, {"$set": {
+            "last_user_id": chunk[-1],
+            "users": materialized,
+            "done": False,
+            "updated_at": datetime.now(timezone.utc),
+        }}, upsert=True)
+
+    checkpoints.update_one({"_id": checkpoint_id}, {"$set": {
+        "users": materialized,
+        "done": True,
+        "updated_at": datetime.now(timezone.utc),
+    }}, upsert=True)
+    logger.info(f"partition {partition} done, {materialized} users materialized")
+    return materialized
+
+
+def list_partitions(partitions: int) -> Dict[int, List[str]]:
+    """Every user with transactions, by partition, sorted. Read from the user_id index without fetching documents."""
+    cursor = _database.transactions.aggregate([
+        {"$sort": {"user_id": 1}},
+        {"$group": {"_id": "$user_id"}},
+    ], allowDiskUse=True)
+
+    users = {partition: [] for partition in range(partitions)}
+    for row in cursor:
+        users[partition_of(row["_id"], partitions)].append(row["_id"])
+    for user_ids in users.values():
+        user_ids.sort()
+    return users
+
+
+def materialize_analytics(run_id: str, partitions: int, processes: int, chunk_size: int, restart: bool = False):
+    _open_database()
+    users = list_partitions(partitions)
+    logger.info(f"run {run_id}: {sum(map(len, users.values()))} users in {partitions} partitions, "
+                f"{processes} processes")
+
+    # worker processes start fresh, rather than forking the parent's client
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(processes, mp_context=context, initializer=_open_database) as pool:
+        futures = {pool.submit(run_partition, run_id, partition, partitions, user_ids, chunk_size, restart): partition
+                   for partition, user_ids in users.items()}
+        materialized = 0
+        for future in as_completed(futures):
+            materialized += future.result()
+
+    removed = _database.get_collection(ANALYTICS_COLLECTION).delete_many({"run_id": {"$ne": run_id}})
+    logger.info(f"run {run_id} finished, {materialized} users materialized, "
+                f"{removed.deleted_count} users without transactions removed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Materialize the transaction analytics of every user")
+    parser.add_argument("--partitions", type=int, default=16, help="hash ranges users are split into")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="partitions computed in parallel")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="users read and written at a time")
+    parser.add_argument("--run-id", default=datetime.now(timezone.utc).strftime("%Y-%m-%d"),
+                        help="runs with the same id resume each other")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoints of a previous run")
+    args = parser.parse_args()
+
+    materialize_analytics(args.run_id, args.partitions, args.processes, args.chunk_size, args.restart)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Rewrite the stored transactions in another layout, see `src/transaction/db/schema.py`, in the background.
+
+    python -m src.transaction.commands.migrate_storage_schema [--to 2] [--batch-size 500] [--restart]
+
+The migration runs online: the API reads both layouts, so set TRANSACTION_SCHEMA_VERSION
+to the target first, so new writes use it, then run this command. Records are walked
+in `_id` order and each one is only rewritten if it has not changed since it was read.
+Progress is checkpointed in the `schema_migrations` collection after every batch, so an
+interrupted run resumes where it stopped; --restart walks the collection from the start.
+"""
+import argparse
+import asyncio
+from datetime import datetime, timezone
+
+from loguru import logger
+from pymongo import ReplaceOne
+
+from src.persistence.base import database
+from src.transaction.db.schema import VERSION_FIELD, from_storage, to_storage
+
+CHECKPOINTS = "schema_migrations"
+
+
+def _old_layout_query(version: int) -> dict:
+    return {VERSION_FIELD: {"$exists": False}} if version == 2 else {VERSION_FIELD: {"$exists": True}}
+
+
+async def migrate_storage_schema(version: int, batch_size: int, restart: bool = False):
+    checkpoints = database.db.get_collection(CHECKPOINTS)
+    checkpoint_id = f"transactions_v{version}"
+    checkpoint = None if restart else await checkpoints.find_one({"_id": checkpoint_id})
+    migrated = checkpoint["migrated"] if checkpoint else 0
+    skipped = checkpoint["skipped"] if checkpoint else 0
+
+    query = _old_layout_query(version)
+    if checkpoint and checkpoint.get("last_id") is not None:
+        query["_id"] = {"$gt": checkpoint["last_id"]}
+        logger.info(f"resuming after _id {checkpoint['last_id']}, {migrated} records migrated so far")
+
+    while True:
+        batch = await database.transactions.find(query).sort("_id", 1).limit(batch_size).to_list(length=batch_size)
+        if not batch:
+            break
+
+        operations = []
+        for document in batch:
+            try:
+                replacement = to_storage(from_storage(document), version)
+            except (KeyError, ValueError, ArithmeticError) as e:
+                logger.warning(f"cannot migrate transaction {document['_id']}: {e!r}")
+                skipped += 1
+                continue
+            if version == 2 and VERSION_FIELD not in replacement:
+                logger.warning(f"cannot migrate transaction {document['_id']}: amount does not fit in v2")
+                skipped += 1
+                continue
+            # matching on every field leaves records changed since they were read to their writer
+            operations.append(ReplaceOne(document, replacement))
+        if operations:
+            result = await database.transactions.bulk_write(operations, ordered=False)
+            migrated += result.modified_count
+
+        query["_id"] = {"$gt": batch[-1]["_id"]}
+        await checkpoints.update_one({"_id": checkpoint_id}, {"$set": {
+            "last_id": batch[-1]["_id"],
+            "migrated": migrated,
+            "skipped": skipped,
+            "updated_at": datetime.now(timezone.utc),
+        }}, upsert=True)
+        logger.info(f"migrated {migrated} records to v{version} so far, last _id {batch[-1]['_id']}")
+
+    remaining = await database.transactions.count_documents(_old_layout_query(version))
+    logger.info(f"migration to v{version} finished, {migrated} records migrated, {skipped} skipped, "
+                f"{remaining} still in the other layout")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rewrite the stored transactions in another layout")
+    parser.add_argument("--to", type=int, choices=[1, 2], default=2, help="layout to migrate to")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint of a previous run")
+    args = parser.parse_args()
+
+    async def run():
+        await database.connect()
+        try:
+            await migrate_storage_schema(args.to, args.batch_size, args.restart)
+        finally:
+            await database.close()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Rebuild the daily transaction rollups from the transactions collection.
+
+    python -m src.transaction.commands.rebuild_rollups [--user-id USER_ID]
+
+Use it to backfill the rollups for data written before they existed, or to
+repair them. The rollups of the selected users are recomputed server side with
+one aggregation and written back with `$merge`. Writes landing for those users
+while the command runs may be counted twice or not at all, so run it for a
+user (or the whole collection) while that data is quiet.
+"""
+import argparse
+import asyncio
+
+from loguru import logger
+
+from src.persistence.base import database
+from src.transaction.db.repository import TransactionRepository
+
+
+# the amount of a v1 document, or the integer minor units of a v2 one as an exact decimal, see `schema`
+_AMOUNT = {"$ifNull": ["$transaction_amount", {"$divide": [{"$toDecimal": "$a"}, {"$pow": [10, "$e"]}]}]}
+
+
+async def rebuild_rollups(user_id: str = None):
+    match = {"user_id": user_id} if user_id else {}
+
+    await TransactionRepository().ensure_indexes()
+    deleted = await database.rollups.delete_many(match)
+    logger.info(f"removed {deleted.deleted_count} rollup rows")
+
+    pipeline = [
+        {"$match": match},
+        {"$group": {
+            "_id": {
+                "user_id": "$user_id",
+                "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$transaction_date"}},
+                "currency": {"$ifNull": ["$transaction_currency", "$c"]},
+            },
+            "transaction_count": {"$sum": 1},
+            "transaction_amount": {"$sum": _AMOUNT},
+        }},
+        {"$project": {
+            "_id": 0,
+            "user_id": "$_id.user_id",
+            "day": "$_id.day",
+            "currency": "$_id.currency",
+            "transaction_count": 1,
+            "transaction_amount": 1,
+        }},
+        {"$merge": {
+            "into": database.rollups.name,
+            "on": ["user_id", "day", "currency"],
+            "whenMatched": "replace",
+            "whenNotMatched": "insert",
+        }},
+    ]
+    cursor = await database.transactions.aggregate(pipeline)
+    await cursor.to_list(length=None)
+
+    rebuilt = await database.rollups.count_documents(match)
+    logger.info(f"rebuilt {rebuilt} rollup rows")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the daily transaction rollups")
+    parser.add_argument("--user-id", help="only rebuild the rollups of this user")
+    args = parser.parse_args()
+
+    async def run():
+        await database.connect()
+        try:
+            await rebuild_rollups(args.user_id)
+        finally:
+            await database.close()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
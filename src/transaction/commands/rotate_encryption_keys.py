@@ -0,0 +1,70 @@
+"""
+Re-encrypt `full_name` with the primary Fernet key, in the background.
+
+    python -m src.transaction.commands.rotate_encryption_keys [--batch-size 500] [--after-id ID]
+
+Rotation does not need downtime: put the new key first in FERNET_KEYS and keep
+the old ones after it, so the API keeps reading records under any of them.
+Then run this command to move existing records to the new key, and drop the
+old keys once it has finished. Records are walked in `_id` order and each one
+is only rewritten if its ciphertext has not changed in the meantime. The last
+`_id` of every batch is logged so an interrupted run can resume with --after-id.
+"""
+import argparse
+import asyncio
+
+from bson import ObjectId
+from loguru import logger
+from pymongo import UpdateOne
+
+from src.persistence.base import database
+from src.transaction.db.schema import V2_FIELDS
+from src.transaction.utils.security import rotate_field
+
+
+async def rotate_encryption_keys(batch_size: int, after_id: str = None):
+    query = {"_id": {"$gt": ObjectId(after_id)}} if after_id else {}
+    rotated = 0
+
+    while True:
+        batch = await database.transactions.find(query, {"full_name": 1, V2_FIELDS["full_name"]: 1}) \
+            .sort("_id", 1).limit(batch_size).to_list(length=batch_size)
+        if not batch:
+            break
+
+        operations = []
+        for document in batch:
+            # the name is stored under `full_name` or its v2 name, depending on the layout of the record
+            field = "full_name" if "full_name" in document else V2_FIELDS["full_name"]
+            rotated_name = rotate_field(document[field])
+            if rotated_name is not None:
+                operations.append(UpdateOne({"_id": document["_id"], field: document[field]},
+                                            {"$set": {field: rotated_name}}))
+        if operations:
+            result = await database.transactions.bulk_write(operations, ordered=False)
+            rotated += result.modified_count
+
+        query = {"_id": {"$gt": batch[-1]["_id"]}}
+        logger.info(f"rotated {rotated} records so far, last _id {batch[-1]['_id']}")
+
+    logger.info(f"key rotation finished, {rotated} records re-encrypted")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-encrypt transaction records with the primary Fernet key")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--after-id", help="resume after this transaction _id")
+    args = parser.parse_args()
+
+    async def run():
+        await database.connect()
+        try:
+            await rotate_encryption_keys(args.batch_size, args.after_id)
+        finally:
+            await database.close()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Index definitions of the transaction collections, and a guard that checks the
+repository queries are actually served by them.
+
+Every query `TransactionRepository` runs on a request path has a matching
+`QueryShape` below. When a query or an index changes, change its shape too, so
+the guard keeps explaining what really runs.
+"""
+from datetime import datetime, timezone
+from typing import Dict, List, NamedTuple, Optional
+
+from bson import ObjectId
+from loguru import logger
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+from src.persistence.base import database
+from src.transaction.Exceptions.exceptions import QueryPlanError
+
+INDEXES: Dict[str, List[IndexModel]] = {
+    "transactions": [
+        # history, keyset pages and exports: equality on user_id, then sorted by date and _id
+        IndexModel([("user_id", ASCENDING), ("transaction_date", DESCENDING), ("_id", DESCENDING)],
+                   name="user_id_transaction_date_id"),
+        # lookups by the blind index of full_name, records written before it existed are left out until backfilled
+        IndexModel([("full_name_bidx", ASCENDING), ("transaction_date", DESCENDING), ("_id", DESCENDING)],
+                   name="full_name_bidx_transaction_date_id",
+                   partialFilterExpression={"full_name_bidx": {"$exists": True}}),
+    ],
+    "rollups": [
+        # one row per user, day and currency, range scans on day for analytics
+        IndexModel([("user_id", ASCENDING), ("day", ASCENDING), ("currency", ASCENDING)],
+                   name="user_id_day_currency", unique=True),
+    ],
+}
+
+# stages that read the whole collection, or hold every result in memory before returning the first one
+REJECTED_STAGES = {"COLLSCAN", "SORT"}
+
+_SAMPLE_USER_ID = "query-plan-guard"
+_SAMPLE_DATE = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+class QueryShape(NamedTuple):
+    name: str
+    collection: str
+    filter: dict
+    sort: Optional[dict] = None
+    projection: Optional[dict] = None
+
+
+QUERY_SHAPES: List[QueryShape] = [
+    QueryShape("fetch_user_transaction_history", "transactions",
+               {"user_id": _SAMPLE_USER_ID},
+               sort={"transaction_date": -1}),
+    QueryShape("fetch_user_transaction_history_page", "transactions",
+               {"user_id": _SAMPLE_USER_ID,
+                "transaction_date": {"$lte": _SAMPLE_DATE},
+                "$or": [{"transaction_date": {"$lt": _SAMPLE_DATE}},
+                        {"transaction_date": _SAMPLE_DATE, "_id": {"$lt": ObjectId()}}]},
+               sort={"transaction_date": -1, "_id": -1}),
+    QueryShape("iter_user_transactions", "transactions",
+               {"user_id": _SAMPLE_USER_ID, "transaction_date": {"$gte": _SAMPLE_DATE, "$lte": _SAMPLE_DATE}},
+               sort={"transaction_date": -1, "_id": -1}),
+    QueryShape("fetch_transactions_by_name", "transactions",
+               {"full_name_bidx": bytes(16)},
+               sort={"transaction_date": -1, "_id": -1}),
+    QueryShape("fetch_user_transaction_analytics", "rollups",
+               {"user_id": _SAMPLE_USER_ID, "day": {"$gte": "2024-01-01", "$lte": "2024-12-31"}},
+               projection={"_id": 0, "day": 1, "transaction_count": 1, "transaction_amount": 1}),
+    QueryShape("fetch_materialized_transaction_analytics", "analytics", {"_id": _SAMPLE_USER_ID}),
+    # the $match of its aggregation
+    QueryShape("fetch_users_transaction_analytics", "rollups",
+               {"user_id": {"$in": [_SAMPLE_USER_ID, f"{_SAMPLE_USER_ID}-2"]},
+                "day": {"$gte": "2024-01-01", "$lte": "2024-12-31"}},
+               projection={"_id": 0, "user_id": 1, "day": 1, "transaction_count": 1, "transaction_amount": 1}),
+]
+
+
+async def ensure_indexes():
+    """
+    Create every index in `INDEXES`. Indexes that already exist with the same
+    definition are left alone, so this is safe to run on every startup.
+    """
+    for collection, indexes in INDEXES.items():
+        names = await getattr(database, collection).create_indexes(indexes)
+        logger.info(f"indexes ensured on {collection}: {', '.join(names)}")
+
+
+def _plan_stages(plan: dict):
+    yield plan.get("stage")
+    if "inputStage" in plan:
+        yield from _plan_stages(plan["inputStage"])
+    for input_stage in plan.get("inputStages", []):
+        yield from _plan_stages(input_stage)
+
+
+async def explain_query_plans() -> Dict[str, List[str]]:
+    """
+    Explain every query in `QUERY_SHAPES` without running it.
+    @return: the rejected stages of each query's winning plan, keyed by query name
+    """
+    problems = {}
+    for shape in QUERY_SHAPES:
+        find = {"find": getattr(database, shape.collection).name, "filter": shape.filter}
+        if shape.sort:
+            find["sort"] = shape.sort
+        if shape.projection:
+            find["projection"] = shape.projection
+
+        explanation = await database.db.command({"explain": find, "verbosity": "queryPlanner"})
+        winning_plan = explanation["queryPlanner"]["winningPlan"]
+        # the slot based engine nests the classic plan tree under `queryPlan`
+        winning_plan = winning_plan.get("queryPlan", winning_plan)
+
+        rejected = sorted(REJECTED_STAGES.intersection(_plan_stages(winning_plan)))
+        if rejected:
+            problems[shape.name] = rejected
+    return problems
+
+
+async def guard_query_plans(mode: str):
+    """
+    Check the repository queries are served by an index, in order, before the app starts serving.
+    @param mode: "off" skips the check, "warn" logs every offending query, "fail" also raises `QueryPlanError`
+    """
+    if mode == "off":
+        return
+
+    problems = await explain_query_plans()
+    for name, stages in problems.items():
+        logger.warning(f"query plan of {name} uses {', '.join(stages)}, it will slow down as data grows")
+
+    if problems and mode == "fail":
+        raise QueryPlanError(problems)
@@ -1,123 +1,428 @@
-from bson import ObjectId
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from bson import ObjectId, Timestamp
 from loguru import logger
+from prometheus_client import Counter
+from pymongo import DESCENDING, UpdateOne
 from pymongo.asynchronous.collection import ReturnDocument
+from pymongo.errors import BulkWriteError
+
+from src.config import Config
+from src.persistence.base import database
+from src.persistence.monitoring import monitored
+from src.transaction.db import indexes
+from src.transaction.db.schema import from_storage, storage_projection, to_storage, to_update
+from src.transaction.utils.analytics import summarize_daily_rollups, transaction_day
+
+# code of a duplicate key write error
+DUPLICATE_KEY = 11000
+
+ROLLUP_UPDATE_FAILURES = Counter(
+    "rollup_update_failures",
+    "Transaction writes whose daily rollup update failed outside a transaction, leaving the rollups wrong",
+)
+
 
-from src.persistence.base import transaction_collection
+class _RejectedDocuments(Exception):
+    """`insert_many` rejected documents of a batch written in a transaction, which it aborted."""
+
+    def __init__(self, write_errors: Dict[int, str], written: List[int]):
+        super().__init__(f"{len(write_errors) + len(written)} documents rejected")
+        self.write_errors = write_errors
+        self.written = written
 
 
 class TransactionRepository:
     """
         Repository to deal with data access to transactions table
+
+        Documents are written in the `TRANSACTION_SCHEMA_VERSION` layout and read in
+        either, see `schema`; what goes in and comes out is always v1 shaped.
     """
 
-    async def create_transaction(self, transaction_data: dict) -> dict:
+    async def ensure_indexes(self):
+        """
+        Create the indexes the repository queries rely on, see `indexes.INDEXES`. Safe to call on every startup.
+        """
+        await indexes.ensure_indexes()
+
+    async def check_query_plans(self, mode: str):
+        """
+        Explain the repository queries and report those not served by an index, see `indexes.guard_query_plans`.
+        """
+        await indexes.guard_query_plans(mode)
+
+    def causal_session(self, after: Optional[Tuple[Timestamp, dict]] = None):
+        """
+        Causally consistent session to run related writes and reads in, see `MongoDatabase.causal_session`.
+        """
+        return database.causal_session(after)
+
+    @monitored
+    async def apply_rollup_deltas(self, changes: Iterable[Tuple[dict, int]], session=None):
+        """
+        Fold transaction changes into the daily rollups with atomic `$inc` upserts.
+
+        Changes hitting the same `(user_id, day, currency)` row are merged first,
+        so a whole batch costs a single `bulk_write`.
+
+        @param changes: `(transaction document, +1 or -1)` pairs
+        @param session: session to write in, if any
+        """
+        deltas = defaultdict(lambda: [0, Decimal(0)])
+        for transaction, sign in changes:
+            key = (transaction["user_id"], transaction_day(transaction["transaction_date"]),
+                   transaction["transaction_currency"])
+            deltas[key][0] += sign
+            deltas[key][1] += sign * Decimal(transaction["transaction_amount"])
+
+        operations = [
+            UpdateOne({"user_id": user_id, "day": day, "currency": currency},
+                      {"$inc": {"transaction_count": count, "transaction_amount": amount}},
+                      upsert=True)
+            for (user_id, day, currency), (count, amount) in deltas.items()
+            if count or amount
+        ]
+        if operations:
+            await database.rollups.bulk_write(operations, ordered=False, session=session)
+
+    async def _write_with_rollups(self, write: Callable[[Any], Awaitable[Tuple[Any, List[Tuple[dict, int]]]]],
+                                  session=None):
+        """
+        Run `write`, which changes transactions and returns its result along with the
+        `(transaction, +1 or -1)` changes it makes to the daily rollups, then apply those.
+
+        With ROLLUP_TRANSACTIONS, on a replica set or sharded cluster, both commit together
+        in a multi-document transaction on `session`, which the driver retries on transient
+        errors, so the rollups never drift from the transactions. Otherwise they are separate
+        writes: a rollup update failing after its transaction write leaves the rollups wrong
+        until `rebuild_rollups` runs, so it is logged and counted in `rollup_update_failures`.
+        @param write: called with the session to write in
+        @param session: session to write in, one is started if None
+        @return: what `write` returned
+        """
+        transactional = self._transactional()
+
+        async def write_both(session):
+            result, changes = await write(session)
+            try:
+                await self.apply_rollup_deltas(changes, session=session)
+            except Exception as e:
+                if not transactional:
+                    ROLLUP_UPDATE_FAILURES.inc()
+                    logger.error(f"daily rollup update failed after a transaction write, the rollups are wrong "
+                                 f"until rebuild_rollups runs: {e!r}")
+                raise
+            return result
+
+        if not transactional:
+            return await write_both(session)
+        if session is None:
+            async with database.causal_session() as session:
+                return await session.with_transaction(write_both)
+        return await session.with_transaction(write_both)
+
+    @staticmethod
+    def _transactional() -> bool:
+        return Config.ROLLUP_TRANSACTIONS and database.supports_transactions
+
+    @monitored
+    async def create_transaction(self, transaction_data: dict, session=None) -> dict:
         """
                Saves invoice payload
 
                @param transaction_data: params transaction data
                @return: dict
         """
-        transaction = await transaction_collection.insert_one(transaction_data)
-        new_transaction = await transaction_collection.find_one({"_id": transaction.inserted_id})
-        return new_transaction
+        document = to_storage(transaction_data, Config.TRANSACTION_SCHEMA_VERSION)
 
-    async def update_transaction(self, transaction_id: str, transaction_data: dict):
+        async def insert(session):
+            transaction = await database.transactions.insert_one(document, session=session)
+            new_transaction = await database.transactions.find_one({"_id": transaction.inserted_id}, session=session)
+            return from_storage(new_transaction), [(transaction_data, 1)]
+
+        return await self._write_with_rollups(insert, session)
+
+    @monitored
+    async def create_transactions(self, transactions_data: List[dict], session=None,
+                                  retried: bool = False) -> Dict[int, str]:
+        """
+        Saves a batch of transactions with a single unordered `insert_many`.
+
+        Documents are expected to carry their own `_id`, so the inserted records
+        are never read back. A write error aborts a transaction, so in one, see
+        `_write_with_rollups`, the batch is committed again without the rejected documents.
+
+        @param transactions_data: list of transaction documents
+        @param session: session to write in, if any
+        @param retried: whether an earlier attempt at the batch failed. A duplicate `_id`
+        is then a document that attempt wrote, not an error. Outside a transaction the
+        attempt may have failed before updating the rollups, so they are updated now.
+        @return: write errors keyed by the position of the failed document
+        """
+        write_errors = {}
+        positions = list(range(len(transactions_data)))
+
+        async def insert(session):
+            documents = [to_storage(transactions_data[position], Config.TRANSACTION_SCHEMA_VERSION)
+                         for position in positions]
+            try:
+                await database.transactions.insert_many(documents, ordered=False, session=session)
+            except BulkWriteError as e:
+                errors, written = rejected(e)
+                if self._transactional():
+                    raise _RejectedDocuments(errors, written) from e
+                write_errors.update(errors)
+            return None, [(transactions_data[position], 1) for position in positions if position not in write_errors]
+
+        def rejected(error: BulkWriteError) -> Tuple[Dict[int, str], List[int]]:
+            # `_id` is the only unique key of the collection
+            errors, written = {}, []
+            for write_error in error.details.get("writeErrors", []):
+                position = positions[write_error["index"]]
+                if retried and write_error.get("code") == DUPLICATE_KEY:
+                    written.append(position)
+                else:
+                    errors[position] = write_error["errmsg"]
+            return errors, written
+
+        while positions:
+            try:
+                await self._write_with_rollups(insert, session)
+                break
+            except _RejectedDocuments as e:
+                write_errors.update(e.write_errors)
+                # the documents written before were committed along with their rollups
+                positions = [position for position in positions
+                             if position not in write_errors and position not in e.written]
+        return write_errors
+
+    @monitored
+    async def update_transaction(self, transaction_id: str, transaction_data: dict, session=None):
         """
         Update individual fields of an existing transaction record.
 
         Only the provided fields will be updated.
         Any missing or `null` fields will be ignored.
+        The daily rollups move from the old values to the new ones.
         """
-        update_transaction = await transaction_collection.find_one_and_update(
-            {"_id": ObjectId(transaction_id)},
-            {"$set": transaction_data},
-            return_document=ReturnDocument.AFTER,
-        )
-        return update_transaction
+        async def update(session):
+            previous_transaction = from_storage(await database.transactions.find_one_and_update(
+                {"_id": ObjectId(transaction_id)},
+                to_update(transaction_data, Config.TRANSACTION_SCHEMA_VERSION),
+                return_document=ReturnDocument.BEFORE,
+                session=session,
+            ))
+            if previous_transaction is None:
+                return None, []
+
+            update_transaction = {**previous_transaction, **transaction_data}
+            return update_transaction, [(previous_transaction, -1), (update_transaction, 1)]
+
+        return await self._write_with_rollups(update, session)
 
-    async def delete_transaction(self, transaction_id: str):
+    @monitored
+    async def delete_transaction(self, transaction_id: str, session=None):
         """
         Remove a single transaction record from the database.
+        @return: the deleted record, or None if it did not exist
         """
-        delete_result = await transaction_collection.delete_one({"_id": ObjectId(transaction_id)})
+        async def delete(session):
+            deleted_transaction = from_storage(await database.transactions.find_one_and_delete(
+                {"_id": ObjectId(transaction_id)}, session=session))
+            return deleted_transaction, [(deleted_transaction, -1)] if deleted_transaction is not None else []
 
-        return delete_result
+        return await self._write_with_rollups(delete, session)
 
-    async def fetch_user_transaction_history(self, user_id: str):
+    @monitored
+    async def fetch_user_transaction_history(self, user_id: str, projection: Optional[dict] = None, session=None):
         """
         Get the transaction history for a specific user, by `user_id`.
+
+        Read from a secondary when one is close enough to the primary.
         :param user_id:
+        :param projection: fields to return, all by default
+        :param session: causally consistent session whose writes must be observed, if any
         :return:
         """
         transactions = []
-        cursor = transaction_collection.find({"user_id": user_id}).sort({"transaction_date": -1})
+        cursor = database.transaction_reads.find({"user_id": user_id}, storage_projection(projection),
+                                                 session=session) \
+            .sort({"transaction_date": -1})
 
         for document in await cursor.to_list(length=100):
-            transactions.append(document)
+            transactions.append(from_storage(document))
 
         return transactions
 
-    async def fetch_user_transaction_analytics(self, user_id: str):
+    @monitored
+    async def fetch_user_transaction_history_page(self, user_id: str, page_size: int,
+                                                  after: Optional[Tuple[datetime, ObjectId]] = None,
+                                                  projection: Optional[dict] = None) -> List[dict]:
+        """
+        Get one page of the transaction history for a specific user, newest first.
+
+        Pages are addressed by the `(transaction_date, _id)` of the last record of
+        the previous page, so every page is a bounded walk of the
+        `user_id_transaction_date_id` index no matter how deep it is.
+        One extra record is returned to tell whether another page follows.
+        :param user_id:
+        :param page_size:
+        :param after: `(transaction_date, _id)` of the last record already seen
+        :param projection: fields to return, `transaction_date` and `_id` are always included
+        :return:
+        """
+        if projection is not None:
+            projection = {**projection, "transaction_date": 1, "_id": 1}
+
+        query = {"user_id": user_id}
+        if after is not None:
+            transaction_date, transaction_id = after
+            query["transaction_date"] = {"$lte": transaction_date}
+            query["$or"] = [
+                {"transaction_date": {"$lt": transaction_date}},
+                {"transaction_date": transaction_date, "_id": {"$lt": transaction_id}},
+            ]
+
+        cursor = database.transactions.find(query, storage_projection(projection)) \
+            .sort([("transaction_date", DESCENDING), ("_id", DESCENDING)]) \
+            .limit(page_size + 1)
+
+        return [from_storage(document) for document in await cursor.to_list(length=page_size + 1)]
+
+    @monitored
+    async def fetch_transactions_by_name(self, full_name_bidx: bytes, projection: Optional[dict] = None,
+                                         limit: int = 100) -> List[dict]:
+        """
+        Get the transactions whose `full_name` has the blind index `full_name_bidx`, newest first.
+
+        An equality match on the `full_name_bidx_transaction_date_id` index, so no
+        record is decrypted to find them. Records written before blind indexes
+        existed are only found once backfilled, see `commands.backfill_blind_index`.
+        :param full_name_bidx: `security.blind_index` of the name
+        :param projection: fields to return
+        :param limit:
+        :return:
+        """
+        cursor = database.transactions.find({"full_name_bidx": full_name_bidx}, storage_projection(projection)) \
+            .sort([("transaction_date", DESCENDING), ("_id", DESCENDING)]) \
+            .limit(limit)
+
+        return [from_storage(document) for document in await cursor.to_list(length=limit)]
+
+    @monitored
+    async def iter_user_transactions(self, user_id: str, start_date: Optional[datetime] = None,
+                                     end_date: Optional[datetime] = None, projection: Optional[dict] = None,
+                                     batch_size: int = 1000) -> AsyncIterator[List[dict]]:
+        """
+        Stream every transaction of a user, newest first, in batches of `batch_size`.
+
+        The cursor fetches one server-side batch at a time, so memory use does
+        not depend on the size of the history.
+        :param user_id:
+        :param start_date: only include transactions on or after this date
+        :param end_date: only include transactions on or before this date
+        :param projection: fields to return
+        :param batch_size:
+        :return:
+        """
+        query = {"user_id": user_id}
+        if start_date is not None or end_date is not None:
+            query["transaction_date"] = {}
+            if start_date is not None:
+                query["transaction_date"]["$gte"] = start_date
+            if end_date is not None:
+                query["transaction_date"]["$lte"] = end_date
+
+        cursor = database.transactions.find(query, storage_projection(projection)) \
+            .sort([("transaction_date", DESCENDING), ("_id", DESCENDING)]) \
+            .batch_size(batch_size)
+
+        batch = []
+        async for document in cursor:
+            batch.append(from_storage(document))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
+
+    @monitored
+    async def fetch_user_transaction_analytics(self, user_id: str, start_date: Optional[datetime] = None,
+                                               end_date: Optional[datetime] = None, session=None):
         """
         Assuming a single currency to allow for simplicity
 
-        Get the transaction history for a specific user, by `user_id`.
+        Get the transaction analytics for a specific user, by `user_id`, from the
+        daily rollups, so the cost grows with the number of active days rather
+        than the number of transactions. Read from a secondary when one is close
+        enough to the primary.
         :param user_id:
+        :param start_date: only include days on or after this date
+        :param end_date: only include days on or before this date
+        :param session: causally consistent session whose writes must be observed, if any
         :return:
         """
+        query = _rollup_query(user_id, start_date, end_date)
+        projection = {"_id": 0, "day": 1, "transaction_count": 1, "transaction_amount": 1}
+        cursor = database.rollup_reads.find(query, projection, session=session)
+        return summarize_daily_rollups(await cursor.to_list(length=None))
+
+    @monitored
+    async def fetch_materialized_transaction_analytics(self, user_id: str) -> Optional[dict]:
+        """
+        Get the transaction analytics of a user as last computed by `commands.materialize_analytics`.
+        :param user_id:
+        :return: the analytics and when they were computed, None if the user had no transactions then
+        """
+        projection = {"_id": 0, "average_transaction_value": 1, "day_with_most_transactions": 1,
+                      "transaction_count_on_that_day": 1, "computed_at": 1}
+        return await database.analytics_reads.find_one({"_id": user_id}, projection)
+
+    @monitored
+    async def fetch_users_transaction_analytics(self, user_ids: List[str], start_date: Optional[datetime] = None,
+                                                end_date: Optional[datetime] = None,
+                                                session=None) -> Dict[str, Optional[dict]]:
+        """
+        Get the transaction analytics of many users at once, see `fetch_user_transaction_analytics`.
+
+        One aggregation over the daily rollups of all of them: their rows are
+        summed per user and day, then gathered per user, so a single round trip
+        answers the whole batch.
+        :param user_ids:
+        :param start_date: only include days on or after this date
+        :param end_date: only include days on or before this date
+        :param session: causally consistent session whose writes must be observed, if any
+        :return: the analytics of every user, None for those with nothing to report
+        """
         pipeline = [
-            # Match transactions for the given user_id
-            {"$match": {"user_id": user_id}},
-
-            # Group by day (use transaction_date for day grouping and sum the transaction amounts)
-            {"$group": {
-                "_id": {
-                    "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$transaction_date"}}
-                },
-                "total_transactions_per_day": {"$sum": 1},
-                "total_amount_per_day": {"$sum": "$transaction_amount"}
-            }},
-
-            # Calculate the average transaction value for each day
-            {"$group": {
-                "_id": None,  # Remove grouping by day for the overall average
-                "total_amount": {"$sum": "$total_amount_per_day"},  # Sum all transaction amounts
-                "total_transactions": {"$sum": "$total_transactions_per_day"},  # Count all transactions
-                "days_with_transactions": {"$push": {
-                    "day": "$_id.day",
-                    "transaction_count": "$total_transactions_per_day"
-                }}
-            }},
-
-            {"$project": {
-                "_id": 0,
-                "average_transaction_value": {
-                    "$cond": {
-                        "if": {"$eq": ["$total_transactions", 0]},  # Prevent division by zero
-                        "then": 0,
-                        "else": {"$divide": ["$total_amount", "$total_transactions"]}  # Calculate the average
-                    }
-                },
-                "days_with_transactions": 1  # Pass the days array for sorting in the next step
-            }},
-
-            # Sort by transaction count and get the day with the highest transaction count
-            {"$unwind": "$days_with_transactions"},
-            {"$sort": {"days_with_transactions.transaction_count": -1}},
-            {"$limit": 1},
-
-            # Format the final output
-            {"$project": {
-                "_id": 0,
-                "average_transaction_value": 1,
-                "day_with_most_transactions": "$days_with_transactions.day",
-                "transaction_count_on_that_day": "$days_with_transactions.transaction_count"
-            }}
+            {"$match": _rollup_query({"$in": user_ids}, start_date, end_date)},
+            {"$group": {"_id": {"user_id": "$user_id", "day": "$day"},
+                        "transaction_count": {"$sum": "$transaction_count"},
+                        "transaction_amount": {"$sum": "$transaction_amount"}}},
+            {"$group": {"_id": "$_id.user_id",
+                        "days": {"$push": {"day": "$_id.day",
+                                           "transaction_count": "$transaction_count",
+                                           "transaction_amount": "$transaction_amount"}}}},
         ]
-        result = transaction_collection.aggregate(pipeline)
+        cursor = await database.rollup_reads.aggregate(pipeline, session=session)
+
+        analytics = dict.fromkeys(user_ids)
+        async for row in cursor:
+            analytics[row["_id"]] = summarize_daily_rollups(row["days"])
+        return analytics
 
-        result = await result.to_list()
 
-        if result:
-            return result[0]
-        return None
+def _rollup_query(user_id, start_date: Optional[datetime] = None, end_date: Optional[datetime] = None) -> dict:
+    query = {"user_id": user_id}
+    if start_date is not None or end_date is not None:
+        query["day"] = {}
+        if start_date is not None:
+            query["day"]["$gte"] = transaction_day(start_date)
+        if end_date is not None:
+            query["day"]["$lte"] = transaction_day(end_date)
+    return query
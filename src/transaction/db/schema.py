@@ -0,0 +1,159 @@
+"""
+Storage layouts of the transaction documents, and the mapping between them.
+
+v1 stores the DTO fields as they are, with Decimal128 amounts. v2 is compact:
+
+    _id, user_id, transaction_date   unchanged, they are the keys of every query and index
+    n   full_name (ciphertext)
+    a   transaction_amount, int64 in minor units of the currency
+    e   decimal exponent of `a`: the currency's, or more for amounts with more decimals
+    t   transaction_type, see `TRANSACTION_TYPES`
+    c   transaction_currency
+    v   2
+
+`TRANSACTION_SCHEMA_VERSION` selects the layout new writes use, except for amounts
+too large or precise for an int64 of minor units, which are kept in v1. Both are always
+read, so the repository only ever hands v1 shaped dicts to the rest of the app,
+and the collection can be migrated online, see `commands.migrate_storage_schema`.
+"""
+from decimal import Decimal
+from typing import Optional
+
+VERSION_FIELD = "v"
+
+V2_FIELDS = {
+    "full_name": "n",
+    "transaction_amount": "a",
+    "transaction_type": "t",
+    "transaction_currency": "c",
+}
+V2_AMOUNT_EXPONENT = "e"
+
+TRANSACTION_TYPES = {"debit": 1, "credit": 2}
+TRANSACTION_TYPE_NAMES = {code: name for name, code in TRANSACTION_TYPES.items()}
+
+# ISO 4217 minor units of the currencies not using two decimals
+CURRENCY_EXPONENTS = {
+    "BIF": 0, "CLP": 0, "DJF": 0, "GNF": 0, "ISK": 0, "JPY": 0, "KMF": 0, "KRW": 0, "PYG": 0, "RWF": 0,
+    "UGX": 0, "UYI": 0, "VND": 0, "VUV": 0, "XAF": 0, "XOF": 0, "XPF": 0,
+    "BHD": 3, "IQD": 3, "JOD": 3, "KWD": 3, "LYD": 3, "OMR": 3, "TND": 3,
+    "CLF": 4, "UYW": 4,
+}
+DEFAULT_CURRENCY_EXPONENT = 2
+
+# range of the BSON int64 holding `a`
+MIN_UNITS, MAX_UNITS = -2 ** 63, 2 ** 63 - 1
+
+
+def currency_exponent(currency: str) -> int:
+    return CURRENCY_EXPONENTS.get(currency.upper(), DEFAULT_CURRENCY_EXPONENT)
+
+
+def to_minor_units(amount, currency: str):
+    """
+    Exact integer form of `amount`.
+    @return: `(units, exponent)` such that `amount == units * 10 ** -exponent`
+    @raise OverflowError: when `units` does not fit in an int64
+    """
+    amount = Decimal(amount)
+    exponent = max(currency_exponent(currency), -amount.normalize().as_tuple().exponent)
+    units = int(amount.scaleb(exponent))
+    if not MIN_UNITS <= units <= MAX_UNITS:
+        raise OverflowError(f"{amount} {currency} does not fit in an int64 of minor units")
+    return units, exponent
+
+
+def from_minor_units(units: int, exponent: int) -> Decimal:
+    return Decimal(units).scaleb(-exponent)
+
+
+def to_storage(transaction: dict, version: int) -> dict:
+    """
+    Document to store for a v1 shaped `transaction` in the `version` layout. Fields it lacks are left out.
+    Transactions whose amount does not fit the v2 layout are stored in v1.
+    """
+    if version == 1:
+        return transaction
+    if "transaction_amount" in transaction:
+        try:
+            to_minor_units(transaction["transaction_amount"], transaction.get("transaction_currency", ""))
+        except OverflowError:
+            return transaction
+
+    document = {}
+    for name, value in transaction.items():
+        short_name = V2_FIELDS.get(name)
+        if short_name is None:
+            document[name] = value
+        elif name == "transaction_amount":
+            document["a"], document[V2_AMOUNT_EXPONENT] = to_minor_units(
+                value, transaction.get("transaction_currency", ""))
+        elif name == "transaction_type":
+            document["t"] = TRANSACTION_TYPES[value]
+        else:
+            document[short_name] = value
+    document[VERSION_FIELD] = 2
+    return document
+
+
+def from_storage(document: Optional[dict]) -> Optional[dict]:
+    """
+    v1 shaped dict of a stored document of any layout, holding the fields it was read with.
+    """
+    if document is None or VERSION_FIELD not in document:
+        return document
+
+    transaction = {}
+    for name, value in document.items():
+        if name == VERSION_FIELD or name == V2_AMOUNT_EXPONENT:
+            continue
+        if name == "n":
+            transaction["full_name"] = value
+        elif name == "a":
+            transaction["transaction_amount"] = from_minor_units(value, document[V2_AMOUNT_EXPONENT])
+        elif name == "t":
+            transaction["transaction_type"] = TRANSACTION_TYPE_NAMES[value]
+        elif name == "c":
+            transaction["transaction_currency"] = value
+        else:
+            transaction[name] = value
+    return transaction
+
+
+def to_update(transaction: dict, version: int) -> dict:
+    """
+    Update setting the given fields of a stored document in the `version` layout, whatever its current one.
+    Fields set in one layout are removed from the other, so a document never mixes both as long as
+    `transaction` holds every field of `V2_FIELDS`, as `TransactionUpdateRequest` does.
+    """
+    document = to_storage(transaction, version)
+    if VERSION_FIELD not in document:
+        unset = {V2_FIELDS[name]: "" for name in transaction if name in V2_FIELDS}
+        if "transaction_amount" in transaction:
+            unset[V2_AMOUNT_EXPONENT] = ""
+        if unset:
+            unset[VERSION_FIELD] = ""
+    else:
+        unset = {name: "" for name in transaction if name in V2_FIELDS}
+
+    update = {"$set": document}
+    if unset:
+        update["$unset"] = unset
+    return update
+
+
+def storage_projection(projection: Optional[dict]) -> Optional[dict]:
+    """
+    Projection of v1 field names extended with their v2 names, so it selects the same fields in either layout.
+    """
+    if projection is None or not any(value for name, value in projection.items() if name != "_id"):
+        return projection
+
+    projection = dict(projection)
+    for name, short_name in V2_FIELDS.items():
+        if projection.get(name):
+            projection[short_name] = 1
+    if projection.get("transaction_amount"):
+        projection[V2_AMOUNT_EXPONENT] = 1
+    projection[VERSION_FIELD] = 1
+    return projection
@@ -1,8 +1,12 @@
 from datetime import datetime
+from typing import List, Optional
+
+from pydantic.json_schema import SkipJsonSchema
 from pydantic import BaseConfig, BaseModel, condecimal, constr, validator, ConfigDict, field_validator, root_validator, \
-    model_validator
+    model_validator, ValidationInfo, Field
 
-from src.transaction.utils.security import encrypt_field
+from src.config import Config
+from src.transaction.utils.security import blind_index, encrypt_field
 
 
 class TransactionTypeConstants:
@@ -15,21 +19,20 @@ def convert_datetime_to_realworld(dt: datetime) -> str:
 
 
 class RWModel(BaseModel):
-    class Config:
-        ConfigDict(
-            populate_by_name=True,
-            json_encoders={datetime: convert_datetime_to_realworld},
-            arbitrary_types_allowed=True,
-            json_schema_extra={
-                "example": {
-                    "user_id": "e7tyewrkjtty",
-                    "full_name": "Jane Doe",
-                    "transaction_amount": 475.66,
-                    "transaction_type": "credit",
-                    "transaction_date": "2024-10-05T09:40:53.695Z",
-                    "transaction_currency": "USD"
-                }
-            })
+    model_config = ConfigDict(
+        populate_by_name=True,
+        json_encoders={datetime: convert_datetime_to_realworld},
+        arbitrary_types_allowed=True,
+        json_schema_extra={
+            "example": {
+                "user_id": "e7tyewrkjtty",
+                "full_name": "Jane Doe",
+                "transaction_amount": 475.66,
+                "transaction_type": "credit",
+                "transaction_date": "2024-10-05T09:40:53.695Z",
+                "transaction_currency": "USD"
+            }
+        })
 
 
 class TransactionCreateRequest(RWModel):
@@ -39,6 +42,8 @@ class TransactionCreateRequest(RWModel):
     transaction_type: constr(strip_whitespace=True)
     transaction_date: datetime
     transaction_currency: str
+    # computed from full_name, never taken from the client
+    full_name_bidx: SkipJsonSchema[Optional[bytes]] = None
 
     @field_validator('transaction_type')
     def validate_transaction_type(cls, transaction_type: str):
@@ -51,7 +56,16 @@ class TransactionCreateRequest(RWModel):
         return transaction_type
 
     @model_validator(mode='before')
-    def encrypt_sensitive_data(cls, values):
+    def encrypt_sensitive_data(cls, values, info: ValidationInfo):
+        # Blind index of full_name, for lookups by name
+        if "full_name" in values:
+            values["full_name_bidx"] = blind_index(values["full_name"]) \
+                if isinstance(values["full_name"], str) else None
+
+        # Bulk ingest validates with `defer_encryption` and encrypts the whole chunk at once
+        if info.context and info.context.get("defer_encryption"):
+            return values
+
         # Encrypt user_id and full_name
         if "full_name" in values:
             values["full_name"] = encrypt_field(values["full_name"])
@@ -64,6 +78,8 @@ class TransactionUpdateRequest(RWModel):
     transaction_type: constr(strip_whitespace=True)
     transaction_date: datetime
     transaction_currency: str
+    # computed from full_name, never taken from the client
+    full_name_bidx: SkipJsonSchema[Optional[bytes]] = None
 
     @field_validator('transaction_type')
     def validate_transaction_type(cls, transaction_type: str):
@@ -77,7 +93,20 @@ class TransactionUpdateRequest(RWModel):
 
     @model_validator(mode='before')
     def encrypt_sensitive_data(cls, values):
-        # Encrypt user_id and full_name
+        # Encrypt user_id and full_name, next to the blind index of full_name
         if "full_name" in values:
+            values["full_name_bidx"] = blind_index(values["full_name"]) \
+                if isinstance(values["full_name"], str) else None
             values["full_name"] = encrypt_field(values["full_name"])
         return values
+
+
+class TransactionLookupRequest(BaseModel):
+    full_name: constr(strip_whitespace=True, min_length=1)
+    limit: int = Field(100, ge=1, le=1000)
+
+
+class TransactionAnalyticsBatchRequest(BaseModel):
+    user_ids: List[str] = Field(min_length=1, max_length=Config.ANALYTICS_BATCH_MAX_USERS)
+    start_date: Optional[datetime] = None
+    end_date: Optional[datetime] = None
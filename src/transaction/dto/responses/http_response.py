@@ -1,9 +1,11 @@
 from __future__ import annotations
 
 from datetime import datetime
-from typing import List, Any, Optional, Annotated
+from functools import lru_cache
+from typing import List, Optional, Annotated, Tuple, Type, Generic, TypeVar
 
-from pydantic import BaseModel, BeforeValidator, Field, ConfigDict, model_validator
+from pydantic import BaseModel, BeforeValidator, Field, ConfigDict, model_validator, ValidationInfo, TypeAdapter, \
+    create_model
 
 from src.transaction.dto.requests.transaction_create_req import convert_datetime_to_realworld, RWModel
 from src.transaction.utils.security import decrypt_field
@@ -14,15 +16,19 @@ class HttpResponseModel(BaseModel):
     message: str
 
 
-class SingleDataResponseModel(HttpResponseModel):
-    data: Optional[Any]
+DataT = TypeVar("DataT")
 
 
-class PagedHttpResponseModel(HttpResponseModel):
+class SingleDataResponseModel(HttpResponseModel, Generic[DataT]):
+    data: Optional[DataT]
+
+
+class PagedHttpResponseModel(HttpResponseModel, Generic[DataT]):
     page: int = 1
     page_size: int
     # total: int
-    data: Optional[Any]
+    next_cursor: Optional[str] = None
+    data: Optional[DataT]
 
 
 PyObjectId = Annotated[str, BeforeValidator(str)]
@@ -41,9 +47,63 @@ class TransactionCreateResponse(RWModel):
     )
 
     @model_validator(mode='before')
-    def decrypt_sensitive_data(cls, values):
+    def decrypt_sensitive_data(cls, values, info: ValidationInfo):
+        # Result sets are decrypted in batches by the CryptoService before validation
+        if info.context and info.context.get("decrypted"):
+            return values
+
         # Decrypt full_name
         if "full_name" in values:
             values["full_name"] = decrypt_field(values["full_name"])
 
         return values
+
+
+TRANSACTION_RESPONSE_FIELDS = ["_id", "user_id", "full_name", "transaction_amount", "transaction_type",
+                               "transaction_currency"]
+
+
+@lru_cache(maxsize=64)
+def transaction_response_model(fields: Tuple[str, ...]) -> Type[BaseModel]:
+    """
+    Response model holding only `fields` of `TransactionCreateResponse`.
+    Unlike `TransactionCreateResponse`, it expects `full_name` to be decrypted already.
+    """
+    if set(fields) >= set(TRANSACTION_RESPONSE_FIELDS):
+        return TransactionCreateResponse
+
+    definitions = {
+        name: (field.annotation, field)
+        for name, field in TransactionCreateResponse.model_fields.items()
+        if (field.alias or name) in fields
+    }
+    return create_model(f"TransactionResponse[{','.join(fields)}]",
+                        __config__=ConfigDict(populate_by_name=True),
+                        **definitions)
+
+
+@lru_cache(maxsize=64)
+def transaction_list_adapter(fields: Tuple[str, ...]) -> TypeAdapter:
+    return TypeAdapter(List[transaction_response_model(fields)])
+
+
+TransactionResponseModel = SingleDataResponseModel[TransactionCreateResponse]
+TransactionListResponseModel = SingleDataResponseModel[List[TransactionCreateResponse]]
+
+
+@lru_cache(maxsize=64)
+def transaction_page_model(fields: Tuple[str, ...]) -> Type[PagedHttpResponseModel]:
+    return PagedHttpResponseModel[List[transaction_response_model(fields)]]
+
+
+@lru_cache(maxsize=128)
+def response_adapter(response_model: Type[BaseModel]) -> TypeAdapter:
+    return TypeAdapter(response_model)
+
+
+def dump_response(response: BaseModel, by_alias: bool = False) -> bytes:
+    """
+    Serialize a response envelope straight to JSON bytes.
+    Envelopes are built with `model_construct` around already validated data, so nothing is validated twice.
+    """
+    return response_adapter(type(response)).dump_json(response, by_alias=by_alias)
@@ -0,0 +1,73 @@
+import time
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing dependency for a while, so callers fall back at once
+    instead of waiting on it.
+
+    The breaker is `closed` while calls succeed. After `failure_threshold` failed
+    calls in a row it opens and `allow()` turns every call away for `cooldown`
+    seconds. It is then `half_open`: a single trial call goes through, closing
+    the breaker if it succeeds and opening it again if it fails.
+
+    Not thread safe; it is only used from the event loop.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    STATES = (CLOSED, OPEN, HALF_OPEN)
+
+    def __init__(self, failure_threshold: int, cooldown: float):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        # when the pending trial call started, a trial that never reports back is given up after a cooldown
+        self._trial_at = None
+
+        self.opened = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self._opened_at < self.cooldown:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow(self) -> bool:
+        """
+        Whether a call may be made now. A `True` must be followed by `record_success`,
+        `record_failure` or `record_skipped`.
+        """
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        now = time.monotonic()
+        if state == self.HALF_OPEN and (self._trial_at is None or now - self._trial_at >= self.cooldown):
+            self._trial_at = now
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        self._failures = 0
+        self._opened_at = None
+        self._trial_at = None
+
+    def record_failure(self):
+        self._failures += 1
+        if self._trial_at is not None or (self._opened_at is None and self._failures >= self.failure_threshold):
+            self._opened_at = time.monotonic()
+            self.opened += 1
+        self._trial_at = None
+
+    def record_skipped(self):
+        """The call said nothing about the dependency, a pending trial is handed to the next call."""
+        self._trial_at = None
+
+    def stats(self) -> dict:
+        return {"state": self.state, "opened": self.opened, "rejected": self.rejected}
@@ -0,0 +1,68 @@
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from src.transaction.utils.security import decrypt_fields, encrypt_fields
+from src.transaction.utils.timing import timed
+
+
+class CryptoService:
+    """
+    Runs Fernet encryption and decryption of whole result sets on a thread pool.
+
+    `cryptography` releases the GIL while it works, so batches are spread over
+    the pool instead of blocking the event loop one value at a time. Decrypted
+    values are kept in a small LRU cache keyed by ciphertext; ciphertexts are
+    randomized, so an entry only ever matches the document it came from.
+    """
+
+    def __init__(self, max_workers: int, batch_size: int, cache_size: int):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="crypto")
+        self._batch_size = batch_size
+        self._cache_size = cache_size
+        self._cache: "OrderedDict[str, str]" = OrderedDict()
+
+    @timed("crypto")
+    async def encrypt_many(self, values: List[str]) -> List[str]:
+        encrypted = []
+        for batch in await self._run_in_batches(encrypt_fields, values):
+            encrypted.extend(batch)
+        return encrypted
+
+    @timed("crypto")
+    async def decrypt_many(self, values: List[str]) -> List[str]:
+        decrypted = [self._cache_get(value) for value in values]
+        missing = list({value for value, plain in zip(values, decrypted) if plain is None})
+        if not missing:
+            return decrypted
+
+        plain_values = {}
+        for batch, plain_batch in zip(self._batches(missing), await self._run_in_batches(decrypt_fields, missing)):
+            plain_values.update(zip(batch, plain_batch))
+
+        for value, plain in plain_values.items():
+            self._cache_set(value, plain)
+        return [plain if plain is not None else plain_values[value] for value, plain in zip(values, decrypted)]
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    def _batches(self, values: List[str]) -> List[List[str]]:
+        return [values[i:i + self._batch_size] for i in range(0, len(values), self._batch_size)]
+
+    async def _run_in_batches(self, func, values: List[str]) -> List[List[str]]:
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(*(loop.run_in_executor(self._executor, func, batch)
+                                      for batch in self._batches(values)))
+
+    def _cache_get(self, value: str):
+        plain = self._cache.get(value)
+        if plain is not None:
+            self._cache.move_to_end(value)
+        return plain
+
+    def _cache_set(self, value: str, plain: str):
+        self._cache[value] = plain
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
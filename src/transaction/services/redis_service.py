@@ -1,30 +1,569 @@
+import asyncio
+import gzip
+import struct
+import time
+import uuid
 from _decimal import Decimal
-from aioredis import Redis
+from typing import Any, Awaitable, Callable, Coroutine, Dict, Iterable, List, NamedTuple, Optional, Union
+
 import json
 
+import orjson
+from loguru import logger
+from redis.asyncio import BlockingConnectionPool, Redis
+from redis.asyncio.cluster import RedisCluster
+from redis.exceptions import ConnectionError as RedisConnectionError, MaxConnectionsError, \
+    TimeoutError as RedisTimeoutError
+
+from src.config import Config
+from src.transaction.services.circuit_breaker import CircuitBreaker
+from src.transaction.services.local_cache import LocalCache
+from src.transaction.services.redis_sharding import ClusterRedis, ShardedRedis
+from src.transaction.utils.timing import stage
+
+# fresh_until timestamp and flags, in front of the response body of every cache entry
+ENTRY_HEADER = struct.Struct(">dB")
+FLAG_GZIP = 0x01
+
+# failures of the cache server itself, as opposed to errors in the commands sent to it
+UNAVAILABLE_ERRORS = (RedisConnectionError, RedisTimeoutError, asyncio.TimeoutError, OSError)
+
+# seconds the invalidation listener waits for a message before checking on pending invalidations
+LISTEN_INTERVAL = 1.0
+
+_UNAVAILABLE = object()
+
+
+class PoolExhaustedError(MaxConnectionsError):
+    """Every connection of the pool stayed busy for the pool timeout. Redis itself may be fine."""
+
+
+class _BlockingConnectionPool(BlockingConnectionPool):
+    """Waits up to `timeout` for a free connection, then raises `PoolExhaustedError`."""
+
+    async def get_connection(self, command_name, *keys, **options):
+        try:
+            return await super().get_connection(command_name, *keys, **options)
+        except RedisConnectionError as e:
+            # the pool wraps the timeout of its wait, failures to connect are raised as they are
+            if isinstance(e.__cause__, asyncio.TimeoutError):
+                raise PoolExhaustedError(f"no free connection after {self.timeout:g}s") from e
+            raise
+
+
+async def connect_redis(url: str, nodes: str = "", cluster: bool = False):
+    """
+    Redis client of the cache, with a bounded pool per server, and timeouts so a slow
+    server fails fast instead of stalling requests. A call finding the pool exhausted
+    waits up to REDIS_POOL_TIMEOUT_MS for a connection.
+    @param url: the server, or with `cluster` any server of a Redis Cluster
+    @param nodes: comma separated urls of servers to shard the keys over by consistent
+    hashing, instead of `url`, see `redis_sharding`
+    @param cluster: whether `url` is a Redis Cluster
+    """
+    options = dict(
+        max_connections=Config.REDIS_MAX_CONNECTIONS,
+        socket_timeout=Config.REDIS_SOCKET_TIMEOUT_MS / 1000,
+        socket_connect_timeout=Config.REDIS_CONNECT_TIMEOUT_MS / 1000,
+        health_check_interval=Config.REDIS_HEALTH_CHECK_INTERVAL,
+    )
+    if cluster:
+        # the cluster client has no blocking pool, it raises MaxConnectionsError at once
+        return ClusterRedis(await RedisCluster.from_url(url, **options), await connect_redis_server(url, **options))
+
+    urls = [node.strip() for node in nodes.split(",") if node.strip()]
+    if urls:
+        return ShardedRedis({node: await connect_redis_server(node, **options) for node in urls}, Config.REDIS_VNODES)
+    return await connect_redis_server(url, **options)
+
+
+async def connect_redis_server(url: str, **options) -> Redis:
+    """Client of the server at `url`, whose pool waits up to REDIS_POOL_TIMEOUT_MS for a free connection."""
+    pool = _BlockingConnectionPool.from_url(url, timeout=Config.REDIS_POOL_TIMEOUT_MS / 1000, **options)
+    return await Redis.from_pool(pool)
+
+
+def user_key(user_id: str, name: str) -> str:
+    """
+    Redis key of a user's `name` entry. Its hash tag is the user id, so every key
+    of a user is stored on the same server of a sharded cache or cluster.
+    """
+    return f"{{{user_id}}}:{name}"
+
 
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, Decimal):
-            return float(obj)
-        return super(DecimalEncoder, self).default(obj)
+def _json_default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class CachedResponse(NamedTuple):
+    """
+    A cached response body, ready to be written to the client as is.
+    `body` is JSON, gzip-compressed when `compressed` is set.
+    """
+    body: bytes
+    compressed: bool
+    fresh_until: float
+
+    @classmethod
+    def encode(cls, data: Any, fresh_until: float = 0.0) -> "CachedResponse":
+        """
+        Serialize `data`, compressing bodies larger than `CACHE_COMPRESSION_THRESHOLD`.
+        `data` that is already JSON encoded bytes is taken as is.
+        """
+        with stage("serialization"):
+            body = data if isinstance(data, bytes) else orjson.dumps(data, default=_json_default)
+            compressed = 0 <= Config.CACHE_COMPRESSION_THRESHOLD < len(body)
+            if compressed:
+                body = gzip.compress(body, compresslevel=Config.CACHE_COMPRESSION_LEVEL, mtime=0)
+        return cls(body, compressed, fresh_until)
+
+    def decode(self) -> Any:
+        return orjson.loads(gzip.decompress(self.body) if self.compressed else self.body)
 
 
 class RedisService:
-    def __init__(self, redis: Redis):
+    """
+    Two tier cache: a per-process `LocalCache` (L1) in front of Redis (L2).
+
+    Writes bump the user's cache generation in Redis and broadcast the user id
+    on a pub/sub channel, so every replica drops its L1 copy of that generation
+    and the next read resolves the new one.
+
+    Entries are final response bodies, stored behind a small header holding
+    their freshness deadline, so a hit is served without decoding anything.
+    They are kept in Redis for `CACHE_STALE_TTL` seconds after they stop being
+    fresh, so `get_or_load` can answer with the stale body while a single loader
+    refreshes it.
+
+    Every command goes through a `CircuitBreaker`. A command that fails or times
+    out behaves as if nothing was cached, and once the breaker opens the cache is
+    bypassed altogether until its cooldown ends, so a degraded Redis never makes
+    a request slower than having no cache. Invalidations that could not be sent
+    are retried, and the users concerned bypass the cache until they are.
+
+    `redis` may spread the keys over several servers, see `connect_redis`: every
+    key is built with `user_key`, so all of a user's entries, generation and
+    session token are on one server.
+    """
+
+    RELEASE_LOCK_SCRIPT = """
+    if redis.call("get", KEYS[1]) == ARGV[1] then
+        return redis.call("del", KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, redis: Union[Redis, ShardedRedis, ClusterRedis], local_cache: Optional[LocalCache] = None):
         self.redis = redis
-        self.CACHE_EXPIRE_IN = 300
+        self.CACHE_EXPIRE_IN = Config.CACHE_EXPIRE_IN
+        self.local_cache = local_cache or LocalCache(Config.CACHE_L1_MAX_ENTRIES, Config.CACHE_L1_TTL)
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.loads = 0
+        self.load_failures = 0
+        self.bypassed = 0
+        self.pool_exhausted = 0
+        self.breaker = CircuitBreaker(Config.REDIS_BREAKER_FAILURES, Config.REDIS_BREAKER_COOLDOWN_SECONDS)
+        self._pending_invalidations = set()
+        self._listener = None
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._refreshes = set()
+        # background refreshes, referenced until they finish so they are not garbage collected mid-run
+        self._refresh_tasks = set()
+
+    async def get_or_load(self, key: str, loader: Callable[[], Awaitable[Any]]) -> CachedResponse:
+        """
+        Return the cached response of `key`, calling `loader` to compute its
+        content on a miss.
+
+        Concurrent misses in this process share one loader call, and a short
+        Redis lock lets a single replica recompute while the others wait for its
+        result. A value past its freshness is returned as is while one background
+        task refreshes it; if that refresh fails the stale value keeps being served.
+        A None `key`, for data whose cache generation is unknown, or an open
+        breaker skip the cache and return what `loader` computes.
+        """
+        if key is None or self.breaker.state == CircuitBreaker.OPEN:
+            return await self._load_uncached(loader)
+
+        entry = await self.get_cache(key)
+        if entry is not None:
+            if entry.fresh_until <= time.time():
+                self.stale_hits += 1
+                self._refresh_in_background(key, loader)
+            return entry
+
+        return await self._single_flight(key, loader)
+
+    async def get_or_load_many(self, keys: List[str], loader: Callable[[List[str]], Awaitable[Dict[str, Any]]],
+                               cache: bool = True) -> Dict[str, CachedResponse]:
+        """
+        Return the cached responses of `keys`, calling `loader` once with all
+        the missing keys to compute their content by key.
+
+        Each step is a single round trip however many keys there are: one MGET,
+        one load, one pipelined SET. Values past their freshness are returned as
+        is while one background load refreshes them. Unlike `get_or_load`,
+        misses are neither shared with concurrent callers nor locked across
+        replicas, which at worst costs a duplicate load. With `cache` unset or
+        an open breaker, the cache is skipped and `loader` computes every key.
+        """
+        if not cache or self.breaker.state == CircuitBreaker.OPEN:
+            self.bypassed += 1
+            self.loads += 1
+            return {key: CachedResponse.encode(value) for key, value in (await loader(keys)).items()}
+
+        entries = await self.get_caches(keys)
+        missing = [key for key, entry in entries.items() if entry is None]
+        if missing:
+            self.loads += 1
+            try:
+                values = await loader(missing)
+            except Exception:
+                self.load_failures += 1
+                raise
+            entries.update(await self.set_caches(values))
+
+        now = time.time()
+        stale = [key for key, entry in entries.items() if entry.fresh_until <= now]
+        if stale:
+            self.stale_hits += len(stale)
+            self._refresh_many_in_background(stale, loader)
+        return entries
 
-    async def get_cache(self, key: str):
-        """Retrieve cached data for the given user_id."""
-        cached_data = await self.redis.get(f"{key}")
+    async def get_cache(self, key: str) -> Optional[CachedResponse]:
+        """Retrieve the cache entry stored under `key`."""
+        cached_data = self.local_cache.get(key)
+        if cached_data is not None:
+            return cached_data
+
+        cached_data = await self._call(lambda: self.redis.get(key))
+        return self._read_entry(key, cached_data)
+
+    async def get_caches(self, keys: List[str]) -> Dict[str, Optional[CachedResponse]]:
+        """Retrieve the cache entries stored under `keys`, with a single MGET for those not in L1."""
+        entries = {key: self.local_cache.get(key) for key in keys}
+        missing = [key for key, entry in entries.items() if entry is None]
+        if missing:
+            values = await self._call(lambda: self.redis.mget(missing), [None] * len(missing))
+            for key, cached_data in zip(missing, values):
+                entries[key] = self._read_entry(key, cached_data)
+        return entries
+
+    def _read_entry(self, key: str, cached_data: Optional[bytes]) -> Optional[CachedResponse]:
         if cached_data:
-            return json.loads(cached_data)
+            self.hits += 1
+            fresh_until, flags = ENTRY_HEADER.unpack_from(cached_data)
+            cached_data = CachedResponse(cached_data[ENTRY_HEADER.size:], bool(flags & FLAG_GZIP), fresh_until)
+            self.local_cache.set(key, cached_data)
+            return cached_data
+
+        self.misses += 1
         return None
 
-    async def set_cache(self, data, key: str):
-        await self.redis.set(
-            key,
-            json.dumps(data, cls=DecimalEncoder),
-            ex=self.CACHE_EXPIRE_IN,
-        )
+    async def set_cache(self, data, key: str) -> CachedResponse:
+        """
+        Serialize `data` as the response body stored under `key`.
+        """
+        entry = CachedResponse.encode(data, time.time() + self.CACHE_EXPIRE_IN)
+        await self._call(lambda: self.redis.set(key, self._entry_bytes(entry),
+                                                ex=self.CACHE_EXPIRE_IN + Config.CACHE_STALE_TTL))
+        self.local_cache.set(key, entry)
+        return entry
+
+    async def set_caches(self, items: Dict[str, Any]) -> Dict[str, CachedResponse]:
+        """
+        Serialize each value of `items` as the response body stored under its key, in one pipelined round trip.
+        """
+        fresh_until = time.time() + self.CACHE_EXPIRE_IN
+        entries = {key: CachedResponse.encode(data, fresh_until) for key, data in items.items()}
+
+        async def set_entries():
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for key, entry in entries.items():
+                    pipe.set(key, self._entry_bytes(entry), ex=self.CACHE_EXPIRE_IN + Config.CACHE_STALE_TTL)
+                return await pipe.execute()
+
+        await self._call(set_entries)
+        for key, entry in entries.items():
+            self.local_cache.set(key, entry)
+        return entries
+
+    @staticmethod
+    def _entry_bytes(entry: CachedResponse) -> bytes:
+        return ENTRY_HEADER.pack(entry.fresh_until, FLAG_GZIP if entry.compressed else 0) + entry.body
+
+    async def get_generation(self, user_id: str) -> Optional[int]:
+        """
+        Current cache generation of a user. It is part of every cache key of that
+        user, so bumping it makes all their cached entries unreachable at once.
+        None when it cannot be known: Redis is unavailable, or the user's last
+        invalidation has not reached it yet.
+        """
+        if user_id in self._pending_invalidations:
+            return None
+        key = user_key(user_id, "cache_generation")
+        generation = self.local_cache.get(key)
+        if generation is not None:
+            return generation
+
+        generation = await self._call(lambda: self.redis.get(key), _UNAVAILABLE)
+        if generation is _UNAVAILABLE:
+            return None
+        generation = int(generation) if generation else 0
+        self.local_cache.set(key, generation)
+        return generation
+
+    async def get_generations(self, user_ids: List[str]) -> Optional[Dict[str, int]]:
+        """
+        Current cache generation of each user, see `get_generation`, with a single MGET for those not in L1.
+        None when the generation of any of them cannot be known.
+        """
+        if self._pending_invalidations.intersection(user_ids):
+            return None
+        generations = {user_id: self.local_cache.get(user_key(user_id, "cache_generation")) for user_id in user_ids}
+        missing = [user_id for user_id, generation in generations.items() if generation is None]
+        if missing:
+            values = await self._call(
+                lambda: self.redis.mget([user_key(user_id, "cache_generation") for user_id in missing]), _UNAVAILABLE)
+            if values is _UNAVAILABLE:
+                return None
+            for user_id, generation in zip(missing, values):
+                generations[user_id] = int(generation) if generation else 0
+                self.local_cache.set(user_key(user_id, "cache_generation"), generations[user_id])
+        return generations
+
+    async def get_session_token(self, user_id: str) -> Optional[str]:
+        """
+        Session token of the last write to the data of a user, see `bump_generations`.
+        """
+        session_token = await self._call(lambda: self.redis.get(user_key(user_id, "session_token")))
+        return session_token.decode() if isinstance(session_token, bytes) else session_token
+
+    async def get_session_tokens(self, user_ids: List[str]) -> List[str]:
+        """
+        Session tokens of the last writes to the data of the given users, for those that have one.
+        """
+        session_tokens = await self._call(
+            lambda: self.redis.mget([user_key(user_id, "session_token") for user_id in user_ids]), [])
+        return [session_token.decode() if isinstance(session_token, bytes) else session_token
+                for session_token in session_tokens if session_token]
+
+    async def bump_generations(self, user_ids: Iterable[str], session_token: Optional[str] = None):
+        """
+        Invalidate everything cached for the given users after their data changed.
+
+        `session_token` identifies the write that changed it. It is stored before
+        the generation moves, so a loader that sees the new generation can make
+        its read wait for that write instead of caching an older replica's view.
+        If Redis cannot be reached, the users bypass the cache in this process
+        until the invalidation is sent by `retry_invalidations`.
+        """
+        user_ids = list(set(user_ids))
+        if not user_ids:
+            return
+
+        async def bump():
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for user_id in user_ids:
+                    if session_token is not None:
+                        pipe.set(user_key(user_id, "session_token"), session_token,
+                                 ex=self.CACHE_EXPIRE_IN + Config.CACHE_STALE_TTL)
+                    pipe.incr(user_key(user_id, "cache_generation"))
+                pipe.publish(Config.CACHE_INVALIDATION_CHANNEL, json.dumps(user_ids))
+                return await pipe.execute()
+
+        if await self._call(bump, _UNAVAILABLE) is _UNAVAILABLE:
+            logger.warning(f"cache invalidation of {len(user_ids)} users could not reach redis, will retry")
+            self._pending_invalidations.update(user_ids)
+        else:
+            self._pending_invalidations.difference_update(user_ids)
+        self._drop_local_generations(user_ids)
+
+    async def retry_invalidations(self):
+        """Send the invalidations `bump_generations` could not, once Redis can be reached again."""
+        if self._pending_invalidations and self.breaker.state != CircuitBreaker.OPEN:
+            await self.bump_generations(list(self._pending_invalidations))
+
+    async def _call(self, command: Callable[[], Awaitable[Any]], default: Any = None) -> Any:
+        """
+        Run a Redis command through the circuit breaker. If Redis is unavailable,
+        too slow, or the breaker is open, `default` is returned instead. So it is when
+        every pooled connection is busy, without counting against Redis.
+        """
+        if not self.breaker.allow():
+            return default
+
+        opened = self.breaker.opened
+        try:
+            with stage("redis"):
+                result = await command()
+        except MaxConnectionsError:
+            # a burst of requests, not a failing server: the breaker would bypass the cache for everyone
+            self.pool_exhausted += 1
+            self.breaker.record_skipped()
+            return default
+        except UNAVAILABLE_ERRORS as e:
+            self.breaker.record_failure()
+            if self.breaker.opened != opened:
+                logger.error(f"redis unavailable, bypassing the cache for {self.breaker.cooldown:g}s: {e!r}")
+            return default
+        except Exception:
+            # redis answered, the command itself was wrong
+            self.breaker.record_success()
+            raise
+        self.breaker.record_success()
+        return result
+
+    async def _load_uncached(self, loader: Callable[[], Awaitable[Any]]) -> CachedResponse:
+        self.bypassed += 1
+        self.loads += 1
+        try:
+            return CachedResponse.encode(await loader())
+        except Exception:
+            self.load_failures += 1
+            raise
+
+    async def _single_flight(self, key: str, loader: Callable[[], Awaitable[Any]]) -> CachedResponse:
+        # The load runs in its own task, so a caller cancelled midway, such as a request whose
+        # client disconnected, leaves it running for the others waiting on the same key
+        flight = self._inflight.get(key)
+        if flight is None:
+            flight = self._inflight[key] = asyncio.create_task(self._load(key, loader))
+            flight.add_done_callback(lambda done: self._end_flight(key, done))
+        return await asyncio.shield(flight)
+
+    def _end_flight(self, key: str, flight: asyncio.Task):
+        del self._inflight[key]
+        # retrieving the exception also keeps a load nobody waits for anymore from being reported as unhandled
+        if not flight.cancelled() and isinstance(flight.exception(), Exception):
+            self.load_failures += 1
+
+    async def _load(self, key: str, loader: Callable[[], Awaitable[Any]]) -> CachedResponse:
+        token = await self._acquire_lock(key)
+        if token is None:
+            # Another replica is computing this entry, give it a chance to finish
+            deadline = time.monotonic() + Config.CACHE_LOCK_WAIT_MS / 1000
+            while time.monotonic() < deadline and self.breaker.state != CircuitBreaker.OPEN:
+                await asyncio.sleep(0.05)
+                entry = await self.get_cache(key)
+                if entry is not None:
+                    return entry
+
+        try:
+            self.loads += 1
+            value = await loader()
+            return await self.set_cache(value, key)
+        finally:
+            if token is not None:
+                await self._release_lock(key, token)
+
+    def _refresh_many_in_background(self, keys: List[str],
+                                    loader: Callable[[List[str]], Awaitable[Dict[str, Any]]]):
+        # keys another task is already refreshing are left to it
+        keys = [key for key in keys if key not in self._refreshes]
+        if not keys:
+            return
+        self._refreshes.update(keys)
+        self._spawn_refresh(self._refresh_many(keys, loader))
+
+    async def _refresh_many(self, keys: List[str], loader: Callable[[List[str]], Awaitable[Dict[str, Any]]]):
+        try:
+            self.loads += 1
+            await self.set_caches(await loader(keys))
+        except Exception as e:
+            self.load_failures += 1
+            logger.warning(f"refreshing {len(keys)} cache entries failed, serving stale data: {e}")
+        finally:
+            self._refreshes.difference_update(keys)
+
+    def _refresh_in_background(self, key: str, loader: Callable[[], Awaitable[Any]]):
+        if key in self._refreshes:
+            return
+        self._refreshes.add(key)
+        self._spawn_refresh(self._refresh(key, loader))
+
+    def _spawn_refresh(self, refresh: Coroutine):
+        task = asyncio.create_task(refresh)
+        self._refresh_tasks.add(task)
+        task.add_done_callback(self._refresh_tasks.discard)
+
+    async def _refresh(self, key: str, loader: Callable[[], Awaitable[Any]]):
+        token = None
+        try:
+            token = await self._acquire_lock(key)
+            if token is None:
+                # Another replica is already refreshing it
+                return
+            self.loads += 1
+            await self.set_cache(await loader(), key)
+        except Exception as e:
+            self.load_failures += 1
+            logger.warning(f"refreshing cache entry {key} failed, serving stale data: {e}")
+        finally:
+            self._refreshes.discard(key)
+            if token is not None:
+                await self._release_lock(key, token)
+
+    async def _acquire_lock(self, key: str) -> Optional[str]:
+        token = uuid.uuid4().hex
+        # without redis there is no one to wait for, so the caller goes ahead as if it held the lock
+        acquired = await self._call(lambda: self.redis.set(f"{key}:lock", token, nx=True,
+                                                           px=Config.CACHE_LOCK_TTL_MS), True)
+        return token if acquired else None
+
+    async def _release_lock(self, key: str, token: str):
+        await self._call(lambda: self.redis.eval(self.RELEASE_LOCK_SCRIPT, 1, f"{key}:lock", token))
+
+    def start(self):
+        """Start listening for invalidations broadcast by other replicas."""
+        self._listener = asyncio.create_task(self._listen_for_invalidations())
+
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            "l1": self.local_cache.stats(),
+            "l2": {"hits": self.hits, "misses": self.misses},
+            "stale_hits": self.stale_hits,
+            "loads": self.loads,
+            "load_failures": self.load_failures,
+            "bypassed": self.bypassed,
+            "pool_exhausted": self.pool_exhausted,
+            "pending_invalidations": len(self._pending_invalidations),
+            "breaker": self.breaker.stats(),
+        }
+
+    def _drop_local_generations(self, user_ids: Iterable[str]):
+        for user_id in user_ids:
+            self.local_cache.delete(user_key(user_id, "cache_generation"))
+
+    async def _listen_for_invalidations(self):
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(Config.CACHE_INVALIDATION_CHANNEL)
+                # Messages published while we were not subscribed are lost, so start from a clean L1
+                self.local_cache.clear()
+                while True:
+                    # polled with a timeout, as a blocking read would be cut short by the socket timeout
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=LISTEN_INTERVAL)
+                    if message is not None and message["type"] == "message":
+                        self._drop_local_generations(json.loads(message["data"]))
+                    await self.retry_invalidations()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"cache invalidation listener failed, resubscribing: {e}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.close()
@@ -0,0 +1,198 @@
+"""
+Clients spreading the cache over several Redis servers, with the subset of the
+redis-py asyncio interface `RedisService` uses.
+
+Keys are placed by their hash tag, the text between their first `{` and `}` as in
+Redis Cluster, and every key of a user is tagged with its `user_id`, see
+`redis_service.user_key`, so all of them live on the same server. `ShardedRedis`
+places them itself over independent servers by consistent hashing, `ClusterRedis`
+leaves it to a Redis Cluster. Either way pub/sub goes through a single server, the
+broker, every replica publishing and subscribing there.
+"""
+import abc
+import asyncio
+import bisect
+import hashlib
+from typing import Any, Dict, Iterable, List, Optional
+
+from redis.asyncio import Redis
+from redis.asyncio.cluster import RedisCluster
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+def hash_tag(key: str) -> str:
+    """Part of `key` that decides where it is stored: the text of its first non-empty `{...}`, else the whole key."""
+    start = key.find("{")
+    if start != -1:
+        end = key.find("}", start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+class HashRing:
+    """
+    Consistent hashing of keys over named nodes.
+
+    Each node owns `vnodes` points on a 64 bit ring and a key belongs to the node
+    of the first point at or after its hash. Adding or removing one of N nodes only
+    moves the keys of the points it gains or loses, about 1/N of them, and the
+    many points per node spread those evenly over the other nodes.
+    """
+
+    def __init__(self, nodes: Iterable[str], vnodes: int):
+        points = sorted((_hash(f"{node}#{index}"), node) for node in set(nodes) for index in range(vnodes))
+        if not points:
+            raise ValueError("a hash ring needs at least one node and one virtual node per node")
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key: str) -> str:
+        position = bisect.bisect_left(self._hashes, _hash(key))
+        # past the last point the ring wraps around to the first one
+        return self._nodes[position % len(self._nodes)]
+
+
+class ShardedPipeline:
+    """
+    Commands queued on a sharded client, sent as one non-transactional pipeline
+    per server holding their keys, all at once. PUBLISH goes to the broker once
+    the others are done, so subscribers never hear of a write before it is made.
+    """
+
+    def __init__(self, client: "_ShardedClient"):
+        self._client = client
+        self._commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self._commands.append((name, args, kwargs))
+            return self
+        return queue
+
+    async def execute(self) -> List[Any]:
+        commands, self._commands = self._commands, []
+        results = [None] * len(commands)
+        shards: Dict[Any, List[int]] = {}
+        published = []
+        for position, (name, args, kwargs) in enumerate(commands):
+            if name == "publish":
+                published.append(position)
+            else:
+                shards.setdefault(self._client.shard_of(args[0]), []).append(position)
+
+        async def run(shard, positions: List[int]):
+            async with shard.pipeline(transaction=False) as pipe:
+                for position in positions:
+                    name, args, kwargs = commands[position]
+                    getattr(pipe, name)(*args, **kwargs)
+                for position, result in zip(positions, await pipe.execute()):
+                    results[position] = result
+
+        await asyncio.gather(*(run(shard, positions) for shard, positions in shards.items()))
+        for position in published:
+            _, args, kwargs = commands[position]
+            results[position] = await self._client.broker.publish(*args, **kwargs)
+        return results
+
+
+class _ShardedClient(abc.ABC):
+    """Single key commands run on the shard of their key, multi key ones are split by shard and run concurrently."""
+
+    def __init__(self, broker: Redis):
+        self.broker = broker
+
+    @abc.abstractmethod
+    def shard_of(self, key: str):
+        """Client of the shard holding `key`."""
+
+    async def get(self, key: str):
+        return await self.shard_of(key).get(key)
+
+    async def set(self, key: str, value, **kwargs):
+        return await self.shard_of(key).set(key, value, **kwargs)
+
+    async def incr(self, key: str):
+        return await self.shard_of(key).incr(key)
+
+    async def mget(self, keys: List[str]) -> List[Optional[bytes]]:
+        shards: Dict[Any, List[int]] = {}
+        for position, key in enumerate(keys):
+            shards.setdefault(self.shard_of(key), []).append(position)
+
+        values = [None] * len(keys)
+
+        async def run(shard, positions: List[int]):
+            for position, value in zip(positions, await self._mget(shard, [keys[position] for position in positions])):
+                values[position] = value
+
+        await asyncio.gather(*(run(shard, positions) for shard, positions in shards.items()))
+        return values
+
+    async def _mget(self, shard, keys: List[str]) -> List[Optional[bytes]]:
+        return await shard.mget(keys)
+
+    async def eval(self, script: str, numkeys: int, *keys_and_args):
+        """Scripts run on the shard of their first key, the others must share its hash tag."""
+        return await self.shard_of(keys_and_args[0]).eval(script, numkeys, *keys_and_args)
+
+    async def publish(self, channel: str, message):
+        return await self.broker.publish(channel, message)
+
+    def pubsub(self):
+        return self.broker.pubsub()
+
+    def pipeline(self, transaction: bool = False) -> ShardedPipeline:
+        if transaction:
+            raise ValueError("a sharded pipeline cannot be a transaction, its commands run on several servers")
+        return ShardedPipeline(self)
+
+
+class ShardedRedis(_ShardedClient):
+    """
+    Independent Redis servers, each key going to the node its hash tag maps to on a
+    `HashRing` of their urls. The first node is the broker.
+    """
+
+    def __init__(self, nodes: Dict[str, Redis], vnodes: int):
+        super().__init__(next(iter(nodes.values())))
+        self.nodes = nodes
+        self.ring = HashRing(nodes, vnodes)
+
+    def shard_of(self, key: str) -> Redis:
+        return self.nodes[self.ring.node_for(hash_tag(key))]
+
+    async def aclose(self):
+        await asyncio.gather(*(node.aclose() for node in self.nodes.values()))
+
+
+class ClusterRedis(_ShardedClient):
+    """
+    A Redis Cluster, which places keys by the slot of their hash tag itself. The
+    asyncio cluster client has no pub/sub, so `broker` is a plain connection to one
+    of its servers; a cluster delivers what is published on any server to the
+    subscribers of all of them.
+    """
+
+    def __init__(self, cluster: RedisCluster, broker: Redis):
+        super().__init__(broker)
+        self.cluster = cluster
+
+    def shard_of(self, key: str) -> RedisCluster:
+        return self.cluster
+
+    async def _mget(self, shard, keys: List[str]) -> List[Optional[bytes]]:
+        # MGET cannot span slots, the cluster client splits it by slot
+        return await shard.mget_nonatomic(keys)
+
+    async def aclose(self):
+        await asyncio.gather(self.cluster.aclose(), self.broker.aclose())
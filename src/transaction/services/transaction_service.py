@@ -1,109 +1,474 @@
+import csv
+import io
 import json
-from typing import List
+from contextlib import asynccontextmanager
+from datetime import datetime
+from decimal import Decimal
+from typing import Any, AsyncIterable, AsyncIterator, List, Optional, Tuple, Union
 
-from fastapi.encoders import jsonable_encoder
+from bson import ObjectId
 from loguru import logger
-from pydantic import parse_obj_as
-from src.transaction.Exceptions.exceptions import TransactionRecordNotFoundError
+from pydantic import BaseModel, ValidationError
+
+from src.config import Config
+from src.transaction.Exceptions.exceptions import InvalidSessionTokenError, TransactionRecordNotFoundError
 from src.transaction.db.repository import TransactionRepository
-from src.transaction.dto.requests.transaction_create_req import TransactionCreateRequest, TransactionUpdateRequest
-from src.transaction.dto.responses.http_response import TransactionCreateResponse
+from src.transaction.dto.requests.transaction_create_req import TransactionCreateRequest, TransactionUpdateRequest, \
+    convert_datetime_to_realworld
+from src.transaction.dto.responses.http_response import TransactionCreateResponse, TRANSACTION_RESPONSE_FIELDS, \
+    dump_response, transaction_list_adapter, transaction_page_model
+from src.transaction.services.crypto_service import CryptoService
+from src.transaction.services.redis_service import CachedResponse, user_key
+from src.transaction.utils.analytics import transaction_day
+from src.transaction.utils.pagination import decode_cursor, encode_cursor
+from src.transaction.utils.security import blind_index, normalize_name
+from src.transaction.utils.session_token import decode_session_token, encode_session_token
+from src.transaction.utils.timing import stage
 from fastapi import Request
 
+TRANSACTION_EXPORT_FIELDS = ["_id", "user_id", "full_name", "transaction_amount", "transaction_type",
+                             "transaction_date", "transaction_currency"]
+
+
+def _export_value(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return convert_datetime_to_realworld(value)
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
 
 class TransactionService:
-    def __init__(self, transaction_repository: TransactionRepository) -> None:
+    def __init__(self, transaction_repository: TransactionRepository, crypto_service: CryptoService) -> None:
         self._repository = transaction_repository
+        self._crypto = crypto_service
 
-    async def create_transaction(self, payload: TransactionCreateRequest) -> TransactionCreateResponse:
+    async def create_transaction(self, payload: TransactionCreateRequest, request: Request) -> TransactionCreateResponse:
         """
         create a transaction record
+        The session token of the write is left on `request.state.session_token`.
         @param payload
+        @param request
         @return: transaction payload
         """
-        created = await self._repository.create_transaction(payload.dict())
+        async with self._repository.causal_session() as session:
+            created = await self._repository.create_transaction(payload.model_dump(), session=session)
+            session_token = encode_session_token(session)
+        request.state.session_token = session_token
+        await self.invalidate_cache([payload.user_id], request, session_token)
         if created:
             transaction_response = TransactionCreateResponse(**created)
             return transaction_response
 
+    async def enqueue_transaction(self, payload: TransactionCreateRequest,
+                                  request: Request) -> Optional[TransactionCreateResponse]:
+        """
+        queue a transaction record for the write-behind group commit
+        @param payload
+        @param request
+        @return: transaction payload, or None when the queue is full
+        """
+        write_behind_queue = request.app.state.write_behind_queue
+
+        document = payload.model_dump()
+        document["_id"] = ObjectId()
+        if not write_behind_queue.enqueue(document):
+            return None
+
+        return TransactionCreateResponse(**document)
+
+    async def create_transactions(self, records: AsyncIterable[Union[bytes, Any]], request: Request) -> List[dict]:
+        """
+        create transaction records in bulk
+        Records are validated, encrypted and written one chunk at a time, so a
+        streamed body never has to be held in memory as a whole.
+        @param records: raw JSON documents (bytes) or already decoded objects
+        @param request
+        @return: one result per record, in input order, with either an id or an error
+        """
+        results = []
+        chunk = []
+
+        async for record in records:
+            chunk.append(record)
+            if len(chunk) >= Config.BULK_INSERT_CHUNK_SIZE:
+                results.extend(await self._create_transaction_chunk(chunk, offset=len(results), request=request))
+                chunk = []
+
+        if chunk:
+            results.extend(await self._create_transaction_chunk(chunk, offset=len(results), request=request))
+
+        return results
+
+    async def _create_transaction_chunk(self, records: List[Union[bytes, Any]], offset: int,
+                                        request: Request) -> List[dict]:
+        results = []
+        payloads = []
+
+        with stage("validation"):
+            for index, record in enumerate(records, start=offset):
+                try:
+                    if isinstance(record, (bytes, str)):
+                        payload = TransactionCreateRequest.model_validate_json(
+                            record, context={"defer_encryption": True})
+                    else:
+                        payload = TransactionCreateRequest.model_validate(
+                            record, context={"defer_encryption": True})
+                except ValidationError as e:
+                    results.append({"index": index, "id": None,
+                                    "error": e.errors(include_url=False, include_context=False,
+                                                      include_input=False)})
+                    continue
+
+                results.append({"index": index, "id": None, "error": None})
+                payloads.append((len(results) - 1, payload))
+
+        if not payloads:
+            return results
+
+        # The whole chunk is encrypted off the event loop in one go
+        encrypted_names = await self._crypto.encrypt_many([payload.full_name for _, payload in payloads])
+
+        documents = []
+        for (_, payload), encrypted_name in zip(payloads, encrypted_names):
+            document = payload.model_dump()
+            document["_id"] = ObjectId()
+            document["full_name"] = encrypted_name
+            documents.append(document)
+
+        async with self._repository.causal_session() as session:
+            write_errors = await self._repository.create_transactions(documents, session=session)
+            session_token = encode_session_token(session)
+        request.state.session_token = session_token
+        await self.invalidate_cache([document["user_id"] for position, document in enumerate(documents)
+                                     if position not in write_errors], request, session_token)
+
+        for position, ((result_index, _), document) in enumerate(zip(payloads, documents)):
+            if position in write_errors:
+                results[result_index]["error"] = write_errors[position]
+            else:
+                results[result_index]["id"] = str(document["_id"])
+
+        return results
+
     async def update_transaction(self, transaction_id: str,
-                                 payload: TransactionUpdateRequest) -> TransactionCreateResponse:
+                                 payload: TransactionUpdateRequest, request: Request) -> TransactionCreateResponse:
         """
         create a transaction record
         @param payload
         @param transaction_id:
+        @param request
         @return: transaction payload
         """
-        response = await self._repository.update_transaction(transaction_id, payload.dict())
+        async with self._repository.causal_session() as session:
+            response = await self._repository.update_transaction(transaction_id, payload.model_dump(), session=session)
+            session_token = encode_session_token(session)
+        request.state.session_token = session_token
 
         if response is not None:
+            await self.invalidate_cache([response["user_id"]], request, session_token)
             return TransactionCreateResponse(**response)
         else:
             raise TransactionRecordNotFoundError(transaction_id)
 
-    async def delete_transaction(self, transaction_id: str) -> bool:
+    async def delete_transaction(self, transaction_id: str, request: Request) -> bool:
         """
         delete a transaction record
         @param transaction_id:
+        @param request
         @return: transaction payload
         """
-        response = await self._repository.delete_transaction(transaction_id)
-        if response.deleted_count == 1:
+        async with self._repository.causal_session() as session:
+            response = await self._repository.delete_transaction(transaction_id, session=session)
+            session_token = encode_session_token(session)
+        request.state.session_token = session_token
+        if response is not None:
+            await self.invalidate_cache([response["user_id"]], request, session_token)
             return True
 
         raise TransactionRecordNotFoundError(transaction_id)
 
-    async def fetch_transaction_history(self, user_id: str, request: Request) -> List[TransactionCreateResponse]:
+    async def fetch_transaction_history(self, user_id: str, request: Request, page: int = 1,
+                                        fields: Optional[List[str]] = None,
+                                        session_token: Optional[str] = None) -> CachedResponse:
         """
         Get list of transactions for a user
         @param user_id:  id
         @param request
-        @return:  list of transactions by a user
+        @param page: echoed back in the response
+        @param fields: fields to return, all by default
+        @param session_token: token of a write the response must reflect, bypasses the cache
+        @return:  the serialized response listing the transactions of a user
         """
-        cache_key = f"{user_id}:transaction_history"
+        fields = tuple(fields or TRANSACTION_RESPONSE_FIELDS)
+
+        async def load_transaction_history():
+            async with self._read_session(user_id, request, session_token) as session:
+                records = await self._repository.fetch_user_transaction_history(user_id, self._projection(fields),
+                                                                                session=session)
+            responses = await self._to_responses(records, fields)
+            with stage("serialization"):
+                return dump_response(transaction_page_model(fields).model_construct(
+                    is_successful=True,
+                    message="operation completed successfully",
+                    page=page,
+                    page_size=len(responses),
+                    next_cursor=None,
+                    data=responses), by_alias=True)
+
+        if session_token is not None:
+            return CachedResponse.encode(await load_transaction_history())
+
+        cache_key = await self.cache_key(user_id, f"transaction_history:{page}:{','.join(sorted(fields))}", request)
+        return await self.get_or_load_cache(cache_key, request, load_transaction_history)
 
-        # Check if the result is cached
-        cached_result = await self.get_cache(cache_key, request)
-        if cached_result:
-            return cached_result
+    async def fetch_transaction_history_page(self, user_id: str, page_size: int, cursor: Optional[str] = None,
+                                             fields: Optional[List[str]] = None) \
+            -> Tuple[List[BaseModel], Optional[str]]:
+        """
+        Get one page of transactions for a user using keyset pagination
+        @param user_id:  id
+        @param page_size: number of records per page
+        @param cursor: continuation token returned with the previous page, None for the first page
+        @param fields: fields to return, all by default
+        @return:  the page of transactions and the token for the next page, if any
+        """
+        fields = tuple(fields or TRANSACTION_RESPONSE_FIELDS)
+        after = decode_cursor(cursor) if cursor else None
 
-        records = await self._repository.fetch_user_transaction_history(user_id)
-        mapped_response = parse_obj_as(List[TransactionCreateResponse], records)
-        if records:
-            # Convert the Pydantic objects into JSON serializable data
-            encoded_response = jsonable_encoder(mapped_response)
+        records = await self._repository.fetch_user_transaction_history_page(user_id, page_size, after,
+                                                                             self._projection(fields))
 
-            # Serialize the encoded response into a JSON string
-            serialized_response = json.dumps(encoded_response)
-            await self.set_cache(cache_key, request, serialized_response)
+        next_cursor = None
+        if len(records) > page_size:
+            records = records[:page_size]
+            next_cursor = encode_cursor(records[-1]["transaction_date"], records[-1]["_id"])
 
-        return mapped_response
+        return await self._to_responses(records, fields), next_cursor
 
-    async def fetch_transaction_analytics(self, user_id: str, request: Request):
+    async def lookup_transactions_by_name(self, full_name: str, limit: int) -> List[BaseModel]:
+        """
+        Find the transactions of a customer by full name, newest first
+        Names match regardless of case and spacing. Records are found by blind
+        index, then checked against the decrypted name to drop index collisions.
+        @param full_name:
+        @param limit: maximum number of transactions to return
+        @return:  the matching transactions
+        """
+        fields = tuple(TRANSACTION_RESPONSE_FIELDS)
+        records = await self._repository.fetch_transactions_by_name(blind_index(full_name), self._projection(fields),
+                                                                    limit)
+        await self._decrypt_full_names(records)
+
+        name = normalize_name(full_name)
+        records = [record for record in records if normalize_name(record["full_name"]) == name]
+        with stage("validation"):
+            return transaction_list_adapter(fields).validate_python(records, context={"decrypted": True})
+
+    async def export_transaction_history(self, user_id: str, export_format: str, fields: List[str],
+                                         start_date: Optional[datetime] = None,
+                                         end_date: Optional[datetime] = None) -> AsyncIterator[bytes]:
+        """
+        Stream the full transaction history of a user as NDJSON or CSV
+        Rows are fetched, decrypted and encoded one cursor batch at a time.
+        @param user_id:  id
+        @param export_format: `ndjson` or `csv`
+        @param fields: fields to include, in output order
+        @param start_date:
+        @param end_date:
+        @return:  encoded chunks of the export
+        """
+        projection = self._projection(tuple(fields))
+
+        if export_format == "csv":
+            yield self._encode_csv_rows([fields])
+
+        async for batch in self._repository.iter_user_transactions(user_id, start_date, end_date, projection,
+                                                                     batch_size=Config.EXPORT_BATCH_SIZE):
+            if "full_name" in projection:
+                await self._decrypt_full_names(batch)
+
+            rows = [[_export_value(document.get(field)) for field in fields] for document in batch]
+            if export_format == "csv":
+                yield self._encode_csv_rows(rows)
+            else:
+                yield "".join(json.dumps(dict(zip(fields, row))) + "\n" for row in rows).encode()
+
+    @staticmethod
+    def _encode_csv_rows(rows: List[list]) -> bytes:
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        return buffer.getvalue().encode()
+
+    async def fetch_transaction_analytics(self, user_id: str, request: Request,
+                                          start_date: Optional[datetime] = None,
+                                          end_date: Optional[datetime] = None,
+                                          session_token: Optional[str] = None) -> CachedResponse:
         """
         Get summary of transaction data for a user
         @param user_id: 's id
         @return:  list of transactions by a user
         @param request:
+        @param start_date: only include transactions on or after this day
+        @param end_date: only include transactions on or before this day
+        @param session_token: token of a write the response must reflect, bypasses the cache
+        @return: the serialized response holding the analytics
         """
-        cache_key = f"{user_id}:transaction_analytics"
-        cached_result = await self.get_cache(cache_key, request)
-        if cached_result:
-            return cached_result
+        async def load_transaction_analytics():
+            async with self._read_session(user_id, request, session_token) as session:
+                analytics = await self._repository.fetch_user_transaction_analytics(user_id=user_id,
+                                                                                    start_date=start_date,
+                                                                                    end_date=end_date,
+                                                                                    session=session)
+            return {"is_successful": True, "message": "Successfully retrieved stats", "data": analytics}
 
-        records = await self._repository.fetch_user_transaction_analytics(user_id=user_id)
-        if records:
-            await self.set_cache(cache_key, request, records)
+        if session_token is not None:
+            return CachedResponse.encode(await load_transaction_analytics())
 
-        return records
+        cache_key = await self.cache_key(user_id, self._analytics_cache_name(start_date, end_date), request)
+        return await self.get_or_load_cache(cache_key, request, load_transaction_analytics)
 
-    async def get_cache(self, key: str, request):
+    async def fetch_materialized_transaction_analytics(self, user_id: str) -> CachedResponse:
+        """
+        Get summary of transaction data for a user, as of the last run of `commands.materialize_analytics`
+        A single read by key, so it is not cached.
+        @param user_id:
+        @return: the serialized response holding the analytics and when they were computed
+        """
+        analytics = await self._repository.fetch_materialized_transaction_analytics(user_id)
+        return CachedResponse.encode({"is_successful": True, "message": "Successfully retrieved stats",
+                                      "data": analytics})
+
+    async def fetch_transactions_analytics(self, user_ids: List[str], request: Request,
+                                           start_date: Optional[datetime] = None,
+                                           end_date: Optional[datetime] = None) -> CachedResponse:
+        """
+        Get summary of transaction data for many users at once
+        The users' cache entries are shared with `fetch_transaction_analytics`.
+        Hits are read with one MGET, misses computed by one aggregation and
+        written back in one pipeline, whatever the number of users.
+        @param user_ids:
+        @param request:
+        @param start_date: only include transactions on or after this day
+        @param end_date: only include transactions on or before this day
+        @return: the serialized response holding the analytics of every user
+        """
         redis_service = request.app.state.redis_service
+        cache_name = self._analytics_cache_name(start_date, end_date)
+        generations = await redis_service.get_generations(user_ids)
+        if generations is None:
+            # the cache cannot be used, the keys only tell the loader which users to compute
+            cache_keys = {user_id: user_id for user_id in user_ids}
+        else:
+            cache_keys = {user_key(user_id, f"{generations[user_id]}:{cache_name}"): user_id for user_id in user_ids}
+
+        async def load_transactions_analytics(keys: List[str]) -> dict:
+            keyed_user_ids = [cache_keys[key] for key in keys]
+            async with self._read_session_many(keyed_user_ids, request) as session:
+                analytics = await self._repository.fetch_users_transaction_analytics(keyed_user_ids,
+                                                                                     start_date=start_date,
+                                                                                     end_date=end_date,
+                                                                                     session=session)
+            return {key: {"is_successful": True, "message": "Successfully retrieved stats",
+                          "data": analytics[cache_keys[key]]} for key in keys}
+
+        entries = await redis_service.get_or_load_many(list(cache_keys), load_transactions_analytics,
+                                                       cache=generations is not None)
+        with stage("serialization"):
+            analytics = {cache_keys[key]: entry.decode()["data"] for key, entry in entries.items()}
+        return CachedResponse.encode({"is_successful": True, "message": "Successfully retrieved stats",
+                                      "data": analytics})
+
+    @staticmethod
+    def _analytics_cache_name(start_date: Optional[datetime], end_date: Optional[datetime]) -> str:
+        cache_name = "transaction_analytics"
+        if start_date is not None or end_date is not None:
+            start_day = start_date and transaction_day(start_date)
+            end_day = end_date and transaction_day(end_date)
+            cache_name = f"{cache_name}:{start_day}:{end_day}"
+        return cache_name
 
-        # Check if the result is cached
-        cached_result = await redis_service.get_cache(key)
-        return cached_result
+    async def _to_responses(self, records: List[dict], fields: Tuple[str, ...]) -> List[BaseModel]:
+        # Only pay for decryption when the names are actually returned
+        if "full_name" in fields:
+            await self._decrypt_full_names(records)
+        with stage("validation"):
+            return transaction_list_adapter(fields).validate_python(records, context={"decrypted": True})
 
-    async def set_cache(self, key, request, records):
+    @staticmethod
+    def _projection(fields: Tuple[str, ...]) -> dict:
+        projection = {field: 1 for field in fields}
+        if "_id" not in projection:
+            projection["_id"] = 0
+        return projection
+
+    async def _decrypt_full_names(self, records: List[dict]):
+        decrypted_names = await self._crypto.decrypt_many([record["full_name"] for record in records])
+        for record, decrypted_name in zip(records, decrypted_names):
+            record["full_name"] = decrypted_name
+
+    @asynccontextmanager
+    async def _read_session(self, user_id: str, request, session_token: Optional[str] = None):
+        """
+        Session for a read that may be served by a secondary. It waits for the
+        write behind `session_token`, or else for the last write to the user's data,
+        so a lagging member never answers with data older than what it must reflect.
+        """
+        if session_token is not None:
+            after = decode_session_token(session_token)
+        else:
+            after = self._decode_stored_session_token(
+                await request.app.state.redis_service.get_session_token(user_id))
+        async with self._repository.causal_session(after) as session:
+            yield session
+
+    @asynccontextmanager
+    async def _read_session_many(self, user_ids: List[str], request):
+        """
+        Session for a read of the data of many users, see `_read_session`. It waits for the latest of their last writes.
+        """
+        session_tokens = await request.app.state.redis_service.get_session_tokens(user_ids)
+        decoded = (self._decode_stored_session_token(session_token) for session_token in session_tokens)
+        after = max((operation_and_cluster_time for operation_and_cluster_time in decoded
+                     if operation_and_cluster_time is not None),
+                    key=lambda operation_and_cluster_time: operation_and_cluster_time[0], default=None)
+        async with self._repository.causal_session(after) as session:
+            yield session
+
+    @staticmethod
+    def _decode_stored_session_token(session_token: Optional[str]):
+        """
+        `(operation_time, cluster_time)` of the session token stored for a user's last write, if any.
+        Tokens that do not verify, such as those signed before SESSION_TOKEN_KEY was rotated, are ignored.
+        """
+        if not session_token:
+            return None
+        try:
+            return decode_session_token(session_token)
+        except InvalidSessionTokenError:
+            logger.warning("ignoring a stored session token that does not verify")
+            return None
+
+    async def cache_key(self, user_id: str, name: str, request) -> Optional[str]:
+        """
+        Cache key of a user's entry, versioned with the user's cache generation
+        so entries written before the user's last change are never read again.
+        None when the generation cannot be known, which makes the read skip the cache.
+        """
         redis_service = request.app.state.redis_service
-        await redis_service.set_cache(records, key)
+        generation = await redis_service.get_generation(user_id)
+        if generation is None:
+            return None
+        return user_key(user_id, f"{generation}:{name}")
+
+    async def invalidate_cache(self, user_ids: List[str], request, session_token: Optional[str] = None):
+        redis_service = request.app.state.redis_service
+        await redis_service.bump_generations(user_ids, session_token)
+
+    async def get_or_load_cache(self, key: str, request, loader):
+        redis_service = request.app.state.redis_service
+
+        # Serve from the cache, running `loader` once across concurrent misses
+        return await redis_service.get_or_load(key, loader)
@@ -0,0 +1,197 @@
+import asyncio
+import time
+from typing import List, Optional
+
+from loguru import logger
+from pymongo.errors import ConnectionFailure, PyMongoError
+
+from src.config import Config
+from src.transaction.db.repository import TransactionRepository
+from src.transaction.services.redis_service import RedisService
+from src.transaction.utils.session_token import encode_session_token
+
+
+def is_transient(error: Exception) -> bool:
+    """Whether a failed write may succeed if tried again: Mongo could not be reached, or said so."""
+    return isinstance(error, ConnectionFailure) or (
+        isinstance(error, PyMongoError)
+        and (error.has_error_label("RetryableWriteError") or error.has_error_label("TransientTransactionError")))
+
+
+class WriteBehindQueue:
+    """
+    Bounded in-process queue that group-commits transaction documents.
+
+    Documents are committed with one `insert_many` whenever `batch_size`
+    documents are waiting or `flush_interval` seconds have passed since the
+    first one of the batch was queued.
+
+    The documents were already accepted, so a commit that fails on a transient
+    error, such as Mongo being unreachable, is retried with an exponential backoff
+    until it succeeds. The queue keeps filling meanwhile, and new documents are
+    turned away once it is full. Documents Mongo rejects, a batch failing on any
+    other error, and the documents not committed WRITE_BEHIND_DRAIN_TIMEOUT_MS
+    after shutdown starts are counted as failed and logged.
+    """
+
+    def __init__(self, transaction_repository: TransactionRepository, redis_service: RedisService, max_size: int,
+                 batch_size: int, flush_interval: float):
+        self._repository = transaction_repository
+        self._redis_service = redis_service
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_size)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._stopping = asyncio.Event()
+        self._drain_deadline = None
+        self._task = None
+        self._pending: List[dict] = []
+
+        self.enqueued = 0
+        self.rejected = 0
+        self.flushed = 0
+        self.failed = 0
+        self.retries = 0
+        self.flushes = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop accepting work and commit everything still queued, giving up after WRITE_BEHIND_DRAIN_TIMEOUT_MS."""
+        self._drain_deadline = asyncio.get_running_loop().time() + Config.WRITE_BEHIND_DRAIN_TIMEOUT_MS / 1000
+        self._stopping.set()
+        if self._task is not None:
+            await self._task
+        logger.info(f"write-behind queue drained, {self.flushed} documents flushed, {self.failed} failed")
+
+    def enqueue(self, document: dict) -> bool:
+        """
+        Queue a document for the next group commit
+        @param document: transaction document carrying its own `_id`
+        @return: False when the queue is full or shutting down
+        """
+        if self._stopping.is_set():
+            self.rejected += 1
+            return False
+        try:
+            self._queue.put_nowait(document)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self.enqueued += 1
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self._queue.qsize() + len(self._pending),
+            "queue_capacity": self._queue.maxsize,
+            "enqueued": self.enqueued,
+            "rejected": self.rejected,
+            "flushed": self.flushed,
+            "failed": self.failed,
+            "retries": self.retries,
+            "flushes": self.flushes,
+            "last_flush_seconds": self.last_flush_seconds,
+            "max_flush_seconds": self.max_flush_seconds,
+            "avg_flush_seconds": self.total_flush_seconds / self.flushes if self.flushes else 0.0,
+        }
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            if batch:
+                await self._flush(batch)
+                self._pending = []
+            elif self._stopping.is_set():
+                return
+
+    async def _next_batch(self) -> List[dict]:
+        batch = self._pending = []
+        loop = asyncio.get_running_loop()
+        deadline = None
+
+        while len(batch) < self._batch_size:
+            if self._stopping.is_set():
+                # Drain whatever is left without waiting for the flush interval
+                while len(batch) < self._batch_size and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                break
+
+            timeout = self._flush_interval if deadline is None else deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                document = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                if batch:
+                    break
+                continue
+
+            batch.append(document)
+            if deadline is None:
+                deadline = loop.time() + self._flush_interval
+
+        return batch
+
+    async def _flush(self, batch: List[dict]):
+        started = time.perf_counter()
+        write_errors, session_token = await self._commit(batch)
+
+        elapsed = time.perf_counter() - started
+        self.flushes += 1
+        self.last_flush_seconds = elapsed
+        self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+        self.total_flush_seconds += elapsed
+        self.flushed += len(batch) - len(write_errors)
+        self.failed += len(write_errors)
+
+        for index, error in write_errors.items():
+            logger.error(f"write-behind insert failed for transaction {batch[index]['_id']}: {error}")
+
+        try:
+            await self._redis_service.bump_generations((document["user_id"] for index, document in enumerate(batch)
+                                                        if index not in write_errors), session_token)
+        except Exception as e:
+            logger.error(f"write-behind cache invalidation failed: {e}")
+
+    async def _commit(self, batch: List[dict]):
+        """
+        Insert the batch, retrying transient failures until the drain deadline, if the queue is stopping.
+        @return: write errors keyed by the position of the failed document, and the session token of the write
+        """
+        backoff = Config.WRITE_BEHIND_RETRY_BACKOFF_MS / 1000
+        attempt = 0
+        while True:
+            remaining = self._drain_remaining()
+            if remaining is not None and remaining <= 0:
+                logger.error(f"write-behind drain timed out, giving up on {len(batch)} transactions")
+                return {index: "not committed before the drain timeout" for index in range(len(batch))}, None
+            try:
+                async with self._repository.causal_session() as session:
+                    write_errors = await asyncio.wait_for(
+                        self._repository.create_transactions(batch, session=session, retried=attempt > 0), remaining)
+                    session_token = encode_session_token(session)
+            except asyncio.TimeoutError:
+                # the drain deadline passed during the attempt, which may have written part of the batch
+                attempt += 1
+                continue
+            except Exception as e:
+                if not is_transient(e):
+                    return {index: str(e) for index in range(len(batch))}, None
+                attempt += 1
+                self.retries += 1
+                logger.warning(f"write-behind insert of {len(batch)} transactions failed, retry {attempt} "
+                               f"in {backoff:g}s: {e!r}")
+                await asyncio.sleep(backoff if remaining is None else min(backoff, remaining))
+                backoff = min(backoff * 2, Config.WRITE_BEHIND_RETRY_MAX_BACKOFF_MS / 1000)
+                continue
+            return write_errors, session_token
+
+    def _drain_remaining(self) -> Optional[float]:
+        """Seconds left until the drain deadline, None while the queue is running."""
+        if self._drain_deadline is None:
+            return None
+        return self._drain_deadline - asyncio.get_running_loop().time()
@@ -1,7 +1,22 @@
+import asyncio
+import json
+import uuid
+from types import SimpleNamespace
+
 import pytest
 
+from bson import ObjectId, Timestamp
 from fastapi.testclient import TestClient
 from main import app
+from pymongo.errors import AutoReconnect, BulkWriteError
+from redis.exceptions import ConnectionError as RedisConnectionError
+from src.config import Config
+from src.persistence.base import database
+from src.transaction.db.indexes import explain_query_plans
+from src.transaction.db.repository import ROLLUP_UPDATE_FAILURES, TransactionRepository
+from src.transaction.services.redis_service import PoolExhaustedError, _BlockingConnectionPool, user_key
+from src.transaction.services.redis_sharding import HashRing, hash_tag
+from src.transaction.utils.session_token import encode_session_token
 
 
 def pytest_namespace():
@@ -105,6 +120,35 @@ def test_fetch_transaction_history(transaction_payload):
         assert response.status_code == 200
 
 
+def test_failed_rollup_update_is_counted(transaction_payload, monkeypatch):
+    async def fail(self, changes, session=None):
+        raise AutoReconnect("connection reset")
+
+    monkeypatch.setattr(TransactionRepository, "apply_rollup_deltas", fail)
+    failures = ROLLUP_UPDATE_FAILURES._value.get()
+    with TestClient(app, raise_server_exceptions=False) as c:
+        # standalone deployments write the rollups outside of a transaction
+        monkeypatch.setattr(database, "supports_transactions", False)
+        response = c.post("/api/v1/transactions", json=transaction_payload)
+        assert response.status_code == 500
+        assert ROLLUP_UPDATE_FAILURES._value.get() == failures + 1
+        assert "rollup_update_failures_total" in c.get("/metrics").text
+
+
+def test_failed_rollup_update_does_not_reject_written_transactions(transaction_payload, monkeypatch):
+    async def fail(self, changes, session=None):
+        raise BulkWriteError({"writeErrors": [{"index": 0, "code": 64, "errmsg": "waiting for replication timed out"}]})
+
+    monkeypatch.setattr(TransactionRepository, "apply_rollup_deltas", fail)
+    with TestClient(app) as c:
+        monkeypatch.setattr(database, "supports_transactions", False)
+        documents = [{**transaction_payload, "_id": ObjectId()} for _ in range(2)]
+        with pytest.raises(BulkWriteError):
+            c.portal.call(TransactionRepository().create_transactions, documents)
+        for document in documents:
+            assert c.portal.call(database.transactions.find_one, {"_id": document["_id"]}) is not None
+
+
 @pytest.mark.asyncio
 def test_fetch_transaction_analytics(transaction_payload):
     with TestClient(app) as c:
@@ -118,3 +162,507 @@ def test_fetch_transaction_analytics(transaction_payload):
         assert response.status_code == 200
         response_json = response.json()
         assert float(response_json['data']['average_transaction_value']) == transaction_payload['transaction_amount']
+
+
+def test_create_transactions_bulk(transaction_payload):
+    invalid_payload = {**transaction_payload, "transaction_type": "cash"}
+    with TestClient(app) as c:
+        response = c.post("/api/v1/transactions:bulk", json=[transaction_payload, invalid_payload])
+        assert response.status_code == 200
+        results = response.json()["data"]
+        assert results[0]["id"] is not None and results[0]["error"] is None
+        assert results[1]["id"] is None and results[1]["error"] is not None
+
+
+def test_create_transactions_bulk_ndjson(transaction_payload):
+    body = "\n".join(json.dumps(transaction_payload) for _ in range(3))
+    with TestClient(app) as c:
+        response = c.post("/api/v1/transactions:bulk", content=body,
+                          headers={"content-type": "application/x-ndjson"})
+        assert response.status_code == 200
+        assert [result["index"] for result in response.json()["data"]] == [0, 1, 2]
+        assert all(result["error"] is None for result in response.json()["data"])
+
+
+def test_create_transaction_respond_async(transaction_payload):
+    with TestClient(app) as c:
+        response = c.post("/api/v1/transactions", json=transaction_payload, headers={"Prefer": "respond-async"})
+        # without WRITE_BEHIND_ENABLED the record is written synchronously
+        expected_status = 202 if app.state.write_behind_queue is not None else 201
+        assert response.status_code == expected_status
+        assert response.json()["data"]["id"] is not None
+
+
+def test_write_behind_retries_transient_failures(transaction_payload, monkeypatch):
+    monkeypatch.setattr(Config, "WRITE_BEHIND_ENABLED", True)
+    monkeypatch.setattr(Config, "WRITE_BEHIND_RETRY_BACKOFF_MS", 10)
+    create_transactions = TransactionRepository.create_transactions
+    attempts = []
+
+    async def fail_once(self, transactions_data, session=None, retried=False):
+        attempts.append(len(transactions_data))
+        if len(attempts) == 1:
+            raise AutoReconnect("connection reset")
+        return await create_transactions(self, transactions_data, session=session, retried=retried)
+
+    monkeypatch.setattr(TransactionRepository, "create_transactions", fail_once)
+    with TestClient(app) as c:
+        response = c.post("/api/v1/transactions", json=transaction_payload, headers={"Prefer": "respond-async"})
+        assert response.status_code == 202
+        transaction_id = response.json()["data"]["id"]
+        write_behind_queue = app.state.write_behind_queue
+    # shutdown drains the queue
+
+    assert len(attempts) == 2
+    assert write_behind_queue.stats()["retries"] == 1
+    assert write_behind_queue.stats()["failed"] == 0
+    with TestClient(app) as c:
+        assert c.portal.call(database.transactions.find_one, {"_id": ObjectId(transaction_id)}) is not None
+
+
+def test_write_behind_gives_up_at_the_drain_timeout(transaction_payload, monkeypatch):
+    monkeypatch.setattr(Config, "WRITE_BEHIND_ENABLED", True)
+    monkeypatch.setattr(Config, "WRITE_BEHIND_RETRY_BACKOFF_MS", 10)
+    monkeypatch.setattr(Config, "WRITE_BEHIND_DRAIN_TIMEOUT_MS", 200)
+
+    async def fail(self, transactions_data, session=None, retried=False):
+        raise AutoReconnect("connection refused")
+
+    monkeypatch.setattr(TransactionRepository, "create_transactions", fail)
+    with TestClient(app) as c:
+        for _ in range(2):
+            response = c.post("/api/v1/transactions", json=transaction_payload, headers={"Prefer": "respond-async"})
+            assert response.status_code == 202
+        write_behind_queue = app.state.write_behind_queue
+    # shutdown gives up on the queue instead of retrying forever
+
+    assert write_behind_queue.stats()["flushed"] == 0
+    assert write_behind_queue.stats()["failed"] == 2
+    assert write_behind_queue.stats()["queue_depth"] == 0
+
+
+def test_write_behind_retry_updates_rollups_of_partially_written_batch(transaction_payload, monkeypatch):
+    monkeypatch.setattr(Config, "WRITE_BEHIND_ENABLED", True)
+    monkeypatch.setattr(Config, "WRITE_BEHIND_RETRY_BACKOFF_MS", 10)
+    # both documents go in one batch
+    monkeypatch.setattr(Config, "WRITE_BEHIND_BATCH_SIZE", 2)
+    monkeypatch.setattr(Config, "WRITE_BEHIND_FLUSH_INTERVAL_MS", 5000)
+    apply_rollup_deltas = TransactionRepository.apply_rollup_deltas
+    applied = []
+
+    async def record(self, changes, session=None):
+        changes = list(changes)
+        applied.extend(changes)
+        return await apply_rollup_deltas(self, changes, session=session)
+
+    monkeypatch.setattr(TransactionRepository, "apply_rollup_deltas", record)
+    with TestClient(app) as c:
+        monkeypatch.setattr(database, "supports_transactions", False)
+        insert_many = database.transactions.insert_many
+        attempts = []
+
+        async def write_first_then_fail(documents, **kwargs):
+            attempts.append(len(documents))
+            if len(attempts) == 1:
+                await insert_many(documents[:1], **kwargs)
+                raise AutoReconnect("connection reset")
+            return await insert_many(documents, **kwargs)
+
+        monkeypatch.setattr(database.transactions, "insert_many", write_first_then_fail)
+        for _ in range(2):
+            response = c.post("/api/v1/transactions", json=transaction_payload, headers={"Prefer": "respond-async"})
+            assert response.status_code == 202
+        write_behind_queue = app.state.write_behind_queue
+    # shutdown drains the queue
+
+    assert attempts == [2, 2]
+    assert write_behind_queue.stats()["flushed"] == 2
+    assert write_behind_queue.stats()["failed"] == 0
+    assert len(applied) == 2
+
+
+def test_fetch_transaction_history_cursor_pagination(transaction_payload):
+    with TestClient(app) as c:
+        c.post("/api/v1/transactions:bulk", json=[transaction_payload] * 5)
+        user_id = transaction_payload["user_id"]
+
+        seen = []
+        params = {"pagination": "cursor", "page_size": 2}
+        while True:
+            response = c.get(f"/api/v1/transactions/{user_id}", params=params)
+            assert response.status_code == 200
+            response_json = response.json()
+            seen.extend(record["_id"] for record in response_json["data"])
+            if response_json["next_cursor"] is None:
+                break
+            params["cursor"] = response_json["next_cursor"]
+
+        assert len(seen) == len(set(seen)) == 5
+
+
+def test_fetch_transaction_history_invalid_cursor(user_id):
+    with TestClient(app) as c:
+        response = c.get(f"/api/v1/transactions/{user_id}", params={"cursor": "not-a-cursor"})
+        assert response.status_code == 400
+
+
+def test_export_transaction_history(transaction_payload):
+    with TestClient(app) as c:
+        c.post("/api/v1/transactions:bulk", json=[transaction_payload] * 3)
+        user_id = transaction_payload["user_id"]
+
+        response = c.get(f"/api/v1/transactions/{user_id}/export")
+        assert response.status_code == 200
+        rows = [json.loads(line) for line in response.text.splitlines()]
+        assert len(rows) == 3
+        assert rows[0]["full_name"] == transaction_payload["full_name"]
+
+        response = c.get(f"/api/v1/transactions/{user_id}/export",
+                         params={"format": "csv", "fields": "_id,transaction_amount"})
+        assert response.status_code == 200
+        lines = response.text.splitlines()
+        assert lines[0] == "_id,transaction_amount"
+        assert len(lines) == 4
+
+
+def test_export_transaction_history_unknown_field(user_id):
+    with TestClient(app) as c:
+        response = c.get(f"/api/v1/transactions/{user_id}/export", params={"fields": "password"})
+        assert response.status_code == 422
+
+
+def test_fetch_transaction_analytics_date_range(transaction_payload):
+    later_payload = {**transaction_payload, "transaction_amount": 100, "transaction_date": "2024-10-07T09:40:53.695Z"}
+    with TestClient(app) as c:
+        c.post("/api/v1/transactions:bulk", json=[transaction_payload, later_payload, later_payload])
+        user_id = transaction_payload["user_id"]
+
+        response = c.get(f"/api/v1/transactions/{user_id}/analytics",
+                         params={"start_date": "2024-10-06T00:00:00Z"})
+        assert response.status_code == 200
+        response_json = response.json()
+        assert float(response_json['data']['average_transaction_value']) == 100
+        assert response_json['data']['day_with_most_transactions'] == "2024-10-07"
+        assert response_json['data']['transaction_count_on_that_day'] == 2
+
+
+def test_fetch_transaction_history_invalidated_on_write(transaction_payload):
+    with TestClient(app) as c:
+        user_id = transaction_payload["user_id"]
+        c.post("/api/v1/transactions", json=transaction_payload)
+        response = c.get(f"/api/v1/transactions/{user_id}")
+        assert len(response.json()["data"]) == 1
+
+        # the cached history must not outlive a write
+        c.post("/api/v1/transactions", json=transaction_payload)
+        response = c.get(f"/api/v1/transactions/{user_id}")
+        assert len(response.json()["data"]) == 2
+
+
+def test_cache_metrics(transaction_payload):
+    with TestClient(app) as c:
+        user_id = transaction_payload["user_id"]
+        c.post("/api/v1/transactions", json=transaction_payload)
+        c.get(f"/api/v1/transactions/{user_id}/analytics")
+        c.get(f"/api/v1/transactions/{user_id}/analytics")
+
+        response = c.get("/metrics/cache")
+        assert response.status_code == 200
+        assert response.json()["l1"]["hits"] >= 1
+
+
+def test_fetch_transaction_history_served_from_cache(transaction_payload):
+    with TestClient(app) as c:
+        user_id = transaction_payload["user_id"]
+        c.post("/api/v1/transactions:bulk", json=[transaction_payload] * 20)
+
+        first = c.get(f"/api/v1/transactions/{user_id}")
+        cached = c.get(f"/api/v1/transactions/{user_id}")
+        assert first.status_code == cached.status_code == 200
+        assert first.json() == cached.json()
+        assert cached.json()["page_size"] == 20
+        assert cached.headers.get("content-encoding") == "gzip"
+
+        uncompressed = c.get(f"/api/v1/transactions/{user_id}", headers={"Accept-Encoding": "identity"})
+        assert uncompressed.headers.get("content-encoding") is None
+        assert uncompressed.json() == first.json()
+
+
+def test_cached_body_respects_accept_encoding_quality(transaction_payload):
+    with TestClient(app) as c:
+        user_id = transaction_payload["user_id"]
+        c.post("/api/v1/transactions:bulk", json=[transaction_payload] * 20)
+        first = c.get(f"/api/v1/transactions/{user_id}")
+
+        for accept_encoding, content_encoding in [("gzip;q=0, identity", None), ("gzip; q=0.5", "gzip"),
+                                                  ("*;q=0.1", "gzip"), ("br, *;q=0", None)]:
+            response = c.get(f"/api/v1/transactions/{user_id}", headers={"Accept-Encoding": accept_encoding})
+            assert response.headers.get("content-encoding") == content_encoding
+            assert response.json() == first.json()
+
+
+def test_fetch_transaction_history_selected_fields(transaction_payload):
+    with TestClient(app) as c:
+        user_id = transaction_payload["user_id"]
+        c.post("/api/v1/transactions", json=transaction_payload)
+
+        response = c.get(f"/api/v1/transactions/{user_id}", params={"fields": "_id,transaction_amount"})
+        assert response.status_code == 200
+        assert set(response.json()["data"][0]) == {"_id", "transaction_amount"}
+
+        response = c.get(f"/api/v1/transactions/{user_id}", params={"fields": "full_name"})
+        assert response.json()["data"][0] == {"full_name": transaction_payload["full_name"]}
+
+        response = c.get(f"/api/v1/transactions/{user_id}", params={"fields": "password"})
+        assert response.status_code == 422
+
+
+def test_fetch_transaction_history_with_session_token(transaction_payload):
+    with TestClient(app) as c:
+        user_id = transaction_payload["user_id"]
+        created = c.post("/api/v1/transactions", json=transaction_payload)
+        assert created.status_code == 201
+
+        # standalone servers have no cluster time, so there may be no token to send back
+        session_token = created.headers.get("X-Session-Token")
+        if session_token is not None:
+            response = c.get(f"/api/v1/transactions/{user_id}", headers={"X-Session-Token": session_token})
+            assert response.status_code == 200
+            assert any(transaction["_id"] == created.json()["data"]["id"] for transaction in response.json()["data"])
+
+        response = c.get(f"/api/v1/transactions/{user_id}", headers={"X-Session-Token": "not-a-token"})
+        assert response.status_code == 400
+
+        # a well formed token that the server did not sign
+        forged = encode_session_token(SimpleNamespace(operation_time=Timestamp(2 ** 31, 1),
+                                                      cluster_time={"clusterTime": Timestamp(2 ** 31, 1)}))
+        payload, _, signature = forged.partition(".")
+        for session_token in (payload, f"{payload}.{signature[::-1]}"):
+            response = c.get(f"/api/v1/transactions/{user_id}", headers={"X-Session-Token": session_token})
+            assert response.status_code == 400
+
+
+def test_repository_queries_are_served_by_indexes():
+    with TestClient(app) as c:
+        # the lifespan has ensured the indexes, every query must be able to use one
+        assert c.portal.call(explain_query_plans) == {}
+
+
+def test_metrics_expose_repository_latency(transaction_payload):
+    with TestClient(app) as c:
+        c.post("/api/v1/transactions", json=transaction_payload)
+
+        response = c.get("/metrics")
+        assert response.status_code == 200
+        assert 'repository_operation_duration_seconds_count{operation="create_transaction"}' in response.text
+        assert 'mongo_command_duration_seconds_count{collection="transactions",command="insert"' in response.text
+
+
+def test_server_timing_on_request(transaction_payload):
+    with TestClient(app) as c:
+        user_id = transaction_payload["user_id"]
+        c.post("/api/v1/transactions", json=transaction_payload)
+
+        response = c.get(f"/api/v1/transactions/{user_id}", headers={"X-Server-Timing": "1"})
+        assert response.status_code == 200
+        assert "total;dur=" in response.headers["Server-Timing"]
+
+        response = c.get(f"/api/v1/transactions/{user_id}")
+        assert "Server-Timing" not in response.headers
+
+        metrics = c.get("/metrics").text
+        assert 'http_request_stage_duration_seconds_count{route="/api/v1/transactions",stage="mongo"}' in metrics
+        assert 'cache_hit_ratio{tier="l1"}' in metrics
+
+
+def test_storage_schema_v2(transaction_payload, transaction_payload_updated, monkeypatch):
+    monkeypatch.setattr(Config, "TRANSACTION_SCHEMA_VERSION", 2)
+    with TestClient(app) as c:
+        user_id = transaction_payload["user_id"]
+        created = c.post("/api/v1/transactions", json=transaction_payload)
+        assert created.status_code == 201
+        transaction_id = created.json()["data"]["id"]
+
+        stored = c.portal.call(database.transactions.find_one, {"_id": ObjectId(transaction_id)})
+        assert stored["v"] == 2
+        assert (stored["a"], stored["e"], stored["t"]) == (47566, 2, 2)
+        assert "transaction_amount" not in stored
+
+        response = c.get(f"/api/v1/transactions/{user_id}")
+        assert response.json()["data"][0]["transaction_amount"] == transaction_payload["transaction_amount"]
+        assert response.json()["data"][0]["transaction_type"] == transaction_payload["transaction_type"]
+        assert response.json()["data"][0]["full_name"] == transaction_payload["full_name"]
+
+        response = c.put(f"/api/v1/transactions/{transaction_id}", json=transaction_payload_updated)
+        assert response.status_code == 200
+        assert response.json()["data"]["transaction_amount"] == transaction_payload_updated["transaction_amount"]
+
+        response = c.get(f"/api/v1/transactions/{user_id}/analytics")
+        assert response.json()["data"]["average_transaction_value"] == \
+            transaction_payload_updated["transaction_amount"]
+
+
+def test_storage_schema_v2_keeps_oversized_amounts_in_v1(transaction_payload, monkeypatch):
+    monkeypatch.setattr(Config, "TRANSACTION_SCHEMA_VERSION", 2)
+    with TestClient(app) as c:
+        payload = {**transaction_payload, "transaction_amount": "123456789.123456789123"}
+        created = c.post("/api/v1/transactions", json=payload)
+        assert created.status_code == 201
+        transaction_id = created.json()["data"]["id"]
+
+        stored = c.portal.call(database.transactions.find_one, {"_id": ObjectId(transaction_id)})
+        assert "v" not in stored
+        assert "transaction_amount" in stored
+
+        response = c.get(f"/api/v1/transactions/{payload['user_id']}")
+        assert transaction_id in [transaction["_id"] for transaction in response.json()["data"]]
+
+
+def test_lookup_transactions_by_name(transaction_payload):
+    with TestClient(app) as c:
+        created = c.post("/api/v1/transactions", json=transaction_payload)
+        assert created.status_code == 201
+        transaction_id = created.json()["data"]["id"]
+
+        full_name = "  " + "  ".join(transaction_payload["full_name"].upper().split())
+        response = c.post("/api/v1/transactions:lookup", json={"full_name": full_name})
+        assert response.status_code == 200
+        assert transaction_id in [transaction["id"] for transaction in response.json()["data"]]
+        assert all(transaction["full_name"].casefold() == transaction_payload["full_name"].casefold()
+                   for transaction in response.json()["data"])
+
+
+def test_fetch_transactions_analytics_batch(transaction_payload):
+    user_id = f"batch-{uuid.uuid4().hex}"
+    with TestClient(app) as c:
+        c.post("/api/v1/transactions:bulk", json=[{**transaction_payload, "user_id": user_id}] * 2)
+
+        for _ in range(2):  # computed, then served from the cache
+            response = c.post("/api/v1/transactions/analytics:batch",
+                              json={"user_ids": [user_id, f"{user_id}-idle"]})
+            assert response.status_code == 200
+            data = response.json()["data"]
+            assert float(data[user_id]["average_transaction_value"]) == transaction_payload["transaction_amount"]
+            assert data[user_id]["transaction_count_on_that_day"] == 2
+            assert data[f"{user_id}-idle"] is None
+
+
+def test_fetch_materialized_transaction_analytics():
+    user_id = f"materialized-{uuid.uuid4().hex}"
+    analytics = {"average_transaction_value": 25.5, "day_with_most_transactions": "2024-10-07",
+                 "transaction_count_on_that_day": 3}
+    with TestClient(app) as c:
+        c.portal.call(database.analytics.insert_one, {"_id": user_id, **analytics, "transaction_count": 4,
+                                                      "run_id": "test"})
+
+        response = c.get(f"/api/v1/transactions/{user_id}/analytics", params={"source": "materialized"})
+        assert response.status_code == 200
+        assert {key: response.json()["data"][key] for key in analytics} == analytics
+
+        response = c.get(f"/api/v1/transactions/{user_id}/analytics",
+                         params={"source": "materialized", "start_date": "2024-10-06T00:00:00Z"})
+        assert response.status_code == 422
+
+
+def test_cancelled_cache_load_is_left_to_the_other_waiters():
+    key = f"test:{uuid.uuid4()}"
+    loads = []
+
+    async def cancel_the_first_caller():
+        redis_service = app.state.redis_service
+        release = asyncio.Event()
+
+        async def loader():
+            loads.append(key)
+            await release.wait()
+            return {"data": "value"}
+
+        first = asyncio.create_task(redis_service.get_or_load(key, loader))
+        await asyncio.sleep(0.05)
+        second = asyncio.create_task(redis_service.get_or_load(key, loader))
+        await asyncio.sleep(0.05)
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        return first.cancelled(), (await second).decode()
+
+    with TestClient(app) as c:
+        cancelled, value = c.portal.call(cancel_the_first_caller)
+        assert cancelled
+        assert value == {"data": "value"}
+        assert len(loads) == 1
+
+
+class _UnreachableRedis:
+    def __getattr__(self, name):
+        def unreachable(*args, **kwargs):
+            raise RedisConnectionError("unreachable")
+        return unreachable
+
+
+def test_cache_bypassed_while_redis_unavailable(transaction_payload, monkeypatch):
+    with TestClient(app) as c:
+        redis_service = app.state.redis_service
+        monkeypatch.setattr(redis_service, "redis", _UnreachableRedis())
+        user_id = transaction_payload["user_id"]
+
+        assert c.post("/api/v1/transactions", json=transaction_payload).status_code == 201
+        for _ in range(Config.REDIS_BREAKER_FAILURES):
+            response = c.get(f"/api/v1/transactions/{user_id}")
+            assert response.status_code == 200
+            assert response.json()["data"]
+
+        assert redis_service.breaker.state == "open"
+        assert 'cache_breaker_state{state="open"} 1.0' in c.get("/metrics").text
+
+
+class _ExhaustedRedis:
+    def __getattr__(self, name):
+        def exhausted(*args, **kwargs):
+            raise PoolExhaustedError("no free connection")
+        return exhausted
+
+
+def test_pool_exhaustion_does_not_open_the_breaker(transaction_payload, monkeypatch):
+    with TestClient(app) as c:
+        redis_service = app.state.redis_service
+        monkeypatch.setattr(redis_service, "redis", _ExhaustedRedis())
+        user_id = transaction_payload["user_id"]
+
+        assert c.post("/api/v1/transactions", json=transaction_payload).status_code == 201
+        for _ in range(Config.REDIS_BREAKER_FAILURES):
+            response = c.get(f"/api/v1/transactions/{user_id}")
+            assert response.status_code == 200
+            assert response.json()["data"]
+
+        assert redis_service.breaker.state == "closed"
+        assert redis_service.pool_exhausted >= Config.REDIS_BREAKER_FAILURES
+
+
+def test_exhausted_pool_raises_pool_exhausted_error():
+    async def get_second_connection():
+        pool = _BlockingConnectionPool(max_connections=1, timeout=0.01)
+        pool.get_available_connection()
+        await pool.get_connection("GET")
+
+    with pytest.raises(PoolExhaustedError):
+        asyncio.run(get_second_connection())
+
+
+def test_hash_ring_moves_few_keys_when_a_node_is_added():
+    nodes = [f"redis://node-{index}" for index in range(4)]
+    user_ids = [f"user-{index}" for index in range(10000)]
+    ring = HashRing(nodes, Config.REDIS_VNODES)
+    grown_ring = HashRing(nodes + ["redis://node-4"], Config.REDIS_VNODES)
+
+    placement = {user_id: ring.node_for(user_id) for user_id in user_ids}
+    moved = [user_id for user_id in user_ids if grown_ring.node_for(user_id) != placement[user_id]]
+    # about 1/5 of the keys, all of them to the new node
+    assert 0.15 < len(moved) / len(user_ids) < 0.25
+    assert {grown_ring.node_for(user_id) for user_id in moved} == {"redis://node-4"}
+    for node in nodes:
+        assert 0.2 < list(placement.values()).count(node) / len(user_ids) < 0.3
+
+    # every key of a user goes to the node of the user
+    keys = [user_key("user-1", "cache_generation"), user_key("user-1", "0:transaction_history:1:")]
+    assert {ring.node_for(hash_tag(key)) for key in keys} == {placement["user-1"]}
@@ -0,0 +1,43 @@
+from collections import defaultdict
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Iterable, Optional
+
+
+def transaction_day(transaction_date: datetime) -> str:
+    """UTC calendar day of a transaction, matching `$dateToString` with `%Y-%m-%d`."""
+    if transaction_date.tzinfo is not None:
+        transaction_date = transaction_date.astimezone(timezone.utc)
+    return transaction_date.strftime("%Y-%m-%d")
+
+
+def summarize_daily_rollups(rollups: Iterable[dict]) -> Optional[dict]:
+    """
+    Compute a user's analytics from their daily rollup rows
+
+    Assuming a single currency to allow for simplicity, rows of every currency
+    are added together.
+    :param rollups: rows with `day`, `transaction_count` and `transaction_amount`
+    :return: average value and busiest day, or None when there is nothing to report
+    """
+    transactions_per_day = defaultdict(int)
+    total_amount = Decimal(0)
+    total_transactions = 0
+
+    for rollup in rollups:
+        if rollup["transaction_count"] <= 0:
+            continue
+        transactions_per_day[rollup["day"]] += rollup["transaction_count"]
+        total_amount += Decimal(rollup["transaction_amount"])
+        total_transactions += rollup["transaction_count"]
+
+    if total_transactions == 0:
+        return None
+
+    # Ties go to the earliest day
+    day, count = max(sorted(transactions_per_day.items()), key=lambda item: item[1])
+    return {
+        "average_transaction_value": total_amount / total_transactions,
+        "day_with_most_transactions": day,
+        "transaction_count_on_that_day": count,
+    }
@@ -0,0 +1,20 @@
+from typing import AsyncIterator
+
+
+async def iter_ndjson_lines(stream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """
+    Split a streamed request body into NDJSON records as the bytes arrive.
+    Blank lines are skipped.
+    @param stream: request body stream
+    @return: one raw JSON document per line
+    """
+    buffer = b""
+    async for chunk in stream:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+
+    if buffer.strip():
+        yield buffer
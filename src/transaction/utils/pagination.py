@@ -0,0 +1,25 @@
+import base64
+import json
+from datetime import datetime
+from typing import Tuple
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+from src.transaction.Exceptions.exceptions import InvalidCursorError
+
+
+def encode_cursor(transaction_date: datetime, transaction_id: ObjectId) -> str:
+    """Build an opaque continuation token from the last `(transaction_date, _id)` of a page."""
+    raw = json.dumps([transaction_date.isoformat(), str(transaction_id)], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, ObjectId]:
+    """Read back a token produced by `encode_cursor`."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        transaction_date, transaction_id = json.loads(raw)
+        return datetime.fromisoformat(transaction_date), ObjectId(transaction_id)
+    except (ValueError, TypeError, InvalidId):
+        raise InvalidCursorError(cursor)
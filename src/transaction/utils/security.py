@@ -1,17 +1,72 @@
+import base64
+import hashlib
+import hmac
 import os
-from cryptography.fernet import Fernet
+import unicodedata
+from typing import List, Optional
+
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
 from loguru import logger
 
-# Load the Fernet key from an environment variable
+from src.transaction.utils.timing import stage
+
+# Load the Fernet keys from environment variables. FERNET_KEYS is a comma separated
+# list, newest first: the first key encrypts, every key is tried when decrypting.
 FERNET_KEY = os.getenv("FERNET_KEY")
-fernet = Fernet(FERNET_KEY.encode())
+FERNET_KEYS = [key.strip() for key in os.getenv("FERNET_KEYS", FERNET_KEY or "").split(",") if key.strip()]
+primary_fernet = Fernet(FERNET_KEYS[0].encode())
+fernet = MultiFernet([Fernet(key.encode()) for key in FERNET_KEYS])
+
+# Key of the blind indexes, kept apart from the Fernet keys so they can be rotated without rebuilding the
+# indexes. Changing it makes every stored index stale, so it never falls back to a Fernet key.
+BLIND_INDEX_KEY = os.getenv("BLIND_INDEX_KEY")
+if not BLIND_INDEX_KEY:
+    raise RuntimeError("BLIND_INDEX_KEY is not set, generate one with `python -c \"import base64, os; "
+                       "print(base64.urlsafe_b64encode(os.urandom(32)).decode())\"`")
+blind_index_key = base64.urlsafe_b64decode(BLIND_INDEX_KEY)
+# bytes of the HMAC kept, lookups recheck the decrypted value so collisions only cost a decryption
+BLIND_INDEX_SIZE = 16
 
 
 def encrypt_field(value: str) -> str:
     """Encrypt a field before saving to the database."""
-    return fernet.encrypt(value.encode()).decode()
+    with stage("crypto"):
+        return fernet.encrypt(value.encode()).decode()
 
 
 def decrypt_field(value: str) -> str:
     """Decrypt a field after retrieving from the database."""
-    return fernet.decrypt(value).decode()
+    with stage("crypto"):
+        return fernet.decrypt(value).decode()
+
+
+def encrypt_fields(values: List[str]) -> List[str]:
+    """Encrypt a batch of fields before saving to the database."""
+    return [fernet.encrypt(value.encode()).decode() for value in values]
+
+
+def decrypt_fields(values: List[str]) -> List[str]:
+    """Decrypt a batch of fields after retrieving from the database."""
+    return [fernet.decrypt(value).decode() for value in values]
+
+
+def normalize_name(value: str) -> str:
+    """Form of a name that lookups compare: compatibility normalized, case folded, whitespace collapsed."""
+    return " ".join(unicodedata.normalize("NFKC", value).casefold().split())
+
+
+def blind_index(value: str) -> bytes:
+    """
+    Keyed hash of a field's normalized value, stored next to its ciphertext so the field can be
+    looked up by equality without being decrypted. Equal names always get the same index.
+    """
+    return hmac.new(blind_index_key, normalize_name(value).encode(), hashlib.sha256).digest()[:BLIND_INDEX_SIZE]
+
+
+def rotate_field(value: str) -> Optional[str]:
+    """Re-encrypt a field with the primary key. Returns None if it already uses it."""
+    try:
+        primary_fernet.decrypt(value)
+        return None
+    except InvalidToken:
+        return fernet.rotate(value).decode()
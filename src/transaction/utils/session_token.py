@@ -0,0 +1,70 @@
+import base64
+import hashlib
+import hmac
+import os
+from typing import Optional, Tuple
+
+import bson
+from bson import Timestamp
+from bson.errors import BSONError
+
+from src.transaction.Exceptions.exceptions import InvalidSessionTokenError
+
+SESSION_TOKEN_HEADER = "X-Session-Token"
+
+# Key signing the tokens handed to clients, so they cannot make reads wait for forged cluster times
+SESSION_TOKEN_KEY = os.getenv("SESSION_TOKEN_KEY")
+if not SESSION_TOKEN_KEY:
+    raise RuntimeError("SESSION_TOKEN_KEY is not set, generate one with `python -c \"import secrets; "
+                       "print(secrets.token_urlsafe(32))\"`")
+# bytes of the HMAC kept in a token
+SIGNATURE_SIZE = 16
+
+
+def _b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _b64decode(value: str) -> bytes:
+    return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+
+
+_key = _b64decode(SESSION_TOKEN_KEY)
+
+
+def _signature(raw: bytes) -> bytes:
+    return hmac.new(_key, raw, hashlib.sha256).digest()[:SIGNATURE_SIZE]
+
+
+def encode_session_token(session) -> Optional[str]:
+    """
+    Build an opaque token from the operation and cluster time a causally consistent session reached,
+    signed with SESSION_TOKEN_KEY so clients cannot forge the times the server will wait for.
+    None when the deployment does not report them (standalone servers).
+    """
+    if session is None or session.operation_time is None or session.cluster_time is None:
+        return None
+
+    raw = bson.encode({"operationTime": session.operation_time, "clusterTime": session.cluster_time})
+    return f"{_b64encode(raw)}.{_b64encode(_signature(raw))}"
+
+
+def decode_session_token(session_token: str) -> Tuple[Timestamp, dict]:
+    """
+    Read back the `(operation_time, cluster_time)` of a token produced by `encode_session_token`.
+    Tokens that are malformed or not signed with SESSION_TOKEN_KEY raise `InvalidSessionTokenError`.
+    """
+    try:
+        payload, _, signature = session_token.partition(".")
+        raw = _b64decode(payload)
+        if not hmac.compare_digest(_b64decode(signature), _signature(raw)):
+            raise InvalidSessionTokenError(session_token)
+        document = bson.decode(raw)
+        operation_time, cluster_time = document["operationTime"], document["clusterTime"]
+    except (ValueError, KeyError, TypeError, BSONError):
+        raise InvalidSessionTokenError(session_token)
+
+    if not isinstance(operation_time, Timestamp) or not isinstance(cluster_time, dict) \
+            or not isinstance(cluster_time.get("clusterTime"), Timestamp):
+        raise InvalidSessionTokenError(session_token)
+    return operation_time, cluster_time
@@ -0,0 +1,127 @@
+"""
+Per-request stage timings.
+
+`TimingMiddleware` gives every request a dict of stage durations. The
+`stage` context manager and the `timed` decorator add to it, wherever they
+run during that request, and cost a `perf_counter` call and a contextvar
+lookup each. At the end of the request the durations are observed into
+`REQUEST_STAGE_SECONDS`, and can be sent back in a `Server-Timing` header.
+"""
+import functools
+import time
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from prometheus_client import Histogram
+
+STAGES = ("validation", "crypto", "redis", "mongo", "serialization")
+
+REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds",
+    "Duration of the HTTP requests, until the response starts",
+    ["method", "route", "status"],
+)
+REQUEST_STAGE_SECONDS = Histogram(
+    "http_request_stage_duration_seconds",
+    "Time spent by the HTTP requests in each stage",
+    ["route", "stage"],
+)
+
+# stage durations of the request being handled, None outside of requests
+request_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("request_timings", default=None)
+
+
+def record_stage(name: str, seconds: float):
+    timings = request_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+class stage:
+    """Add the time spent in the block to stage `name` of the current request."""
+
+    __slots__ = ("name", "started")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        record_stage(self.name, time.perf_counter() - self.started)
+
+
+def timed(name: str):
+    """Add the time spent in an async function to stage `name` of the current request."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                record_stage(name, time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
+
+
+def server_timing(timings: Dict[str, float], total: float) -> str:
+    """Format stage durations as a `Server-Timing` header value, in milliseconds."""
+    metrics = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in timings.items()]
+    metrics.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(metrics)
+
+
+class TimingMiddleware:
+    """
+    ASGI middleware timing every HTTP request and its stages.
+
+    `server_timing` decides when the stage durations are sent back in a
+    `Server-Timing` header: "always", "request" when the request carries an
+    `X-Server-Timing` header, or "off". The header goes out with the start of
+    the response, so for streamed responses it only covers the work done before
+    the first chunk; the histograms cover the whole request.
+    """
+
+    def __init__(self, app, server_timing: str = "request"):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings = {}
+        token = request_timings.set(timings)
+        started = time.perf_counter()
+        send_header = self.server_timing == "always" or (
+            self.server_timing == "request" and any(name == b"x-server-timing" for name, _ in scope["headers"]))
+        status = 500
+        elapsed = None
+
+        async def send_with_timing(message):
+            nonlocal status, elapsed
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                elapsed = time.perf_counter() - started
+                if send_header:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", server_timing(timings, elapsed).encode()))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            request_timings.reset(token)
+            if elapsed is None:
+                elapsed = time.perf_counter() - started
+            # the route template, not the raw path, keeps the number of label values bounded
+            route = getattr(scope.get("route"), "path", "unmatched")
+            REQUEST_SECONDS.labels(scope["method"], route, status).observe(elapsed)
+            for name, seconds in timings.items():
+                REQUEST_STAGE_SECONDS.labels(route, name).observe(seconds)